@@ -0,0 +1,506 @@
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import ssl
+import time
+
+import metrics
+import service
+from bus import BusClient, BusHub
+from compression import BATCH_SIZE, COMPRESSION, Compressor
+from outbound import OutboundQueue, bulk_written
+from protocol import (OP_INVALID_USERNAME, OP_LOGIN, OP_REQUEST_USERNAME, OP_VALID_USERNAME, FrameDecoder, FrameError,
+                      decode_envelope, encode_envelope, encode_frame)
+from reconnect import login_body, new_token, parse_login_body, valid_token
+from registry import UserRecord, valid_username
+from service import (HOST, LISTEN_BACKLOG, PORT, configure, configure_logging, enter_chat, expire_login,
+                     flood_control, handle_message, logger, open_message_log, remove_client, take_over)
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the open file limit is not the bottleneck
+    resource = None
+
+# Seconds worker processes are given to stop before being killed
+WORKER_STOP_TIMEOUT = 5
+# Seconds a worker whose hub is gone waits for its connections' tasks to end
+DRAIN_TIMEOUT = 1
+
+# Running writer tasks (the event loop only keeps weak references to tasks)
+writer_tasks = set()
+# Task serving each connection (login then message handling) -> the connection's stream writer
+connections = {}
+
+
+def raise_file_limit():
+    """
+    Raises the process' open file limit to its hard maximum so that tens of thousands of sockets can be held open.
+    :return: the new soft limit, or None if it could not be changed
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+async def read_message(reader, decoder, chunk_size=65536):
+    """
+    Waits until a whole message has been received from the given stream.
+    :param reader: the stream reader to receive from
+    :param decoder: the FrameDecoder holding the stream's partially received data
+    :param chunk_size: the maximum number of bytes to read at once
+    :return: the decoded Envelope, or None if the connection was closed
+    """
+    frame = decoder.next_frame()
+    while frame is None:
+        data = await reader.read(chunk_size)
+        # Peer closed the connection
+        if not data:
+            return None
+        metrics.bytes_received.inc(len(data))
+        decoder.feed(data)
+        frame = decoder.next_frame()
+    return decode_envelope(frame)
+
+
+async def write_messages(writer, outbound, ready, compressor=None):
+    """
+    Writes the messages queued for a client until their queue is closed, sending everything that piled up in one
+    write.
+    :param writer: the client's stream writer
+    :param outbound: the client's OutboundQueue
+    :param ready: event set whenever the queue has something for the writer to do
+    :param compressor: the client's Compressor, if they asked for compression
+    :return:
+    """
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            frames = outbound.take_all()
+            # Messages go first, then no more than a write's worth of file chunks before checking for messages again
+            chunks = outbound.take_bulk()
+            if frames:
+                # A small write waits a moment for more messages to join it (like Nagle's algorithm, but bounded),
+                # unless file chunks are waiting behind it anyway
+                if service.batch_window > 0 and not chunks and sum(len(frame) for frame in frames) < BATCH_SIZE:
+                    await asyncio.sleep(service.batch_window)
+                    frames += outbound.take_all()
+                data = b''.join(frames)
+                if compressor is not None:
+                    data = compressor.compress(data)
+                # Connection is already being closed (a TLS transport even fails on writes once closed)
+                if writer.is_closing():
+                    break
+                writer.write(data)
+                await writer.drain()
+                metrics.messages_sent.inc(len(frames))
+                metrics.bytes_sent.inc(len(data))
+                metrics.write_batch_messages.observe(len(frames))
+            if chunks:
+                if writer.is_closing():
+                    break
+                # File data is handed to the transport straight from the frames it arrived in, never compressed
+                buffers = [buffer for item, _ in chunks for buffer in item]
+                writer.writelines(buffers)
+                await writer.drain()
+                bulk_written(chunks)
+                metrics.messages_sent.inc(len(chunks))
+                metrics.bytes_sent.inc(sum(len(buffer) for buffer in buffers))
+                if outbound.bulk:
+                    ready.set()
+            if not frames and not chunks and outbound.closed:
+                break
+    except ConnectionError:
+        pass
+    # Connection broke, drop it so the client's handle_client task removes it
+    if not outbound.closed:
+        writer.transport.abort()
+
+
+def start_writer(writer, compressor=None):
+    """
+    Creates a client's outbound queue and starts the task that drains it.
+    :param writer: the client's stream writer
+    :param compressor: the client's Compressor, if they asked for compression
+    :return: the client's OutboundQueue
+    """
+    ready = asyncio.Event()
+    # A client too slow to keep up is dropped without flushing, its writer may be stuck waiting on it
+    outbound = OutboundQueue(service.queue_size, service.slow_consumer_policy, wakeup=ready.set,
+                             on_overflow=writer.transport.abort)
+    task = asyncio.create_task(write_messages(writer, outbound, ready, compressor))
+    writer_tasks.add(task)
+    task.add_done_callback(writer_tasks.discard)
+    return outbound
+
+
+def close_client(writer):
+    """
+    Closes a removed client's connection, once whatever is still buffered for it has been sent.
+    :param writer: the client's stream writer
+    :return:
+    """
+    writer.close()
+
+
+def abort_client(writer):
+    """
+    Drops a client's connection at once, without flushing (its peer may never read what is buffered).
+    :param writer: the client's stream writer
+    :return:
+    """
+    writer.transport.abort()
+
+
+def call_later(delay, callback):
+    """
+    Runs a callback after a delay on the running event loop.
+    :param delay: seconds to wait
+    :param callback: function to call
+    :return:
+    """
+    asyncio.get_running_loop().call_later(delay, callback)
+
+
+async def handle_client(user, reader):
+    """
+    Handles a user's sent message if user is available. Else, removes user and ends the task.
+    :param user: UserRecord of the user to receive messages from
+    :param reader: the user's stream reader
+    :return:
+    """
+    try:
+        while True:
+            envelope = await read_message(reader, user.decoder)
+            # An empty read means the user closed their connection
+            if envelope is None:
+                break
+            if handle_message(user, envelope):
+                await throttle(user.flood)
+    # The user disconnected, crashed, broke TLS or sent something that could not be decoded
+    except (OSError, FrameError):
+        pass
+    # A message the server failed to handle still ends the connection cleanly
+    except Exception:
+        logger.exception('Error handling a message from %s.', user.username)
+    finally:
+        # Whatever ended the loop, the user is removed and their connection closed before the task ends
+        remove_client(user)
+
+
+async def throttle(flood):
+    """
+    Charges a connection for a message, and if it is sending too fast stops reading from it until it is back within
+    its limits. Once the stream's buffer fills up its transport stops reading too, so TCP slows the sender down instead
+    of the server buffering its input.
+    :param flood: the connection's FloodControl
+    :return:
+    """
+    delay = flood.take()
+    if delay:
+        metrics.reads_paused.inc()
+        await asyncio.sleep(delay)
+
+
+def run_wheel():
+    """
+    Runs the timers due on the timer wheel, then schedules itself again for the next tick.
+    :return:
+    """
+    service.wheel.advance()
+    call_later(service.wheel.tick, run_wheel)
+
+
+async def login(reader, writer):
+    """
+    Handles user login attempts by looping in a separate task until either a valid (unique) username is given or
+    the user closes the login window.
+    :param reader: stream reader of the client to handle login for
+    :param writer: stream writer of the client to handle login for
+    :return:
+    """
+    accepted = time.perf_counter()
+    task = asyncio.current_task()
+    connections[task] = writer
+    metrics.connections_accepted.inc()
+    address = writer.get_extra_info('peername')[0]
+    logger.debug('Connection from %s accepted.', address)
+    # The event loop has already run the TLS handshake, without holding up accepting others
+    connection = writer.get_extra_info('ssl_object')
+    if connection is not None:
+        metrics.tls_handshakes.inc()
+        if connection.session_reused:
+            metrics.tls_resumed.inc()
+    # The event loop accepts connections by itself, so those arriving too fast wait here before being served
+    delay = service.accept_bucket.take()
+    if delay:
+        metrics.accepts_paused.inc()
+        await asyncio.sleep(delay)
+    # Decoder holding any of the client's data received but not yet handled
+    decoder = FrameDecoder(service.max_message_size)
+    flood = flood_control(address)
+    # The user's record, once their username is reserved
+    user = None
+    # A client that never finishes logging in (e.g. a half-open connection) is closed at the deadline
+    deadline = (service.wheel.schedule(service.login_timeout, lambda: expire_login(writer))
+                if service.login_timeout > 0 else None)
+    try:
+        # Send the initial message to user to request the declaration of a username
+        writer.write(encode_frame(encode_envelope(OP_REQUEST_USERNAME)))
+        await writer.drain()
+        while True:
+            # The user's username input
+            envelope = await read_message(reader, decoder)
+
+            # If user hits 'Cancel' on the popup asking for a username, close the connection
+            if envelope is None or envelope.op != OP_LOGIN or len(envelope.sender) == 0:
+                writer.close()
+                break
+            username = envelope.sender
+            # A username that would corrupt user lists is refused like a taken one
+            if not valid_username(username):
+                writer.write(encode_frame(encode_envelope(OP_INVALID_USERNAME)))
+                await writer.drain()
+                await throttle(flood)
+                continue
+            # The client lists the optional features it supports in the body, and where to resume from if it is
+            # reconnecting
+            features, options = parse_login_body(envelope.body)
+            compress = service.compression and COMPRESSION in features
+
+            # Queue of messages waiting to be written to the user, drained by its own writer task
+            outbound = start_writer(writer, Compressor(service.compress_threshold) if compress else None)
+            user = UserRecord(username, writer, outbound, decoder, address=address, flood=flood, token=new_token())
+
+            # If username is already taken (and not by the user's own stale connection), request user to input a valid
+            # username
+            if not await reserve(user) and not (take_over(username, options.get('token')) and await reserve(user)):
+                user = None
+                outbound.close()
+                writer.write(encode_frame(encode_envelope(OP_INVALID_USERNAME)))
+                await writer.drain()
+                # Login attempts count against the same limits as messages
+                await throttle(flood)
+                continue
+            outbound.put(encode_frame(encode_envelope(
+                OP_VALID_USERNAME, body=login_body([COMPRESSION] if compress else [], token=user.token))))
+            enter_chat(user, options)
+
+            metrics.logins.inc()
+            metrics.login_seconds.observe(time.perf_counter() - accepted)
+            logger.debug('Client username: %s', username)
+            if deadline is not None:
+                deadline.cancel()
+            service.heartbeats.watch(user)
+            # Keep serving the user from this task
+            await handle_client(user, reader)
+            break
+    except (ConnectionError, ssl.SSLError, FrameError):
+        # User dropped during login, forget any reservation made for them
+        if user is not None:
+            remove_client(user)
+        writer.close()
+    finally:
+        connections.pop(task, None)
+        if deadline is not None:
+            deadline.cancel()
+        # Once registered, the connection's share of its address' limit is given up when the user is removed
+        if user is None:
+            service.addresses.release(address)
+
+
+async def reserve(user):
+    """
+    Reserves a user's username, on every worker when running several.
+    :param user: the UserRecord to add
+    :return: True if the username was free and is now reserved, else False
+    """
+    if service.bus is None:
+        return service.registry.reserve(user)
+    # The hub decides for every worker; a username it hands out is free here too, as users are removed here before
+    # their username is released
+    return await service.bus.reserve(user.username) and service.registry.reserve(user)
+
+
+def relay_room_message(event, message):
+    """
+    Publishes a room message relayed by the hub to the room's members on this worker.
+    :param event: the hub's 'room' event
+    :param message: the encoded message
+    :return:
+    """
+    save = event['save']
+    service.rooms.open(event['room']).publish(None if save else encode_frame(message), message if save else None,
+                                              event['key'])
+
+
+def relay_presence_change(event, data):
+    """
+    Applies a user joining or leaving a room, relayed by the hub, and passes it on to the room's members on this
+    worker.
+    :param event: the hub's 'presence' event
+    :param data: unused, presence events carry no data
+    :return:
+    """
+    room = service.rooms.open(event['room'])
+    username = event['username']
+    present = event['present']
+    # Users logged in on this worker are members of the room, only those on other workers are remote
+    if username not in room.members:
+        if present:
+            room.remote_members.add(username)
+        else:
+            room.remote_members.discard(username)
+    service.presence.changed(room, username, present)
+
+
+def relay_direct_message(event, message):
+    """
+    Delivers a private message sent from another worker.
+    :param event: the hub's 'direct' event
+    :param message: the encoded message
+    :return:
+    """
+    user = service.registry.get(event['username'])
+    if user is not None:
+        user.outbound.put(encode_frame(message))
+
+
+def relay_takeover(event, data):
+    """
+    Drops a stale connection on this worker whose user reconnected (possibly to another worker) with its resume token,
+    freeing the username.
+    :param event: the hub's 'takeover' event
+    :param data: unused, takeover events carry no data
+    :return:
+    """
+    user = service.registry.get(event['username'])
+    if valid_token(user, event['token']):
+        metrics.takeovers.inc()
+        logger.debug('Replacing the stale connection of %s.', user.username)
+        # Removed before the abort wakes the old connection's handle_client task, so its own remove_client finds the
+        # user gone and nobody is told they left
+        remove_client(user, announce=False)
+        abort_client(user.connection)
+
+
+async def serve(host=HOST, port=PORT, bus_address=None):
+    """
+    Accepts connections on a single event loop, running each user's login and message handling as a task.
+    :param host: the host IP to bind to
+    :param port: the port number to bind to
+    :param bus_address: address of the parent process' hub when running as one of several workers, else None
+    :return:
+    """
+    raise_file_limit()
+    # Delta flushes and the timer wheel's ticks are scheduled on the event loop
+    call_later(service.wheel.tick, run_wheel)
+    if bus_address is not None:
+        service.bus = BusClient({'room': relay_room_message, 'presence': relay_presence_change,
+                                 'direct': relay_direct_message, 'takeover': relay_takeover})
+        await service.bus.connect(bus_address)
+    tls_context = service.tls_context
+    # Workers all listen on the same port, the kernel spreads new connections over them
+    server = await asyncio.start_server(login, host, port, backlog=LISTEN_BACKLOG, reuse_address=True,
+                                        reuse_port=service.bus is not None, ssl=tls_context,
+                                        ssl_handshake_timeout=service.login_timeout
+                                        if tls_context and service.login_timeout > 0 else None)
+    logger.info('Server started and running.')
+    async with server:
+        if service.bus is None:
+            await server.serve_forever()
+        else:
+            # Workers stop once the parent process (and its hub) is gone
+            await service.bus.listen()
+            await drop_connections()
+
+
+async def drop_connections():
+    """
+    Drops every connection this worker serves once its hub is gone, and waits for their tasks to end by themselves
+    (their users are removed without anything being published, as the bus drops events once closed); tasks left for
+    asyncio.run() to cancel would each log a traceback.
+    :return:
+    """
+    for writer in connections.values():
+        abort_client(writer)
+    if connections:
+        await asyncio.wait(list(connections), timeout=DRAIN_TIMEOUT)
+
+
+async def supervise(options):
+    """
+    Starts the hub and the worker processes, running until any worker exits.
+    :param options: the parsed command line options
+    :return:
+    """
+    # The log is read back once here and handed to every worker
+    records = []
+    log = open_message_log(options)
+    if log is not None:
+        records = log.tail(options.log_recover)
+        log.close()
+    hub = BusHub()
+    address = await hub.start()
+    workers = [multiprocessing.Process(target=run_worker, args=(options, address, records, index), daemon=True)
+               for index in range(options.workers)]
+    for worker in workers:
+        worker.start()
+    logger.info('Started %d worker processes.', len(workers))
+    try:
+        await asyncio.to_thread(multiprocessing.connection.wait, [worker.sentinel for worker in workers])
+    finally:
+        # Workers stop once the hub closes their connections, which gives the one writing the message log the chance
+        # to flush it
+        hub.close()
+        for worker in workers:
+            await asyncio.to_thread(worker.join, WORKER_STOP_TIMEOUT)
+            worker.terminate()
+
+
+def run_worker(options, bus_address, records, worker):
+    """
+    Runs one of several worker processes sharing the server's port.
+    :param options: the parsed command line options
+    :param bus_address: address of the parent process' hub
+    :param records: (room name, message) pairs to restore the rooms' histories from
+    :param worker: the worker's number, counting from 0
+    :return:
+    """
+    configure_logging(options)
+    configure(options, call_later, close_client, abort_client, records, worker)
+    try:
+        asyncio.run(serve(options.host, options.port, bus_address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if service.log is not None:
+            service.log.close()
+
+
+def run(options):
+    """
+    Runs the asyncio server with the given options until interrupted, in this process or spread over several worker
+    processes.
+    :param options: the parsed command line options
+    :return:
+    """
+    try:
+        if options.workers > 1:
+            asyncio.run(supervise(options))
+        else:
+            configure(options, call_later, close_client, abort_client)
+            asyncio.run(serve(options.host, options.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if service.log is not None:
+            service.log.close()
@@ -0,0 +1,239 @@
+import asyncio
+import itertools
+import json
+import os
+import socket
+import tempfile
+
+from protocol import HEADER, FrameDecoder, encode_frame
+
+# Events the hub hands to the single worker that owns the named user instead of relaying to every worker
+ROUTED_EVENTS = ('direct', 'takeover')
+
+
+def encode_event(event, data=b''):
+    """
+    Frames a bus event for sending: the event as one line of JSON, followed by any raw data it carries.
+    :param event: dict with at least an 'op' key
+    :param data: bytes carried along with the event (e.g. an encoded message)
+    :return: the framed event
+    """
+    return encode_frame(json.dumps(event, separators=(',', ':')).encode('utf-8') + b'\n' + data)
+
+
+def decode_event(payload):
+    """
+    Decodes a received bus event.
+    :param payload: the frame's payload
+    :return: tuple of (event dict, raw data carried along with it)
+    """
+    header, _, data = payload.partition(b'\n')
+    return json.loads(header), data
+
+
+async def read_event(reader, decoder, chunk_size=65536):
+    """
+    Waits until a whole event has been received from the given stream.
+    :param reader: the stream reader to receive from
+    :param decoder: the FrameDecoder holding the stream's partially received data
+    :param chunk_size: the maximum number of bytes to read at once
+    :return: the event's raw payload, or None if the connection was closed
+    """
+    frame = decoder.next_frame()
+    while frame is None:
+        data = await reader.read(chunk_size)
+        if not data:
+            return None
+        decoder.feed(data)
+        frame = decoder.next_frame()
+    return frame
+
+
+class BusHub:
+    """
+    Local publish/subscribe hub the worker processes connect to, run by the parent process. Every relayed event goes
+    through this one hub, so all workers see room messages and presence changes in the same order and keep identical
+    room histories. The hub is also the authority on which worker owns each username, which keeps usernames unique
+    across workers and lets direct messages go straight to the worker holding the recipient.
+    """
+
+    def __init__(self):
+        # Stream writers of the connected workers
+        self.workers = set()
+        # Username -> stream writer of the worker the user is logged in on
+        self.owners = {}
+        self.server = None
+        # Directory holding the hub's Unix socket, if one is used
+        self.directory = None
+
+    async def start(self):
+        """
+        Starts listening for workers on a Unix socket (or a loopback TCP port where Unix sockets are unavailable).
+        :return: the address workers should connect to (a socket path or a (host, port) tuple)
+        """
+        if hasattr(socket, 'AF_UNIX'):
+            self.directory = tempfile.mkdtemp(prefix='chat-bus-')
+            address = os.path.join(self.directory, 'bus.sock')
+            self.server = await asyncio.start_unix_server(self.handle_worker, address)
+            return address
+        self.server = await asyncio.start_server(self.handle_worker, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[:2]
+
+    def close(self):
+        """
+        Stops listening, disconnects the workers and removes the hub's socket file.
+        :return:
+        """
+        if self.server is not None:
+            self.server.close()
+        for writer in self.workers:
+            writer.close()
+        if self.directory is not None:
+            try:
+                os.unlink(os.path.join(self.directory, 'bus.sock'))
+                os.rmdir(self.directory)
+            except OSError:
+                pass
+
+    async def handle_worker(self, reader, writer):
+        """
+        Serves one worker's connection until it closes.
+        :param reader: the worker's stream reader
+        :param writer: the worker's stream writer
+        :return:
+        """
+        decoder = FrameDecoder()
+        self.workers.add(writer)
+        try:
+            while True:
+                payload = await read_event(reader, decoder)
+                if payload is None:
+                    break
+                self.handle_event(writer, payload)
+        except ConnectionError:
+            pass
+        finally:
+            self.workers.discard(writer)
+            # The worker's users are gone with it, free their usernames
+            for username in [username for username, owner in self.owners.items() if owner is writer]:
+                del self.owners[username]
+            writer.close()
+
+    def handle_event(self, worker, payload):
+        """
+        Handles one event sent by a worker.
+        :param worker: stream writer of the worker that sent the event
+        :param payload: the event's raw payload
+        :return:
+        """
+        event, _ = decode_event(payload)
+        op = event['op']
+        if op == 'reserve':
+            username = event['username']
+            reserved = username not in self.owners
+            if reserved:
+                self.owners[username] = worker
+            worker.write(encode_event({'op': 'reserved', 'id': event['id'], 'ok': reserved}))
+        elif op == 'release':
+            if self.owners.get(event['username']) is worker:
+                del self.owners[event['username']]
+        elif op in ROUTED_EVENTS:
+            owner = self.owners.get(event['username'])
+            if owner is not None:
+                owner.write(HEADER.pack(len(payload)) + payload)
+        else:
+            # Relay the event as received to every worker, including the one that sent it
+            frame = HEADER.pack(len(payload)) + payload
+            for writer in self.workers:
+                writer.write(frame)
+
+
+class BusClient:
+    """
+    A worker's connection to the BusHub. Events relayed by the hub are passed, along with the data they carry, to
+    the handler registered for their 'op'.
+    """
+
+    def __init__(self, handlers):
+        # Op -> function called with the event and its data
+        self.handlers = handlers
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        # Request id -> future waiting for the hub's answer to a username reservation
+        self.pending = {}
+        self.ids = itertools.count()
+        # Whether the connection to the hub is gone
+        self.closed = False
+
+    async def connect(self, address):
+        """
+        Connects to the hub.
+        :param address: the hub's address (a socket path or a (host, port) tuple)
+        :return:
+        """
+        if isinstance(address, str):
+            self.reader, self.writer = await asyncio.open_unix_connection(address)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(*address)
+
+    def publish(self, event, data=b''):
+        """
+        Sends an event to the hub.
+        :param event: dict with at least an 'op' key
+        :param data: bytes carried along with the event
+        :return:
+        """
+        # Nobody is left to relay events to once the hub is gone
+        if self.closed:
+            return
+        self.writer.write(encode_event(event, data))
+
+    async def reserve(self, username):
+        """
+        Asks the hub to reserve a username across every worker.
+        :param username: the username to reserve
+        :return: True if the username was free and is now reserved, else False
+        """
+        # An answer could never arrive
+        if self.closed:
+            raise ConnectionResetError('bus connection closed')
+        request = next(self.ids)
+        future = self.pending[request] = asyncio.get_running_loop().create_future()
+        self.publish({'op': 'reserve', 'id': request, 'username': username})
+        return await future
+
+    def release(self, username):
+        """
+        Frees a username reserved by this worker.
+        :param username: the username to release
+        :return:
+        """
+        self.publish({'op': 'release', 'username': username})
+
+    async def listen(self):
+        """
+        Handles events from the hub until the connection closes.
+        :return:
+        """
+        try:
+            while True:
+                payload = await read_event(self.reader, self.decoder)
+                if payload is None:
+                    break
+                event, data = decode_event(payload)
+                if event['op'] == 'reserved':
+                    future = self.pending.pop(event['id'], None)
+                    if future is not None and not future.done():
+                        future.set_result(event['ok'])
+                else:
+                    self.handlers[event['op']](event, data)
+        except ConnectionError:
+            pass
+        finally:
+            self.closed = True
+            # Logins waiting on the hub can no longer be answered
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError('bus connection closed'))
+            self.pending.clear()
@@ -0,0 +1,431 @@
+import asyncio
+import itertools
+import ssl
+
+from compression import COMPRESSION, decompressor
+from history import FIRST_SEQUENCE
+from protocol import (OP_CHAT, OP_CONNECTED, OP_DIRECT, OP_FILE_ACCEPT, OP_FILE_CHUNK, OP_FILE_CREDIT, OP_FILE_END,
+                      OP_FILE_OFFER, OP_JOIN_ROOM, OP_LEAVE_ROOM, OP_LOGIN, OP_PING, OP_PONG, OP_PRESENCE,
+                      OP_REQUEST_HISTORY, OP_REQUEST_USERNAME, OP_ROOM, OP_SEARCH, OP_SET_COLOR, OP_USER_LIST,
+                      OP_VALID_USERNAME, FrameDecoder, decode_chunk, decode_envelope, encode_chunk_header,
+                      encode_envelope, encode_frame)
+from reconnect import Backoff, login_body, parse_login_body
+from search import search_body
+from transfers import IncomingFile, OutgoingFile, download_path, parse_numbers, parse_offer
+
+# Server IP
+HOST = '127.0.0.1'
+# Server port
+PORT = 9090
+
+
+class LoginError(Exception):
+    """
+    Raised when the server rejects a username or closes the connection during login.
+    """
+
+
+class ChatClient:
+    """
+    Headless, scriptable chat client speaking the same protocol as the Tkinter client, for use in scripts, tests and
+    load generation. Keeps track of the room it is in and the users in that room as messages are received.
+    """
+
+    def __init__(self, host=HOST, port=PORT, compress=True, tls=None, accept_files=False, downloads=None):
+        self.host = host
+        self.port = port
+        # ClientContext to connect over TLS with (None for plain TCP), and whether the connection resumed a session
+        self.tls = tls
+        self.tls_resumed = False
+        # Whether to ask the server to compress what it sends, and whether it agreed
+        self.compress = compress
+        self.compressed = False
+        self.reader = None
+        self.writer = None
+        # Decoder holding data received from the server but not yet handled (a new one for every connection)
+        self.decoder = None
+        # Username, once logged in
+        self.username = None
+        # Room the client is in and the users in it
+        self.room = None
+        self.users = set()
+        # Token to reclaim the username with after losing the connection, the sequence number of the last message
+        # received in the room (to resume after), and whether the last login resumed instead of starting afresh
+        self.token = None
+        self.last_sequence = FIRST_SEQUENCE - 1
+        self.resumed = False
+        # Delays between attempts to reconnect
+        self.backoff = Backoff()
+        # Whether files offered to the client are taken, and the directory they are saved in (None to only count
+        # what is received)
+        self.accept_files = accept_files
+        self.downloads = downloads
+        # Transfer id -> OutgoingFile being sent, and the event set whenever it is given credit (or ends)
+        self.outgoing = {}
+        self.credited = {}
+        # (sender, transfer id) -> IncomingFile being received
+        self.incoming = {}
+        self.transfer_ids = itertools.count(1)
+        # Tasks streaming outgoing files (the event loop only keeps weak references to tasks)
+        self.streams = set()
+        # Held while writing, so a file chunk being sent is never interleaved with another message, and whether a
+        # chunk's data is being sent; messages written from trackers meanwhile wait in the deferred list (a transport
+        # cannot be written to during a sendfile)
+        self.write_lock = asyncio.Lock()
+        self.sending_file = False
+        self.deferred = []
+        # Opcode -> method updating the client's state from (or answering) a received envelope
+        self.trackers = {OP_ROOM: self.track_room, OP_USER_LIST: self.track_user_list, OP_PRESENCE: self.track_presence,
+                         OP_PING: self.answer_ping, OP_FILE_OFFER: self.track_file_offer,
+                         OP_FILE_CREDIT: self.track_file_credit, OP_FILE_CHUNK: self.track_file_chunk,
+                         OP_FILE_END: self.track_file_end}
+
+    async def connect(self):
+        """
+        Opens the connection to the server.
+        :return:
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.tls)
+        self.decoder = FrameDecoder(decompressor=decompressor())
+        # Messages deferred on the lost connection are not worth sending on the new one
+        self.deferred.clear()
+        if self.tls is not None:
+            self.tls_resumed = self.writer.get_extra_info('ssl_object').session_reused
+
+    async def login(self, username):
+        """
+        Logs in with the given username, returning once the server has confirmed the connection (after the room's
+        history has been received). Logging in again as the same user after losing the connection resumes: the client
+        is put back in its room and only sent the messages it missed, if the server still has them.
+        :param username: the username to log in with
+        :return: list of Envelopes received during login (history, presence and the connection notice)
+        """
+        envelope = await self.receive()
+        if envelope is None or envelope.op != OP_REQUEST_USERNAME:
+            raise LoginError(f'unexpected message before login: {envelope!r}')
+        features = [COMPRESSION] if self.compress else []
+        if username == self.username and self.token is not None:
+            body = login_body(features, token=self.token, room=self.room, after=self.last_sequence)
+        else:
+            body = login_body(features)
+        await self.send_raw(OP_LOGIN, sender=username, body=body)
+        envelope = await self.receive()
+        if envelope is None or envelope.op != OP_VALID_USERNAME:
+            raise LoginError(f'username {username!r} rejected: {envelope!r}')
+        self.username = username
+        features, options = parse_login_body(envelope.body)
+        self.compressed = COMPRESSION in features
+        self.token = options.get('token')
+        # The room's name only comes with a full greeting, a resumed one carries on from the messages already received
+        self.resumed = True
+        # The server's session tickets have arrived by now, keep one for the next connection to resume
+        if self.tls is not None:
+            self.tls.remember(self.writer.get_extra_info('ssl_object'))
+        received = []
+        while True:
+            envelope = await self.receive()
+            if envelope is None:
+                raise LoginError('connection closed during login')
+            received.append(envelope)
+            if envelope.op == OP_ROOM:
+                self.resumed = False
+            elif envelope.op == OP_CONNECTED:
+                return received
+
+    async def reconnect(self, attempts=None):
+        """
+        Connects and logs in again as the same user after losing the connection, waiting a jittered, growing delay
+        before each attempt. While the server still holds the old connection the username is taken, so that counts as
+        a failed attempt too.
+        :param attempts: the most attempts to make (None to keep trying)
+        :return: list of Envelopes received during login
+        """
+        failures = 0
+        while True:
+            await self.close()
+            await asyncio.sleep(self.backoff.next_delay())
+            try:
+                await self.connect()
+                received = await self.login(self.username)
+            except (OSError, LoginError):
+                failures += 1
+                if attempts is not None and failures >= attempts:
+                    raise
+                continue
+            self.backoff.reset()
+            self.resume_transfers()
+            return received
+
+    def resume_transfers(self):
+        """
+        Picks the client's transfers back up after reconnecting: outgoing files are offered again (and wait to be told
+        where to carry on from), incoming ones are taken again from what was already received.
+        :return:
+        """
+        for transfer in self.outgoing.values():
+            transfer.suspend()
+            self.write_frame(encode_frame(encode_envelope(OP_FILE_OFFER, target=transfer.target,
+                                                          body=transfer.offer_body())))
+        for incoming in self.incoming.values():
+            self.write_frame(encode_frame(encode_envelope(OP_FILE_ACCEPT, target=incoming.sender,
+                                                          body=incoming.accept_body())))
+
+    async def receive(self):
+        """
+        Waits for the next message from the server, updating the client's room and user list as it goes.
+        :return: the Envelope, or None once the connection is closed
+        """
+        frame = self.decoder.next_frame()
+        while frame is None:
+            data = await self.reader.read(65536)
+            if not data:
+                return None
+            self.decoder.feed(data)
+            frame = self.decoder.next_frame()
+        envelope = decode_envelope(frame)
+        # Messages recorded in the room's history are numbered, the newest one received is where to resume after
+        if envelope.sequence > self.last_sequence:
+            self.last_sequence = envelope.sequence
+        tracker = self.trackers.get(envelope.op)
+        if tracker is not None:
+            tracker(envelope)
+        return envelope
+
+    def track_room(self, envelope):
+        """
+        Records the room the client was placed in (the messages received from now on are the new room's).
+        :param envelope: the received ROOM envelope
+        :return:
+        """
+        self.room = envelope.body
+        self.last_sequence = FIRST_SEQUENCE - 1
+
+    def track_user_list(self, envelope):
+        """
+        Replaces the client's user list with the room's full list.
+        :param envelope: the received USER_LIST envelope
+        :return:
+        """
+        self.users = set(envelope.body.split())
+
+    def track_presence(self, envelope):
+        """
+        Applies the users who joined ('+name') and left ('-name') the room to the client's user list.
+        :param envelope: the received PRESENCE envelope
+        :return:
+        """
+        for change in envelope.body.split():
+            if change[0] == '+':
+                self.users.add(change[1:])
+            else:
+                self.users.discard(change[1:])
+
+    def answer_ping(self, envelope):
+        """
+        Answers the server's heartbeat, so a client only receiving is not taken for dead.
+        :param envelope: the received PING envelope
+        :return:
+        """
+        self.write_frame(encode_frame(encode_envelope(OP_PONG)))
+
+    def track_file_offer(self, envelope):
+        """
+        Takes a file offered to the client (or its room), if the client takes files.
+        :param envelope: the received FILE_OFFER envelope
+        :return:
+        """
+        offer = parse_offer(envelope.body)
+        if not self.accept_files or offer is None or envelope.sender == self.username:
+            return
+        transfer_id, size, name = offer
+        path = download_path(self.downloads, name) if self.downloads is not None else None
+        incoming = self.incoming[(envelope.sender, transfer_id)] = IncomingFile(envelope.sender, transfer_id, size,
+                                                                                name, path)
+        self.write_frame(encode_frame(encode_envelope(OP_FILE_ACCEPT, target=envelope.sender,
+                                                      body=incoming.accept_body())))
+
+    def track_file_credit(self, envelope):
+        """
+        Lets an outgoing file be sent further.
+        :param envelope: the received FILE_CREDIT envelope
+        :return:
+        """
+        numbers = parse_numbers(envelope.body)
+        transfer = self.outgoing.get(numbers[0]) if numbers else None
+        if transfer is not None:
+            transfer.credit(envelope)
+            self.credited[transfer.id].set()
+
+    def track_file_chunk(self, envelope):
+        """
+        Writes part of an incoming file.
+        :param envelope: the received FILE_CHUNK envelope
+        :return:
+        """
+        transfer_id, offset, data = decode_chunk(envelope)
+        incoming = self.incoming.get((envelope.sender, transfer_id))
+        if incoming is not None:
+            incoming.write(offset, data)
+
+    def track_file_end(self, envelope):
+        """
+        Finishes a transfer the client was sending or receiving.
+        :param envelope: the received FILE_END envelope
+        :return:
+        """
+        numbers = parse_numbers(envelope.body.split(' ', 1)[0])
+        if not numbers:
+            return
+        reason = envelope.body.partition(' ')[2]
+        if envelope.target == self.username and numbers[0] in self.outgoing:
+            transfer = self.outgoing.pop(numbers[0])
+            transfer.ended = reason
+            self.credited.pop(transfer.id).set()
+        incoming = self.incoming.pop((envelope.target, numbers[0]), None)
+        if incoming is not None:
+            incoming.ended = reason
+            incoming.close()
+
+    def write_frame(self, frame):
+        """
+        Writes a framed message without waiting for it to be sent (after the file chunk being sent, if there is one).
+        :param frame: the framed message
+        :return:
+        """
+        if self.sending_file:
+            self.deferred.append(frame)
+        else:
+            self.writer.write(frame)
+
+    async def send_raw(self, op, **fields):
+        """
+        Sends a protocol message.
+        :param op: the message's opcode
+        :param fields: the envelope's other fields (sender, target, color, body)
+        :return:
+        """
+        async with self.write_lock:
+            self.writer.write(encode_frame(encode_envelope(op, **fields)))
+            await self.writer.drain()
+
+    async def send(self, message):
+        """
+        Sends a chat message to the client's room.
+        :param message: the message to send
+        :return:
+        """
+        await self.send_raw(OP_CHAT, body=message)
+
+    async def send_direct(self, username, message):
+        """
+        Sends a private message to another user.
+        :param username: the user to send the message to
+        :param message: the message to send
+        :return:
+        """
+        await self.send_raw(OP_DIRECT, target=username, body=message)
+
+    async def set_color(self, color):
+        """
+        Changes the color of the client's messages.
+        :param color: the color name
+        :return:
+        """
+        await self.send_raw(OP_SET_COLOR, color=color.lower())
+
+    async def join_room(self, room):
+        """
+        Moves the client into a room.
+        :param room: name of the room to join
+        :return:
+        """
+        await self.send_raw(OP_JOIN_ROOM, body=room)
+
+    async def leave_room(self):
+        """
+        Moves the client back to the default room.
+        :return:
+        """
+        await self.send_raw(OP_LEAVE_ROOM)
+
+    async def request_history(self, sequence):
+        """
+        Asks for the page of history sent before the given sequence number.
+        :param sequence: sequence number to page back from
+        :return:
+        """
+        await self.send_raw(OP_REQUEST_HISTORY, body=str(sequence))
+
+    async def search(self, text='', sender=None, since=None, until=None, before=None):
+        """
+        Searches the client's room for chat messages; the server answers with a page of results, newest first.
+        :param text: the words the messages must all hold
+        :param sender: username the messages must be from (None for anyone)
+        :param since: milliseconds since the epoch the messages must be sent at or after (None for no limit)
+        :param until: milliseconds since the epoch the messages must be sent before (None for no limit)
+        :param before: sequence number from the previous page's SEARCH_RESULTS envelope, for the next page
+        :return:
+        """
+        await self.send_raw(OP_SEARCH, body=search_body(text, sender, since, until, before))
+
+    async def send_file(self, path, target=''):
+        """
+        Offers a file to another user, or to the client's room, sending it as the server gives credit for it.
+        :param path: path of the file
+        :param target: username of the user to send the file to ('' for everyone in the room)
+        :return: the OutgoingFile (its ended attribute is set once the transfer is over)
+        """
+        transfer = OutgoingFile(next(self.transfer_ids), path, target)
+        self.outgoing[transfer.id] = transfer
+        self.credited[transfer.id] = asyncio.Event()
+        await self.send_raw(OP_FILE_OFFER, target=target, body=transfer.offer_body())
+        task = asyncio.create_task(self.stream_file(transfer, self.credited[transfer.id]))
+        self.streams.add(task)
+        task.add_done_callback(self.streams.discard)
+        return transfer
+
+    async def stream_file(self, transfer, credited):
+        """
+        Sends an outgoing file's chunks as credit for them arrives, until the transfer ends. The chunks' data goes
+        from the file to the socket with sendfile() (read and written through the TLS layer over TLS).
+        :param transfer: the OutgoingFile
+        :param credited: the event set whenever it is given credit
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while transfer.ended is None:
+                await credited.wait()
+                credited.clear()
+                while transfer.ended is None and (chunk := transfer.next_chunk()) is not None:
+                    offset, length = chunk
+                    try:
+                        async with self.write_lock:
+                            self.writer.write(encode_chunk_header(self.username, transfer.target, transfer.id,
+                                                                  offset, length))
+                            self.sending_file = True
+                            try:
+                                await loop.sendfile(self.writer.transport, transfer.file, offset, length)
+                            finally:
+                                self.sending_file = False
+                            self.writer.writelines(self.deferred)
+                            self.deferred.clear()
+                    # Connection lost: reconnecting offers the file again and waits to be told where to carry on
+                    except (ConnectionError, RuntimeError):
+                        transfer.suspend()
+                        break
+        finally:
+            transfer.close()
+
+    async def close(self):
+        """
+        Closes the connection.
+        :return:
+        """
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            # The server may still be sending when a TLS connection is closed
+            except (ConnectionError, ssl.SSLError):
+                pass
@@ -1,9 +1,28 @@
+import argparse
+import datetime
+import itertools
+import logging
+import os
+import queue
 import socket
 import threading
 import time
 import tkinter
 import tkinter.scrolledtext
-from tkinter import simpledialog
+from tkinter import filedialog, messagebox, simpledialog
+
+from compression import COMPRESSION, decompressor
+from history import FIRST_SEQUENCE
+from protocol import (OP_CHAT, OP_CONNECTED, OP_DIRECT, OP_FILE_ACCEPT, OP_FILE_CHUNK, OP_FILE_CREDIT, OP_FILE_END,
+                      OP_FILE_OFFER, OP_HISTORY_END, OP_HISTORY_PAGE, OP_INVALID_USERNAME, OP_JOIN_ROOM, OP_JOINED,
+                      OP_LEAVE_ROOM, OP_LEFT, OP_LOGIN, OP_PING, OP_PONG, OP_PRESENCE, OP_REQUEST_HISTORY,
+                      OP_REQUEST_USERNAME, OP_ROOM, OP_SEARCH, OP_SEARCH_END, OP_SEARCH_RESULTS, OP_SET_COLOR,
+                      OP_USER_LIST, OP_VALID_USERNAME, FrameDecoder, FrameError, decode_chunk, encode_chunk_header,
+                      encode_envelope, encode_frame, receive_message)
+from reconnect import RESUME_ATTEMPTS, Backoff, login_body, parse_login_body
+from search import search_body
+from tls import SharedTLSSocket, client_context
+from transfers import END_DONE, END_REFUSED, IncomingFile, OutgoingFile, download_path, parse_numbers, parse_offer
 
 # Server IP
 HOST = '127.0.0.1'
@@ -11,24 +30,107 @@ HOST = '127.0.0.1'
 PORT = 9090
 # Text color options
 COLORS = ['Black', 'Blue', 'Yellow', 'Purple', 'Orange', 'Brown', 'Cyan']
+# Milliseconds between chat window updates, each applying the messages received since the last one
+FRAME_INTERVAL = 50
+# Most messages handled in one update, so a flood of messages cannot stall the window
+FRAME_BATCH = 500
+# Lines kept in the chat log, the oldest being dropped beyond that
+CHAT_LOG_LINES = 2000
+# Directory received files are saved in
+DOWNLOADS = '.'
+
+logger = logging.getLogger('chat.client')
 
 
 class User:
 
-    def __init__(self, host, port):
-        # Client's connection socket
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Connect to server
-        self.socket.connect((host, port))
+    def __init__(self, host, port, tls=None, downloads=DOWNLOADS):
+        # Server to connect (and reconnect) to, and the TLS context to connect with (None for plain TCP)
+        self.host = host
+        self.port = port
+        self.tls = tls
+        # Client's connection socket, and the decoder holding data received on it but not yet handled
+        self.socket = None
+        self.decoder = None
+        # Held while writing to the socket, so the chunks of a file being sent are never interleaved with messages
+        self.send_lock = threading.Lock()
+        self.connect()
 
         # Username
         self.username = None
         # Check to determine if username is valid (not taken by another)
 
         # Connected users
-        self.connected_users = []
+        self.connected_users = set()
         # User to privately chat with
         self.selected_user = None
+        # Sequence number of the oldest history message received (None until the first history page arrives)
+        self.oldest_sequence = None
+        # Room the user is in, and the sequence number of the newest message received there (to resume after)
+        self.room = None
+        self.last_sequence = FIRST_SEQUENCE - 1
+        # Token to reclaim the username with after losing the connection (None until logged in)
+        self.token = None
+        # Delays between attempts to reconnect, and the attempts in a row that found the username still taken
+        self.backoff = Backoff()
+        self.resume_failures = 0
+        # Whether the messages being received belong to a page of history (inserted above the current chat log)
+        self.loading_history = False
+        # Number of messages received in the current page of history
+        self.history_page_count = 0
+        # Search being paged through, the sequence number to search before for its next page (None once there are no
+        # more results), and whether the messages being received are search results (shown in the search window)
+        self.search_text = None
+        self.search_cursor = None
+        self.loading_search = False
+        # Number of results received for the current search
+        self.search_count = 0
+        # Window listing search results (None until the first search)
+        self.search_window = None
+        # Directory received files are saved in
+        self.downloads = downloads
+        # Transfer id -> OutgoingFile being sent, and the event set whenever it is given credit (or ends)
+        self.outgoing_files = {}
+        self.credited = {}
+        # (sender, transfer id) -> IncomingFile being received (written to on the network thread)
+        self.incoming_files = {}
+        self.transfer_ids = itertools.count(1)
+        # Messages received by the network thread, waiting to be handled on the Tk thread
+        self.incoming = queue.SimpleQueue()
+        # Text and tags waiting to be inserted into the chat log in one go, and where they go ('end' or 'history')
+        self.batch = []
+        self.batch_index = 'end'
+        # Tags already configured in the chat log for message colors
+        self.color_tags = set()
+        # Opcode -> method handling that message from the server
+        self.handlers = {
+            OP_REQUEST_USERNAME: self.on_request_username,
+            OP_VALID_USERNAME: self.on_valid_username,
+            OP_INVALID_USERNAME: self.on_invalid_username,
+            OP_ROOM: self.on_room,
+            OP_HISTORY_PAGE: self.on_history_page,
+            OP_HISTORY_END: self.on_history_end,
+            OP_CONNECTED: self.on_connected,
+            OP_USER_LIST: self.on_user_list,
+            OP_PRESENCE: self.on_presence,
+            OP_JOINED: lambda envelope: self.display_message(envelope.body, 'green'),
+            OP_LEFT: lambda envelope: self.display_message(envelope.body, 'red'),
+            OP_CHAT: lambda envelope: self.display_message(envelope.body, envelope.color),
+            OP_DIRECT: lambda envelope: self.display_message(envelope.body, envelope.color),
+            OP_SEARCH_RESULTS: self.on_search_results,
+            OP_SEARCH_END: self.on_search_end,
+            OP_FILE_OFFER: self.on_file_offer,
+            OP_FILE_END: self.on_file_end,
+        }
+        # Opcode -> method handling that message on the network thread, as soon as it is received (heartbeats, file
+        # data and credit never reach the Tk thread, so they are answered even while a dialog holds it up)
+        self.network_handlers = {
+            OP_PING: lambda envelope: self.send(OP_PONG),
+            OP_FILE_CHUNK: self.receive_chunk,
+            OP_FILE_CREDIT: self.receive_credit,
+            OP_FILE_END: self.end_transfer,
+            OP_VALID_USERNAME: self.store_token,
+        }
 
         # Establish chat window
         self.chat_window = tkinter.Tk()
@@ -50,6 +152,8 @@ class User:
         # Tags for special colored messages
         self.chat_log.tag_config('new_user', foreground='green')
         self.chat_log.tag_config('user_disconnect', foreground='red')
+        for color in [color.lower() for color in COLORS] + ['green', 'red']:
+            self.add_color_tag(color)
 
         # Create list of connected users
         self.users_list = tkinter.scrolledtext.ScrolledText(self.frame, width=15, height=20)
@@ -63,46 +167,109 @@ class User:
         self.color = tkinter.StringVar()
         self.color.set('Black')
 
+        # Title of the chat log, naming the room the user is in
+        self.room_title = tkinter.StringVar()
+        self.room_title.set('Chat')
+
         # Ask user to input a username and sets that input to this variable
         self.ask_for_username()
 
         # Flag to only run receive() loop if user should be receiving (user is connected to chat)
         self.receiving = True
 
-        # Open client to receiving messages
-        self.handle_incoming_messages()
+        # Thread receiving messages from the server for as long as the user is connected
+        receive_thread = threading.Thread(target=self.handle_incoming_messages, daemon=True)
+        receive_thread.start()
+
+        # Handle received messages on the Tk thread, one batch per frame
+        self.chat_window.after(FRAME_INTERVAL, self.render_incoming)
+        self.chat_window.mainloop()
+
+    def connect(self):
+        """
+        Opens a connection to the server.
+        :return:
+        """
+        sock = socket.create_connection((self.host, self.port))
+        # Messages are batched before being written, so Nagle's algorithm would only delay them further
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Encrypt the connection if asked to; the network thread reads from it while the Tk thread writes to it
+        if self.tls is not None:
+            sock = SharedTLSSocket(self.tls.wrap_socket(sock, server_hostname=self.host))
+        self.decoder = FrameDecoder(decompressor=decompressor())
+        self.socket = sock
+
+    def reconnect(self):
+        """
+        Keeps trying to connect to the server again, waiting a jittered, growing delay before each attempt (runs on
+        the network thread; logging back in happens on the Tk thread once the server asks for the username).
+        :return: True once connected, False if the user exited meanwhile
+        """
+        self.socket.close()
+        while self.receiving:
+            time.sleep(self.backoff.next_delay())
+            try:
+                self.connect()
+                return True
+            except OSError:
+                continue
+        return False
 
     def select_user(self, event):
-        print('Selecting user')
+        logger.debug('Selecting user')
         # get the index of the mouse click
         index = self.users_list.index("@%s,%s" % (event.x, event.y))
 
-        # Check each username to see if user selected it
-        for username in self.connected_users:
-            tag_indices = list(self.users_list.tag_ranges(username))
-
-            # Iterate through
-            for start, end in zip(tag_indices[0::2], tag_indices[1::2]):
-                # Check if username found in mouse click
-                if self.users_list.compare(start, '<=', index) and self.users_list.compare(index, '<', end):
-                    # Gets user's selection
-                    selection = self.users_list.get(start, end)
-                    user = ''
-                    # Remove newline characters from selection
-                    for char in selection:
-                        if char == "\n":
-                            break
-                        user += char
-                    # Select user if user not selected, else deselect
-                    self.selected_user = user if self.selected_user != user else None
-                    # If user selecting, change background to indicate selection
-                    if self.selected_user is not None:
-                        self.users_list.tag_config(user, background='lightgray')
-                        self.input_label.config(text=f'Message (To {user})')
-                    # Deselecting, revert components
-                    else:
-                        self.users_list.tag_config(user, background='white')
-                        self.input_label.config(text='Message')
+        # Each username is tagged with itself, so the clicked user is one of the tags at the click
+        for user in self.users_list.tag_names(index):
+            if user in self.connected_users:
+                # Select user if user not selected, else deselect
+                self.selected_user = user if self.selected_user != user else None
+                # If user selecting, change background to indicate selection
+                if self.selected_user is not None:
+                    self.users_list.tag_config(user, background='lightgray')
+                    self.input_label.config(text=f'Message (To {user})')
+                # Deselecting, revert components
+                else:
+                    self.users_list.tag_config(user, background='white')
+                    self.input_label.config(text='Message')
+                break
+
+    def add_user(self, username):
+        """
+        Adds a user to the list of connected users (users list must be in 'normal' state).
+        :param username: the user to add
+        :return:
+        """
+        if username in self.connected_users:
+            return
+        self.connected_users.add(username)
+        # Add user to list
+        if username == self.username:
+            username += ' (You)'
+        # Create unique tag to allow for selection and private messaging with user
+        self.users_list.tag_config(username)
+        self.users_list.tag_bind(username, '<Button-1>', self.select_user)
+        self.users_list.insert('end', username + '\n\n', username)
+
+    def remove_user(self, username):
+        """
+        Removes a user from the list of connected users (users list must be in 'normal' state).
+        :param username: the user to remove
+        :return:
+        """
+        if username not in self.connected_users:
+            return
+        self.connected_users.discard(username)
+        # Deselect the user if they were being messaged privately
+        if self.selected_user == username:
+            self.selected_user = None
+            self.input_label.config(text='Message')
+        if username == self.username:
+            username += ' (You)'
+        # The user's tag covers exactly their entry in the list
+        self.users_list.delete(f'{username}.first', f'{username}.last')
+        self.users_list.tag_delete(username)
 
     def ask_for_username(self, message=None):
         """
@@ -114,26 +281,28 @@ class User:
             message = 'Please enter a username.'
         self.username = simpledialog.askstring('Username', f'Welcome to Chat App!\n{message}',
                                                parent=self.chat_window)
+        # User presses 'Cancel' (or closes the dialog), quit
+        if self.username is None:
+            self.exit()
         # User presses 'OK' without entering anything, ask again
         if self.username == '':
             self.ask_for_username()
         # Retry with new username
         if message == 'Invalid username, try again.':
-            self.socket.send(self.username.encode('utf-8'))
+            self.send(OP_LOGIN, sender=self.username, body=COMPRESSION)
 
-    def access_chat(self):
+    def send(self, op, **fields):
         """
-        Begins the process of receiving chat messages and displays the chat window.
+        Sends a message to the server (messages sent while the connection is down are lost).
+        :param op: the message's opcode
+        :param fields: the envelope's other fields (sender, target, color, body)
         :return:
         """
-        # Thread to handle receiving broadcasts from the server
-        receive_thread = threading.Thread(target=self.handle_incoming_messages)
-
-        # Begin thread to receive messages
-        receive_thread.start()
-
-        # Display chat window
-        self.display_chat()
+        try:
+            with self.send_lock:
+                self.socket.sendall(encode_frame(encode_envelope(op, **fields)))
+        except OSError:
+            pass
 
     def display_chat(self):
         """
@@ -144,7 +313,7 @@ class User:
         self.chat_window.deiconify()
 
         # Chat label
-        chat_label = tkinter.Label(self.frame, text='Chat')
+        chat_label = tkinter.Label(self.frame, textvariable=self.room_title)
         chat_label.config(font=('Arial', 14))
 
         # Users label
@@ -161,11 +330,37 @@ class User:
 
         # Function for updating user text color
         def send_color(color):
-            self.socket.send(f'{self.username}_COLOR={color.lower()}'.encode('utf-8'))
+            self.send(OP_SET_COLOR, color=color.lower())
 
         # Create text color selector
         color_selector = tkinter.OptionMenu(self.frame, self.color, command=send_color, *COLORS)
 
+        # 'Load Earlier Messages' button
+        self.history_button = tkinter.Button(self.frame, text='Load Earlier Messages', command=self.request_history)
+        self.history_button.config(font=('Arial', 11))
+
+        # Room name entry with 'Join Room' and 'Leave Room' buttons
+        room_frame = tkinter.Frame(self.frame)
+        room_entry = tkinter.Entry(room_frame, width=20)
+        join_button = tkinter.Button(room_frame, text='Join Room',
+                                     command=lambda: self.join_room(room_entry.get().strip()))
+        leave_button = tkinter.Button(room_frame, text='Leave Room', command=self.leave_room)
+        room_entry.grid(row=0, column=0, padx=5)
+        join_button.grid(row=0, column=1, padx=5)
+        leave_button.grid(row=0, column=2, padx=5)
+
+        # Search entry with 'Search' button
+        search_frame = tkinter.Frame(self.frame)
+        search_entry = tkinter.Entry(search_frame, width=40)
+        search_button = tkinter.Button(search_frame, text='Search',
+                                       command=lambda: self.search(search_entry.get().strip()))
+        search_entry.grid(row=0, column=0, padx=5)
+        search_button.grid(row=0, column=1, padx=5)
+
+        # 'Send File' button
+        file_button = tkinter.Button(self.frame, text='Send File', command=self.send_file)
+        file_button.config(font=('Arial', 11), width=10)
+
         # Set grids
         chat_label.grid(row=0, column=0)
         users_label.grid(row=0, column=1, padx=(0, 20))
@@ -175,93 +370,518 @@ class User:
         self.input_area.grid(row=3, column=0, padx=10, pady=10)
         send_button.grid(row=3, column=1)
         color_label.grid(row=4, column=1, pady=(0, 10))
+        self.history_button.grid(row=4, column=0, pady=(0, 10))
         color_selector.grid(row=5, column=1, pady=(0, 10))
-
-        # Begin loop
-        self.chat_window.mainloop()
+        room_frame.grid(row=5, column=0, pady=(0, 10))
+        search_frame.grid(row=6, column=0, pady=(0, 10))
+        file_button.grid(row=6, column=1, pady=(0, 10))
 
     def handle_incoming_messages(self):
         """
-        While the user is connected, looks for messages to handle from the server.
+        While the user is connected, receives messages from the server and queues them for the Tk thread (runs on
+        the network thread, which never touches the widgets).
         :return:
         """
         # If user is connected, loop to check for messages to receive
         while self.receiving:
             # Check socket for incoming messages from server
             try:
-                # Message received from server
-                message = self.socket.recv(1024).decode('utf-8')
-                print(f'CLIENT RECEIVING {message}')
-                # If server is asking for user's username:
-                if message == 'REQUEST_USERNAME':
-                    self.socket.send(self.username.encode('utf-8'))
-                # Username declared valid
-                elif message == 'VALID_USERNAME':
-                    self.access_chat()
-                # Username declared invalid
-                elif message == 'INVALID_USERNAME':
-                    self.ask_for_username('Invalid username, try again.')
-                # Message notifying user that they have connected to the chat successfully
-                elif message == f'Connected to chat as {self.username}\n':
-                    self.chat_log.config(state='normal')
-                    self.chat_log.insert('end', message)
-                # Server sending data regarding all connecting users
-                elif 'CONNECTED_USERS: ' in message:
-                    users = message[17:]
-                    username = ''
-                    self.users_list.config(state='normal')
-                    # Empty current list
-                    self.users_list.delete('0.0', 'end')
-                    # Empty current list of connected users
-                    self.connected_users = []
-                    for char in users:
-                        if char == ' ':
-                            self.connected_users.append(username)
-                            # Add user to list
-                            if username == self.username:
-                                username += ' (You)'
-                            # Create unique tag to allow for selection and private messaging with user
-                            self.users_list.tag_config(username)
-                            self.users_list.tag_bind(username, '<Button-1>', self.select_user)
-                            print(username)
-                            self.users_list.insert('end', username + '\n\n', username)
-                            username = ''
-                        else:
-                            username = username + char
-                    self.users_list.config(state='disabled')
-                # Else, receiving a message that needs to be colored (user joins, user leaves, user's sent message)
-                else:
-                    # Set state to normal to allow for chat log to be updated
-                    self.chat_log.config(state='normal')
-                    # Insert message with appropriate color
-                    if 'has joined the chat.\n' in message:
-                        color = 'green'
-                    elif 'has left the chat.\n' in message:
-                        color = 'red'
-                    # Normal message w/ user's color attached
-                    else:
-                        color = ''
-                        substring = 0
-                        for char in message:
-                            substring += 1
-                            if char == '_':
-                                break
-                            else:
-                                color = color + char
-                        # Actual message
-                        message = message[substring:]
-                    # Insert message with coloring matching user's selection for themselves
-                    self.chat_log.tag_config(color, foreground=color)
-                    self.chat_log.insert('end', message, color)
-                # Scroll to the end
-                self.chat_log.yview('end')
-                # Disable text box to prevent user entry
-                self.chat_log.config(state='disabled')
-            # Error occurring, break
-            except InterruptedError:
-                break
-            except ConnectionAbortedError:
+                # Message received from server (None once the server closes the connection)
+                envelope = receive_message(self.socket, self.decoder)
+                if envelope is None:
+                    raise ConnectionResetError
+                handler = self.network_handlers.get(envelope.op)
+                if handler is not None:
+                    handler(envelope)
+                if envelope.op not in (OP_PING, OP_FILE_CHUNK, OP_FILE_CREDIT):
+                    self.incoming.put(envelope)
+            # Connection lost (or the socket closed on exit), or the server sent a frame that could not be decoded
+            except (OSError, FrameError):
+                if not self.receiving:
+                    break
+                # None tells the Tk thread the connection was lost
+                self.incoming.put(None)
+                # Only a logged in user is reconnected (with the token they were given to resume with)
+                if self.token is None or not self.reconnect():
+                    break
+
+    def render_incoming(self):
+        """
+        Handles the messages received since the last frame and shows them in one update of the chat log, then
+        schedules the next frame.
+        :return:
+        """
+        for _ in range(FRAME_BATCH):
+            try:
+                envelope = self.incoming.get_nowait()
+            except queue.Empty:
                 break
+            logger.debug('Received %r', envelope)
+            if envelope is None:
+                # Lost before logging in, there is no session to reconnect to
+                if self.token is None:
+                    messagebox.showerror('Connection Lost', 'The connection to the server was lost.',
+                                         parent=self.chat_window)
+                    self.exit()
+                self.display_message('Connection lost, reconnecting...\n', 'red')
+                continue
+            # Messages recorded in the room's history are numbered, the newest one received is where to resume after
+            if envelope.sequence > self.last_sequence:
+                self.last_sequence = envelope.sequence
+            # Messages with an opcode the client does not know are ignored
+            handler = self.handlers.get(envelope.op)
+            if handler is not None:
+                handler(envelope)
+        self.flush_messages()
+        self.chat_window.after(FRAME_INTERVAL, self.render_incoming)
+
+    def flush_messages(self):
+        """
+        Inserts the batched messages into the chat log with a single insert, then drops the oldest lines beyond
+        CHAT_LOG_LINES.
+        :return:
+        """
+        if not self.batch:
+            return
+        self.chat_log.config(state='normal')
+        self.chat_log.insert(self.batch_index, *self.batch)
+        self.batch = []
+        # Older messages being added at the top are kept, however long the log gets
+        if self.batch_index == 'end':
+            lines = int(self.chat_log.index('end-1c').split('.')[0])
+            if lines > CHAT_LOG_LINES:
+                self.chat_log.delete('1.0', f'{lines - CHAT_LOG_LINES + 1}.0')
+                # Earlier messages loaded now would not follow on from the oldest one shown
+                self.oldest_sequence = None
+                if hasattr(self, 'history_button'):
+                    self.history_button.config(state='disabled')
+            # Scroll to the end
+            self.chat_log.yview('end')
+        # Disable text box to prevent user entry
+        self.chat_log.config(state='disabled')
+
+    def on_request_username(self, envelope):
+        """
+        Sends the server the username the user picked, or when reconnecting the same username and where to resume
+        from.
+        :param envelope: the REQUEST_USERNAME envelope
+        :return:
+        """
+        if self.token is not None:
+            body = login_body([COMPRESSION], token=self.token, room=self.room, after=self.last_sequence)
+        else:
+            body = login_body([COMPRESSION])
+        self.send(OP_LOGIN, sender=self.username, body=body)
+
+    def store_token(self, envelope):
+        """
+        Keeps the token the server gave to reclaim the username with (runs on the network thread, which reconnects with
+        it, so a connection lost before the Tk thread gets to the VALID_USERNAME message is still resumed).
+        :param envelope: the VALID_USERNAME envelope
+        :return:
+        """
+        self.token = parse_login_body(envelope.body)[1].get('token')
+
+    def on_valid_username(self, envelope):
+        """
+        Opens the chat once the server accepted the username (it is already open when reconnecting).
+        :param envelope: the VALID_USERNAME envelope
+        :return:
+        """
+        self.resume_failures = 0
+        # The server's session tickets have arrived by now, keep one for reconnecting to resume
+        if self.tls is not None:
+            self.tls.remember(self.socket)
+        if not hasattr(self, 'history_button'):
+            self.display_chat()
+        self.resume_transfers()
+
+    def on_invalid_username(self, envelope):
+        """
+        Asks for another username after the server rejected one. A reconnecting user's username is taken while the
+        server still holds their old connection, so they try again (over a new connection, after a delay) a few times
+        first.
+        :param envelope: the INVALID_USERNAME envelope
+        :return:
+        """
+        if self.token is not None and self.resume_failures < RESUME_ATTEMPTS:
+            self.resume_failures += 1
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return
+        self.token = None
+        self.ask_for_username('Invalid username, try again.')
+
+    def on_room(self, envelope):
+        """
+        Starts a fresh chat log for the room the user was placed in.
+        :param envelope: the ROOM envelope
+        :return:
+        """
+        self.room_title.set(f'Chat (#{envelope.body})')
+        self.room = envelope.body
+        self.last_sequence = FIRST_SEQUENCE - 1
+        self.oldest_sequence = None
+        self.flush_messages()
+        self.chat_log.config(state='normal')
+        self.chat_log.delete('1.0', 'end')
+        self.chat_log.config(state='disabled')
+        if hasattr(self, 'history_button'):
+            self.history_button.config(state='normal')
+
+    def on_history_page(self, envelope):
+        """
+        Starts a page of history, whose messages are inserted above everything already shown.
+        :param envelope: the HISTORY_PAGE envelope
+        :return:
+        """
+        self.oldest_sequence = int(envelope.body)
+        self.flush_messages()
+        self.loading_history = True
+        self.history_page_count = 0
+        self.chat_log.mark_set('history', '1.0')
+
+    def on_history_end(self, envelope):
+        """
+        Finishes a page of history.
+        :param envelope: the HISTORY_END envelope
+        :return:
+        """
+        self.loading_history = False
+        # Nothing older left on the server
+        if self.oldest_sequence == FIRST_SEQUENCE or self.history_page_count == 0:
+            if hasattr(self, 'history_button'):
+                self.history_button.config(state='disabled')
+
+    def on_connected(self, envelope):
+        """
+        Shows the notice that the user has connected to the chat successfully.
+        :param envelope: the CONNECTED envelope
+        :return:
+        """
+        self.backoff.reset()
+        self.display_message(envelope.body)
+
+    def on_user_list(self, envelope):
+        """
+        Replaces the list of connected users with the room's full list.
+        :param envelope: the USER_LIST envelope
+        :return:
+        """
+        self.users_list.config(state='normal')
+        # Empty current list
+        self.users_list.delete('0.0', 'end')
+        for username in list(self.connected_users):
+            self.users_list.tag_delete(username + ' (You)' if username == self.username else username)
+        # Empty current list of connected users
+        self.connected_users = set()
+        for username in envelope.body.split():
+            self.add_user(username)
+        self.users_list.config(state='disabled')
+
+    def on_presence(self, envelope):
+        """
+        Applies the users who joined ('+name') or left ('-name') the room since the last update.
+        :param envelope: the PRESENCE envelope
+        :return:
+        """
+        self.users_list.config(state='normal')
+        for change in envelope.body.split():
+            if change[0] == '+':
+                self.add_user(change[1:])
+            else:
+                self.remove_user(change[1:])
+        self.users_list.config(state='disabled')
+
+    def add_color_tag(self, color):
+        """
+        Configures the chat log tag showing text in a color, the first time the color is used.
+        :param color: the color's name
+        :return:
+        """
+        if color in self.color_tags:
+            return
+        try:
+            self.chat_log.tag_config(color, foreground=color)
+        # Not a color Tk knows, the text is shown in the default color
+        except tkinter.TclError:
+            pass
+        self.color_tags.add(color)
+
+    def display_message(self, message, color=None):
+        """
+        Adds a message to the batch shown in the chat log at the end of the frame (or, while a page of history is
+        arriving, above the messages shown).
+        :param message: the text to show
+        :param color: the color to show it in (None for the default)
+        :return:
+        """
+        # Search results go to the search window (a page at a time, so they are not batched)
+        if self.loading_search:
+            self.search_count += 1
+            self.search_log.config(state='normal')
+            self.search_log.insert('end', message)
+            self.search_log.config(state='disabled')
+            return
+        index = 'history' if self.loading_history else 'end'
+        # Messages going elsewhere in the log cannot share an insert with those already batched
+        if index != self.batch_index:
+            self.flush_messages()
+            self.batch_index = index
+        if self.loading_history:
+            self.history_page_count += 1
+        # Insert message with coloring matching the sender's selection for themselves
+        if color:
+            self.add_color_tag(color)
+        self.batch += (message, color or ())
+
+    def request_history(self):
+        """
+        Asks the server for the page of messages sent before the oldest one displayed.
+        :return:
+        """
+        if self.oldest_sequence:
+            self.send(OP_REQUEST_HISTORY, body=str(self.oldest_sequence))
+
+    def search(self, text):
+        """
+        Asks the server for the newest messages in the room matching a search, showing them in the search window.
+        :param text: the words to search for, along with any of 'from:<username>' and 'since:' or 'until:' a date and
+        time (e.g. 'since:2024-05-01' or 'until:2024-05-01T18:30', local time)
+        :return:
+        """
+        if len(text) == 0:
+            return
+        self.open_search_window()
+        self.search_log.config(state='normal')
+        self.search_log.delete('1.0', 'end')
+        self.search_log.config(state='disabled')
+        self.more_button.config(state='disabled')
+        self.search_count = 0
+        self.search_text = search_text(text)
+        self.send(OP_SEARCH, body=self.search_text)
+
+    def more_results(self):
+        """
+        Asks the server for the next page of results of the current search.
+        :return:
+        """
+        if self.search_cursor is not None:
+            self.more_button.config(state='disabled')
+            self.send(OP_SEARCH, body=search_body(self.search_text, before=self.search_cursor))
+
+    def open_search_window(self):
+        """
+        Shows the window listing search results, creating it the first time.
+        :return:
+        """
+        if self.search_window is not None:
+            self.search_window.deiconify()
+            return
+        self.search_window = tkinter.Toplevel(self.chat_window)
+        self.search_window.title('Search Results')
+        # Closing the window only hides it, so it can be shown again for the next search
+        self.search_window.protocol('WM_DELETE_WINDOW', self.search_window.withdraw)
+        self.search_log = tkinter.scrolledtext.ScrolledText(self.search_window)
+        self.search_log.config(state='disabled', bg='lightgray')
+        self.more_button = tkinter.Button(self.search_window, text='More Results', command=self.more_results)
+        self.more_button.config(font=('Arial', 11), state='disabled')
+        self.search_log.grid(row=0, column=0, padx=20, pady=5)
+        self.more_button.grid(row=1, column=0, pady=(0, 10))
+
+    def on_search_results(self, envelope):
+        """
+        Starts a page of search results, shown below those already in the search window.
+        :param envelope: the SEARCH_RESULTS envelope
+        :return:
+        """
+        self.search_cursor = int(envelope.body) if envelope.body else None
+        self.loading_search = True
+
+    def on_search_end(self, envelope):
+        """
+        Finishes a page of search results.
+        :param envelope: the SEARCH_END envelope
+        :return:
+        """
+        self.loading_search = False
+        if self.search_window is None:
+            return
+        if self.search_count == 0 and self.search_cursor is None:
+            self.search_log.config(state='normal')
+            self.search_log.insert('end', 'No messages found.\n')
+            self.search_log.config(state='disabled')
+        self.more_button.config(state='normal' if self.search_cursor is not None else 'disabled')
+
+    def send_file(self):
+        """
+        Asks the user for a file and offers it to the selected user (or everyone in the room), sending it on its own
+        thread as the server gives credit for it.
+        :return:
+        """
+        path = filedialog.askopenfilename(parent=self.chat_window, title='Send File')
+        if not path:
+            return
+        try:
+            transfer = OutgoingFile(next(self.transfer_ids), path, self.selected_user or '')
+        except OSError as error:
+            self.display_message(f'Could not open {path}: {error.strerror}\n', 'red')
+            return
+        self.outgoing_files[transfer.id] = transfer
+        self.credited[transfer.id] = threading.Event()
+        self.send(OP_FILE_OFFER, target=transfer.target, body=transfer.offer_body())
+        recipient = transfer.target or 'the room'
+        self.display_message(f'Offering {transfer.name} ({transfer.size} bytes) to {recipient}...\n', 'green')
+        threading.Thread(target=self.stream_file, args=(transfer, self.credited[transfer.id]), daemon=True).start()
+
+    def stream_file(self, transfer, credited):
+        """
+        Sends an outgoing file's chunks as credit for them arrives, until the transfer ends (runs on the file's own
+        thread). Over plain TCP the chunks' data goes from the file to the socket with sendfile(), over TLS it is
+        read and encrypted.
+        :param transfer: the OutgoingFile
+        :param credited: the event set whenever it is given credit
+        :return:
+        """
+        try:
+            while transfer.ended is None:
+                credited.wait()
+                credited.clear()
+                while transfer.ended is None and (chunk := transfer.next_chunk()) is not None:
+                    offset, length = chunk
+                    try:
+                        with self.send_lock:
+                            self.socket.sendall(encode_chunk_header(self.username, transfer.target, transfer.id,
+                                                                    offset, length))
+                            if isinstance(self.socket, SharedTLSSocket):
+                                self.socket.sendall(os.pread(transfer.file.fileno(), length, offset))
+                            else:
+                                self.socket.sendfile(transfer.file, offset, length)
+                    # Connection lost: logging back in offers the file again and waits to be told where to carry on
+                    except OSError:
+                        transfer.suspend()
+                        break
+        finally:
+            transfer.close()
+
+    def receive_credit(self, envelope):
+        """
+        Lets an outgoing file be sent further (runs on the network thread).
+        :param envelope: the FILE_CREDIT envelope
+        :return:
+        """
+        numbers = parse_numbers(envelope.body)
+        transfer = self.outgoing_files.get(numbers[0]) if numbers else None
+        if transfer is not None:
+            transfer.credit(envelope)
+            self.credited[transfer.id].set()
+
+    def receive_chunk(self, envelope):
+        """
+        Writes part of an incoming file (runs on the network thread).
+        :param envelope: the FILE_CHUNK envelope
+        :return:
+        """
+        transfer_id, offset, data = decode_chunk(envelope)
+        incoming = self.incoming_files.get((envelope.sender, transfer_id))
+        if incoming is not None and incoming.ended is None:
+            incoming.write(offset, data)
+
+    def end_transfer(self, envelope):
+        """
+        Stops a transfer the user was sending or receiving as soon as it ends (runs on the network thread, the Tk
+        thread then shows how it went).
+        :param envelope: the FILE_END envelope
+        :return:
+        """
+        numbers = parse_numbers(envelope.body.split(' ', 1)[0])
+        if not numbers:
+            return
+        reason = envelope.body.partition(' ')[2]
+        transfer = self.outgoing_files.get(numbers[0]) if envelope.target == self.username else None
+        if transfer is not None:
+            transfer.ended = reason
+            self.credited[transfer.id].set()
+        incoming = self.incoming_files.get((envelope.target, numbers[0]))
+        if incoming is not None:
+            incoming.ended = reason
+            incoming.close()
+
+    def on_file_offer(self, envelope):
+        """
+        Asks the user whether to take a file offered to them (or their room), saving it in the downloads directory.
+        :param envelope: the FILE_OFFER envelope
+        :return:
+        """
+        offer = parse_offer(envelope.body)
+        if offer is None or envelope.sender == self.username:
+            return
+        transfer_id, size, name = offer
+        if not messagebox.askyesno('File Offered', f'{envelope.sender} is sending you {name} ({size} bytes).\n'
+                                                   f'Save it in {os.path.abspath(self.downloads)}?',
+                                   parent=self.chat_window):
+            self.send(OP_FILE_END, target=envelope.sender, body=f'{transfer_id} {END_REFUSED}')
+            return
+        path = download_path(self.downloads, name)
+        try:
+            incoming = IncomingFile(envelope.sender, transfer_id, size, name, path)
+        except OSError as error:
+            self.display_message(f'Could not save {name}: {error.strerror}\n', 'red')
+            return
+        self.incoming_files[(envelope.sender, transfer_id)] = incoming
+        self.send(OP_FILE_ACCEPT, target=envelope.sender, body=incoming.accept_body())
+        self.display_message(f'Receiving {name} from {envelope.sender}...\n', 'green')
+
+    def on_file_end(self, envelope):
+        """
+        Shows how a transfer the user was sending or receiving ended.
+        :param envelope: the FILE_END envelope
+        :return:
+        """
+        numbers = parse_numbers(envelope.body.split(' ', 1)[0])
+        if not numbers:
+            return
+        reason = envelope.body.partition(' ')[2]
+        transfer = self.outgoing_files.pop(numbers[0], None) if envelope.target == self.username else None
+        if transfer is not None:
+            del self.credited[transfer.id]
+            message = f'Sent {transfer.name}.\n' if reason == END_DONE else f'Sending {transfer.name} {reason}.\n'
+            self.display_message(message, 'green' if reason == END_DONE else 'red')
+        incoming = self.incoming_files.pop((envelope.target, numbers[0]), None)
+        if incoming is not None:
+            message = (f'Saved {incoming.name} as {incoming.path}.\n' if reason == END_DONE else
+                       f'Receiving {incoming.name} {reason}.\n')
+            self.display_message(message, 'green' if reason == END_DONE else 'red')
+
+    def resume_transfers(self):
+        """
+        Picks the user's transfers back up after logging back in: outgoing files are offered again (and wait to be
+        told where to carry on from), incoming ones are taken again from what was already received.
+        :return:
+        """
+        for transfer in list(self.outgoing_files.values()):
+            transfer.suspend()
+            self.send(OP_FILE_OFFER, target=transfer.target, body=transfer.offer_body())
+        for incoming in list(self.incoming_files.values()):
+            self.send(OP_FILE_ACCEPT, target=incoming.sender, body=incoming.accept_body())
+
+    def join_room(self, room):
+        """
+        Asks the server to move the user into a room.
+        :param room: name of the room to join
+        :return:
+        """
+        if len(room) > 0:
+            self.send(OP_JOIN_ROOM, body=room)
+
+    def leave_room(self):
+        """
+        Asks the server to move the user out of their room and back to the default room.
+        :return:
+        """
+        self.send(OP_LEAVE_ROOM)
 
     def send_message(self):
         """
@@ -273,9 +893,10 @@ class User:
         # If input not empty, send the message and delete the text from the entry box
         if len(message) > 0:
             if self.selected_user is not None:
-                print(f"DIRECT MESSAGING WITH {self.selected_user}")
-                message = f'CHAT_WITH_{self.selected_user} ' + message
-            self.socket.send(message.encode('utf-8'))
+                logger.debug('Direct messaging with %s', self.selected_user)
+                self.send(OP_DIRECT, target=self.selected_user, body=message)
+            else:
+                self.send(OP_CHAT, body=message)
             self.input_area.delete('0.0', 'end')
 
     def exit(self):
@@ -293,6 +914,46 @@ class User:
         exit(0)
 
 
+def search_text(text):
+    """
+    Turns a search typed by the user into the body of a SEARCH envelope, converting any 'since:' and 'until:' dates
+    and times (local time) into milliseconds since the epoch.
+    :param text: the search as typed
+    :return: the body
+    """
+    words = []
+    for word in text.split():
+        name, colon, value = word.partition(':')
+        if colon and name in ('since', 'until') and not value.isdigit():
+            try:
+                word = f'{name}:{int(datetime.datetime.fromisoformat(value).timestamp() * 1000)}'
+            # Sent as typed, the server ignores a search it cannot read
+            except ValueError:
+                pass
+        words.append(word)
+    return ' '.join(words)
+
+
+def parse_args(args=None):
+    """
+    Parses the client's command line options.
+    :param args: list of arguments to parse (defaults to sys.argv)
+    :return: the parsed options
+    """
+    parser = argparse.ArgumentParser(description='Simple Chat App client')
+    parser.add_argument('--host', default=HOST, help='server host')
+    parser.add_argument('--port', type=int, default=PORT, help='server port')
+    parser.add_argument('--tls', action='store_true', help='connect over TLS')
+    parser.add_argument('--ca-file', default=None,
+                        help="PEM file of the certificate authorities to trust (defaults to the system's)")
+    parser.add_argument('--insecure', action='store_true',
+                        help="don't check the server's certificate (for testing against self-signed servers)")
+    parser.add_argument('--downloads', default=DOWNLOADS, help='directory received files are saved in')
+    return parser.parse_args(args)
+
+
 if __name__ == '__main__':
+    options = parse_args()
+    tls = client_context(options.ca_file, verify=not options.insecure) if options.tls else None
     # Create User instance to initialize connection to server socket
-    user = User(HOST, PORT)
+    user = User(options.host, options.port, tls, options.downloads)
@@ -0,0 +1,79 @@
+import time
+import zlib
+
+import metrics
+from protocol import COMPRESSED, HEADER, MAX_FRAME_SIZE
+
+# Feature a client names in its LOGIN body to ask for compression, echoed in the VALID_USERNAME body when granted
+COMPRESSION = 'deflate'
+# Smallest batch (in bytes) worth compressing, smaller ones are sent as they are
+COMPRESS_THRESHOLD = 256
+# zlib compression level, from 1 (fastest) to 9 (smallest)
+COMPRESS_LEVEL = 6
+# Size of the compression window (2 ** bits bytes) and of zlib's internal state; every compressing connection holds
+# about 2 ** (bits + 2) + 2 ** (mem_level + 9) bytes, 32 KiB with these instead of zlib's default 256 KiB
+COMPRESS_WINDOW_BITS = 12
+COMPRESS_MEM_LEVEL = 5
+# Seconds a writer waits for more messages to join a small batch before sending it (0 to send straight away)
+BATCH_WINDOW = 0.002
+# Bytes of waiting messages worth sending without waiting for more
+BATCH_SIZE = 16 * 1024
+# Most bytes of a batch compressed into one frame, so that even a batch that does not compress (deflate grows it by a
+# few bytes per block) stays within the client's MAX_FRAME_SIZE; larger batches (e.g. a long history replay) are sent
+# as several compressed frames
+COMPRESS_SLICE = MAX_FRAME_SIZE // 2
+
+# Preset dictionary priming both ends' streams with what chat traffic looks like, so even the first small batch on a
+# connection compresses well. zlib matches strings near the end of the dictionary most cheaply, so the most common
+# come last. Changing it breaks compression between clients and servers using different versions
+DICTIONARY = b''.join([
+    *[b'{"op":"%s",' % name for name in (b'ROOM', b'HISTORY_PAGE', b'HISTORY_END', b'USER_LIST', b'CONNECTED',
+                                         b'LEFT', b'JOINED', b'PRESENCE', b'PING', b'DIRECT', b'CHAT')],
+    b'"target":"', b'"sender":"', b'"color":"', b'"time":1', b'"body":"',
+    b'Connected to chat as ', b' has left the chat.\n', b' has joined the chat.\n', b' (To: ',
+    b'black', b'blue', b'yellow', b'purple', b'orange', b'brown', b'cyan', b'green', b'red',
+    b'\x00\x00\x00', b'\x00\x00\x05black', b'AM] ', b'PM] ', b': ', b'\n',
+])
+
+
+class Compressor:
+    """
+    Compresses the batches written to one client as a single zlib stream, so each batch is compressed with
+    everything sent before it as context. Batches are flushed to a byte boundary and framed with the COMPRESSED flag;
+    the client inflates them back into ordinary frames. Only the client's writer uses it.
+    """
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL):
+        self.threshold = threshold
+        self.stream = zlib.compressobj(level, zlib.DEFLATED, COMPRESS_WINDOW_BITS, COMPRESS_MEM_LEVEL,
+                                       zdict=DICTIONARY)
+
+    def compress(self, data):
+        """
+        Compresses a batch of frames, if it is large enough to be worth it.
+        :param data: the framed messages
+        :return: the compressed frame(s), or the data as it was
+        """
+        if len(data) < self.threshold:
+            return data
+        start = time.thread_time()
+        frames = []
+        # The client inflates one stream, so a message may straddle two compressed frames
+        with memoryview(data) as view:
+            for offset in range(0, len(data), COMPRESS_SLICE):
+                compressed = (self.stream.compress(view[offset:offset + COMPRESS_SLICE]) +
+                              self.stream.flush(zlib.Z_SYNC_FLUSH))
+                frames.append(HEADER.pack(len(compressed) | COMPRESSED) + compressed)
+        metrics.compression_seconds.observe(time.thread_time() - start)
+        frame = b''.join(frames)
+        metrics.compression_input_bytes.inc(len(data))
+        metrics.compression_output_bytes.inc(len(frame))
+        return frame
+
+
+def decompressor():
+    """
+    Creates the stream inflating the compressed frames sent to a client.
+    :return: a zlib decompression object primed with the preset dictionary
+    """
+    return zlib.decompressobj(zdict=DICTIONARY)
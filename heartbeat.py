@@ -0,0 +1,147 @@
+import math
+import threading
+import time
+
+from protocol import OP_PING, encode_envelope, encode_frame
+
+# Seconds a user may be quiet before being pinged (0 turns heartbeats off)
+HEARTBEAT_INTERVAL = 15.0
+# Seconds a user may be quiet (not even answering pings) before their connection is closed
+HEARTBEAT_TIMEOUT = 45.0
+# Seconds a connection has to finish logging in before it is closed (0 for no deadline)
+LOGIN_TIMEOUT = 30.0
+# Seconds per slot of the timer wheel, the precision timers fire with
+WHEEL_TICK = 0.5
+# Number of slots in the timer wheel, timers further out than one turn wait in their slot for their turn
+WHEEL_SLOTS = 128
+
+
+class Timer:
+    """
+    A callback scheduled on a TimerWheel.
+    """
+    __slots__ = ('tick', 'callback', 'cancelled')
+
+    def __init__(self, tick, callback):
+        # Number of the wheel tick the timer fires on
+        self.tick = tick
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stops the timer from firing (it is dropped from the wheel when its slot comes round).
+        :return:
+        """
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: timers go into the slot of the tick they fire on, so scheduling and cancelling cost the same
+    however many timers are running, and each tick only looks at one slot. Something has to call advance() about once
+    per tick (a thread in the threaded server, the event loop in the asyncio server).
+    """
+
+    def __init__(self, tick=WHEEL_TICK, slot_count=WHEEL_SLOTS, clock=time.monotonic):
+        self.tick = tick
+        # Lists of the timers firing on each tick, by tick number modulo the number of slots
+        self.slots = [[] for _ in range(slot_count)]
+        # Function returning the current time in seconds
+        self.clock = clock
+        # Number of the last tick whose timers have been run
+        self.position = int(clock() / tick)
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, callback):
+        """
+        Runs a callback once a delay has passed (never early, at most one tick late).
+        :param delay: seconds to wait
+        :param callback: the function to call, from whatever calls advance()
+        :return: the Timer, to cancel it with
+        """
+        with self.lock:
+            timer = Timer(max(math.ceil((self.clock() + delay) / self.tick), self.position + 1), callback)
+            self.slots[timer.tick % len(self.slots)].append(timer)
+        return timer
+
+    def advance(self):
+        """
+        Runs the timers due since the last call.
+        :return:
+        """
+        with self.lock:
+            target = int(self.clock() / self.tick)
+            due = []
+            # Each slot needs visiting once at most, however far behind the wheel is
+            for tick in range(self.position + 1, min(target, self.position + len(self.slots)) + 1):
+                slot = self.slots[tick % len(self.slots)]
+                if slot:
+                    due += [timer for timer in slot if timer.tick <= target]
+                    slot[:] = [timer for timer in slot if timer.tick > target and not timer.cancelled]
+            self.position = max(self.position, target)
+        # Callbacks run outside the lock, so they can schedule timers of their own
+        for timer in due:
+            if not timer.cancelled:
+                timer.callback()
+
+
+def run_with_thread(wheel):
+    """
+    Drives a timer wheel from a background thread (used by the threaded server).
+    :param wheel: the TimerWheel
+    :return:
+    """
+    def run():
+        while True:
+            time.sleep(wheel.tick)
+            wheel.advance()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+class Heartbeats:
+    """
+    Watches logged in users for signs of life. Receiving anything from a user counts, so all a message costs is
+    updating their last_seen time; their timer only looks at it when it fires. A user quiet for a heartbeat interval is
+    pinged, and one quiet for the whole timeout is handed to reap() to be disconnected.
+    """
+
+    def __init__(self, wheel, reap, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT, clock=time.monotonic):
+        self.wheel = wheel
+        # Function closing a dead user's connection, called with their UserRecord
+        self.reap = reap
+        self.interval = interval
+        self.timeout = timeout
+        self.clock = clock
+        # The framed ping, shared by every user
+        self.ping = encode_frame(encode_envelope(OP_PING))
+
+    def watch(self, user):
+        """
+        Starts watching a user who just logged in.
+        :param user: the UserRecord
+        :return:
+        """
+        user.last_seen = self.clock()
+        if self.interval > 0:
+            self.wheel.schedule(self.interval, lambda: self.check(user))
+
+    def check(self, user):
+        """
+        Checks on a user when their timer fires, pinging or reaping them if they have been quiet for too long.
+        :param user: the UserRecord
+        :return:
+        """
+        # User has left
+        if user.outbound.closed:
+            return
+        idle = self.clock() - user.last_seen
+        if idle >= self.timeout:
+            self.reap(user)
+            return
+        if idle >= self.interval:
+            user.outbound.put(self.ping)
+        # Check again once they could next need a ping, or at the latest when they run out of time
+        delay = self.interval - idle if idle < self.interval else min(self.interval, self.timeout - idle)
+        self.wheel.schedule(delay, lambda: self.check(user))
@@ -0,0 +1,162 @@
+import collections
+
+from protocol import OP_HISTORY_END, OP_HISTORY_PAGE, encode_envelope
+from search import SearchIndex
+
+# Number of messages kept in the chat history by default
+HISTORY_SIZE = 1000
+# Number of messages replayed to a user when they join (and per page when they ask for older messages)
+REPLAY_SIZE = 50
+# Sequence number of a room's first message (0 marks messages not recorded in a history)
+FIRST_SEQUENCE = 1
+
+
+class ChatHistory:
+    """
+    Fixed-capacity ring buffer of broadcast messages. Each message gets an increasing sequence number, so appending,
+    evicting and looking up a message by its position are all O(1). Chat messages are also indexed for searching as
+    they are appended, and dropped from the index as they are evicted.
+    """
+
+    def __init__(self, capacity=HISTORY_SIZE):
+        self.capacity = capacity
+        # Message with sequence number n lives in slot n % capacity
+        self.slots = [None] * capacity
+        # Sequence number of the oldest message still held
+        self.first_sequence = FIRST_SEQUENCE
+        # Sequence number the next appended message will get
+        self.next_sequence = FIRST_SEQUENCE
+        # Number of copies of each message held, so membership checks don't scan the buffer
+        self.counts = collections.Counter()
+        # Index of the messages held, by the words in them, their sender and the time they were sent
+        self.index = SearchIndex(capacity)
+
+    def __len__(self):
+        return self.next_sequence - self.first_sequence
+
+    def __contains__(self, message):
+        return self.counts[message] > 0
+
+    def __iter__(self):
+        return iter(self.range(self.first_sequence, self.next_sequence))
+
+    def append(self, message):
+        """
+        Adds a message to the history, evicting the oldest message if the history is full.
+        :param message: the message to add
+        :return: the sequence number given to the message
+        """
+        sequence = self.next_sequence
+        slot = sequence % self.capacity
+        # Buffer full, the slot still holds the oldest message
+        if len(self) == self.capacity:
+            self.forget(self.slots[slot])
+            self.index.evict()
+            self.first_sequence += 1
+        self.slots[slot] = message
+        self.counts[message] += 1
+        self.index.add(sequence, message)
+        self.next_sequence = sequence + 1
+        return sequence
+
+    def resume_at(self, sequence):
+        """
+        Continues numbering from where an earlier history left off (e.g. before a restart), so clients' sequence
+        numbers stay valid. Only an empty history can be moved.
+        :param sequence: sequence number the next appended message will get
+        :return:
+        """
+        if not len(self):
+            self.first_sequence = self.next_sequence = sequence
+
+    def forget(self, message):
+        """
+        Drops one copy of an evicted message from the membership counts.
+        :param message: the evicted message
+        :return:
+        """
+        count = self.counts[message] - 1
+        if count:
+            self.counts[message] = count
+        else:
+            del self.counts[message]
+
+    def message(self, sequence):
+        """
+        Gets a message still held.
+        :param sequence: the message's sequence number
+        :return: the message
+        """
+        return self.slots[sequence % self.capacity]
+
+    def range(self, start, end):
+        """
+        Gets the messages with sequence numbers in [start, end), clamped to what is still held.
+        :param start: sequence number of the first message
+        :param end: sequence number after the last message
+        :return: list of messages, oldest first
+        """
+        start = max(start, self.first_sequence)
+        end = min(end, self.next_sequence)
+        return [self.slots[sequence % self.capacity] for sequence in range(start, end)]
+
+    def latest(self, count=REPLAY_SIZE):
+        """
+        Gets the most recent messages.
+        :param count: the maximum number of messages to get
+        :return: tuple of (sequence number of the first message, list of messages oldest first)
+        """
+        return self.before(self.next_sequence, count)
+
+    def before(self, sequence, count=REPLAY_SIZE):
+        """
+        Gets a page of the messages sent before the given sequence number.
+        :param sequence: sequence number to page back from
+        :param count: the maximum number of messages to get
+        :return: tuple of (sequence number of the first message, list of messages oldest first)
+        """
+        end = max(min(sequence, self.next_sequence), self.first_sequence)
+        start = max(end - count, self.first_sequence)
+        return start, self.range(start, end)
+
+
+def history_page(history, sequence=None, count=REPLAY_SIZE):
+    """
+    Builds the messages that deliver one page of history to a client: a HISTORY_PAGE envelope carrying the first
+    message's sequence number, the messages themselves and a closing HISTORY_END envelope.
+    :param history: the ChatHistory to page through
+    :param sequence: sequence number to page back from (None for the most recent messages)
+    :param count: the maximum number of messages in the page
+    :return: list of messages to send
+    """
+    if sequence is None:
+        sequence = history.next_sequence
+    start, messages = history.before(sequence, count)
+    return [encode_envelope(OP_HISTORY_PAGE, body=str(start)), *messages, encode_envelope(OP_HISTORY_END)]
+
+
+def missed_messages(history, after, count=REPLAY_SIZE):
+    """
+    Gets the messages a reconnecting client missed since the last one it received, as long as they are no more than
+    a fresh login would be sent.
+    :param history: the ChatHistory of the client's room
+    :param after: sequence number of the last message the client received
+    :param count: the most messages worth sending
+    :return: list of messages oldest first, or None if there are too many, or the history no longer holds all of them
+    (or never held the sequence number, e.g. the room was discarded since)
+    """
+    if not history.first_sequence - 1 <= after < history.next_sequence or history.next_sequence - after - 1 > count:
+        return None
+    return history.range(after + 1, history.next_sequence)
+
+
+def parse_history_request(envelope):
+    """
+    Gets the sequence number from a REQUEST_HISTORY envelope.
+    :param envelope: the history request
+    :return: the sequence number, or None if the request is malformed
+    """
+    try:
+        return int(envelope.body)
+    except ValueError:
+        return None
@@ -0,0 +1,621 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from async_server import raise_file_limit
+from chat_client import HOST, PORT, ChatClient, LoginError
+from protocol import OP_DIRECT, OP_FILE_CHUNK
+from reconnect import RESUME_ATTEMPTS
+from tls import client_context
+from transfers import END_DONE, TRANSFER_TIMEOUT
+
+try:
+    import psutil
+except ImportError:
+    # Optional, server memory is read from /proc where available
+    psutil = None
+
+# Marker put in front of the send time of every benchmark message
+BENCH_MARKER = 'BENCH '
+# Seconds between server memory samples
+MEMORY_INTERVAL = 0.5
+# Size in bytes of the file sent in each transfer
+TRANSFER_SIZE = 8 * 1024 * 1024
+# Seconds between checks on whether the transfers have ended
+TRANSFER_POLL_INTERVAL = 0.01
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """
+    Summarizes a list of samples.
+    :param samples: list of numbers
+    :param points: the percentiles to report
+    :return: dict of count, mean, max and the requested percentiles (None values if there are no samples)
+    """
+    summary = {'count': len(samples)}
+    if not samples:
+        summary.update({'mean': None, 'max': None, **{f'p{point}': None for point in points}})
+        return summary
+    ordered = sorted(samples)
+    summary['mean'] = sum(ordered) / len(ordered)
+    summary['max'] = ordered[-1]
+    for point in points:
+        summary[f'p{point}'] = ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))]
+    return summary
+
+
+def server_memory(pid):
+    """
+    Gets the resident memory of the server process.
+    :param pid: the server's process id
+    :return: resident memory in bytes, or None if it cannot be read
+    """
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def git_commit():
+    """
+    Gets the commit the benchmark is being run against, so results can be compared across commits.
+    :return: the commit hash, or None outside a git checkout
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LoadTest:
+    """
+    Opens many simulated users against a running server and measures how it copes.
+    """
+
+    def __init__(self, options, server=None):
+        self.options = options
+        # Popen of the server started for the run (None when running against an existing server)
+        self.server = server
+        self.random = random.Random(options.seed)
+        # Context every user connects over TLS with, sharing the session they resume (None for plain TCP); without a
+        # CA file the server's certificate is not checked, for testing against self-signed servers
+        self.tls = client_context(options.tls_ca, verify=options.tls_ca is not None) if options.tls else None
+        # Logged in simulated users
+        self.clients = []
+        # Latency samples, in seconds
+        self.connect_latencies = []
+        self.login_latencies = []
+        self.broadcast_latencies = []
+        self.direct_latencies = []
+        # Connect latencies of TLS connections, by whether they resumed a session
+        self.full_handshake_latencies = []
+        self.resumed_handshake_latencies = []
+        # Connect and login latencies of the users reconnecting at once after the chat, the messages each was sent
+        # while logging back in, and how many resumed where they left off
+        self.storm_connect_latencies = []
+        self.storm_login_latencies = []
+        self.storm_replayed = []
+        self.storm_resumed = 0
+        # Counters
+        self.failed_logins = 0
+        self.sent = 0
+        self.received = 0
+        self.received_bytes = 0
+        # Server memory samples, in bytes, and those taken while files were being transferred
+        self.memory_samples = []
+        self.transfer_memory_samples = []
+        # Seconds each transfer took to be written to its recipient, the reasons transfers ended with, the bytes of
+        # file data received and the number of transfers still going on
+        self.transfer_latencies = []
+        self.transfer_ends = []
+        self.transfer_bytes = 0
+        self.transfers_running = 0
+        # Set once senders should stop
+        self.stopping = False
+
+    async def open_user(self, index, limit):
+        """
+        Connects and logs in one simulated user.
+        :param index: the user's number
+        :param limit: semaphore bounding how many users connect at once
+        :return:
+        """
+        async with limit:
+            client = ChatClient(self.options.host, self.options.port, compress=not self.options.no_compression,
+                                tls=self.tls, accept_files=self.options.transfers > 0)
+            start = time.perf_counter()
+            try:
+                await client.connect()
+                connected = time.perf_counter()
+                await client.login(f'{self.options.prefix}{index}')
+                logged_in = time.perf_counter()
+                if self.options.rooms > 1:
+                    await client.join_room(f'room{index % self.options.rooms}')
+            except (OSError, LoginError) as error:
+                self.failed_logins += 1
+                if self.failed_logins <= 5:
+                    print(f'User {index} failed to log in: {error!r}', file=sys.stderr)
+                await client.close()
+                return
+            self.connect_latencies.append(connected - start)
+            self.record_handshake(client, connected - start)
+            self.login_latencies.append(logged_in - connected)
+            self.clients.append(client)
+
+    async def resume_user(self, client, limit):
+        """
+        Reconnects a simulated user whose connection dropped, after the client's jittered backoff delay, logging in
+        as the same user to resume where they left off (or afresh with --no-resume).
+        :param client: the user's ChatClient
+        :param limit: semaphore bounding how many users connect at once
+        :return:
+        """
+        if self.options.no_resume:
+            client.token = None
+        for attempt in range(RESUME_ATTEMPTS):
+            await asyncio.sleep(client.backoff.next_delay())
+            async with limit:
+                start = time.perf_counter()
+                try:
+                    await client.connect()
+                    connected = time.perf_counter()
+                    received = await client.login(client.username)
+                    logged_in = time.perf_counter()
+                # Without resuming, the username stays taken until the server notices the old connection closed
+                except (OSError, LoginError) as error:
+                    await client.close()
+                    if attempt + 1 < RESUME_ATTEMPTS:
+                        continue
+                    self.failed_logins += 1
+                    if self.failed_logins <= 5:
+                        print(f'User {client.username} failed to log back in: {error!r}', file=sys.stderr)
+                    return
+            self.storm_connect_latencies.append(connected - start)
+            self.storm_login_latencies.append(logged_in - connected)
+            self.record_handshake(client, connected - start)
+            self.storm_replayed.append(len(received))
+            self.storm_resumed += client.resumed
+            self.clients.append(client)
+            return
+
+    def record_handshake(self, client, seconds):
+        """
+        Records how long a TLS connection took to open, by whether it resumed a TLS session.
+        :param client: the connected ChatClient
+        :param seconds: the connect latency
+        :return:
+        """
+        if self.tls is not None:
+            handshakes = self.resumed_handshake_latencies if client.tls_resumed else self.full_handshake_latencies
+            handshakes.append(seconds)
+
+    async def receive_loop(self, client):
+        """
+        Reads a simulated user's messages, timing every benchmark message it gets.
+        :param client: the user's ChatClient
+        :return:
+        """
+        try:
+            while True:
+                envelope = await client.receive()
+                if envelope is None:
+                    break
+                # File data is counted apart from chat messages
+                if envelope.op == OP_FILE_CHUNK:
+                    self.transfer_bytes += len(envelope.body)
+                    continue
+                self.received += 1
+                self.received_bytes += len(envelope.body)
+                marker = envelope.body.rfind(BENCH_MARKER)
+                if marker == -1:
+                    continue
+                latency = time.perf_counter() - int(envelope.body[marker + len(BENCH_MARKER):].split()[0]) / 1e9
+                if envelope.op == OP_DIRECT:
+                    self.direct_latencies.append(latency)
+                else:
+                    self.broadcast_latencies.append(latency)
+        except (ConnectionError, ValueError):
+            pass
+
+    async def send_loop(self, client, rate, dm_ratio):
+        """
+        Sends a simulated user's messages at the given average rate until the test ends.
+        :param client: the user's ChatClient
+        :param rate: average messages per second
+        :param dm_ratio: fraction of messages sent as direct messages
+        :return:
+        """
+        try:
+            while not self.stopping:
+                await asyncio.sleep(self.random.expovariate(rate))
+                if self.stopping:
+                    break
+                body = f'{BENCH_MARKER}{time.perf_counter_ns()}'
+                if len(self.clients) > 1 and self.random.random() < dm_ratio:
+                    other = self.random.choice(self.clients)
+                    if other is not client:
+                        await client.send_direct(other.username, body)
+                        self.sent += 1
+                        continue
+                await client.send(body)
+                self.sent += 1
+        except ConnectionError:
+            pass
+
+    async def transfer_file(self, client, path, recipient):
+        """
+        Sends a file from one simulated user to another, timing it until it has been written to the recipient.
+        :param client: the sending user's ChatClient
+        :param path: path of the file to send
+        :param recipient: the receiving user's ChatClient
+        :return:
+        """
+        self.transfers_running += 1
+        start = time.perf_counter()
+        try:
+            transfer = await client.send_file(path, recipient.username)
+            while transfer.ended is None and time.perf_counter() - start < TRANSFER_TIMEOUT:
+                await asyncio.sleep(TRANSFER_POLL_INTERVAL)
+        except ConnectionError:
+            return
+        finally:
+            self.transfers_running -= 1
+        self.transfer_ends.append(transfer.ended)
+        if transfer.ended == END_DONE:
+            self.transfer_latencies.append(time.perf_counter() - start)
+
+    async def run_transfers(self):
+        """
+        Sends the configured number of files at once, each from a different simulated user to another one picked at
+        random, while the others chat.
+        :return: dict of how the transfers went
+        """
+        options = self.options
+        senders = self.random.sample(self.clients, min(options.transfers, len(self.clients)))
+        with tempfile.NamedTemporaryFile(prefix='bench', suffix='.bin') as file:
+            file.write(os.urandom(options.transfer_size))
+            file.flush()
+            start = time.perf_counter()
+            await asyncio.gather(*[self.transfer_file(client, file.name, self.random.choice(
+                [other for other in self.clients if other is not client])) for client in senders])
+            elapsed = time.perf_counter() - start
+        completed = len(self.transfer_latencies)
+        return {
+            'transfers': len(senders),
+            'completed': completed,
+            'failed': len(senders) - completed,
+            'file_bytes': options.transfer_size,
+            'seconds': elapsed,
+            'throughput': completed * options.transfer_size / elapsed if elapsed else None,
+            'transfer_throughput': percentiles([options.transfer_size / seconds
+                                                for seconds in self.transfer_latencies]),
+            'transfer_latency': percentiles(self.transfer_latencies),
+            'server_memory_peak': max(self.transfer_memory_samples) if self.transfer_memory_samples else None,
+            # File data the recipients received (a restarted transfer's resent bytes included), and what each transfer
+            # ended with ('timeout' if it had not ended by TRANSFER_TIMEOUT)
+            'bytes_received': self.transfer_bytes,
+            'receive_throughput': self.transfer_bytes / elapsed if elapsed else None,
+            'ends': dict(collections.Counter(end or 'timeout' for end in self.transfer_ends)),
+        }
+
+    async def sample_memory(self):
+        """
+        Samples the server's memory use until cancelled.
+        :return:
+        """
+        while True:
+            memory = server_memory(self.options.server_pid)
+            if memory is not None:
+                self.memory_samples.append(memory)
+                if self.transfers_running:
+                    self.transfer_memory_samples.append(memory)
+            await asyncio.sleep(MEMORY_INTERVAL)
+
+    async def restart_server(self):
+        """
+        Stops the server started for the run and starts it again with the same arguments.
+        :return:
+        """
+        self.server.terminate()
+        self.server.wait()
+        self.server = await asyncio.to_thread(spawn_server, self.options)
+        self.options.server_pid = self.server.pid
+
+    async def reconnect_storm(self, limit):
+        """
+        Reconnects every user at once after their connections were closed (as when a server restarts).
+        :param limit: semaphore bounding how many users connect at once
+        :return: dict of how the reconnection went
+        """
+        dropped = self.clients
+        failed_before = self.failed_logins
+        self.clients = []
+        start = time.perf_counter()
+        await asyncio.gather(*[self.resume_user(client, limit) for client in dropped])
+        elapsed = time.perf_counter() - start
+        for client in self.clients:
+            await client.close()
+        return {
+            'users': len(self.clients),
+            'failed_logins': self.failed_logins - failed_before,
+            'resumed': self.storm_resumed,
+            'seconds': elapsed,
+            'connect_latency': percentiles(self.storm_connect_latencies),
+            'login_latency': percentiles(self.storm_login_latencies),
+            'replayed_messages': percentiles(self.storm_replayed),
+        }
+
+    def tls_summary(self):
+        """
+        Summarizes the TLS handshakes made: how many resumed a session, and what full and resumed handshakes cost.
+        :return: dict of TLS results, or None if users connected over plain TCP
+        """
+        if self.tls is None:
+            return None
+        full = len(self.full_handshake_latencies)
+        resumed = len(self.resumed_handshake_latencies)
+        return {
+            'handshakes': full + resumed,
+            'resumed': resumed,
+            'resumption_rate': resumed / (full + resumed) if full + resumed else None,
+            'full_connect_latency': percentiles(self.full_handshake_latencies),
+            'resumed_connect_latency': percentiles(self.resumed_handshake_latencies),
+        }
+
+    def user_profile(self):
+        """
+        Picks a simulated user's message rate and direct message ratio around the configured averages.
+        :return: tuple of (messages per second, direct message ratio)
+        """
+        jitter = self.options.jitter
+        rate = self.options.rate * self.random.uniform(1 - jitter, 1 + jitter)
+        dm_ratio = min(1.0, self.options.dm_ratio * self.random.uniform(1 - jitter, 1 + jitter))
+        return max(rate, 1e-6), dm_ratio
+
+    async def run(self):
+        """
+        Runs the load test: connects every user, lets them chat for the configured duration, then reports.
+        :return: dict of results
+        """
+        options = self.options
+        memory_task = asyncio.create_task(self.sample_memory()) if options.server_pid else None
+
+        # Connect and log in every user
+        limit = asyncio.Semaphore(options.concurrency)
+        ramp_start = time.perf_counter()
+        await asyncio.gather(*[self.open_user(index, limit) for index in range(options.users)])
+        ramp_time = time.perf_counter() - ramp_start
+        print(f'{len(self.clients)} users logged in ({self.failed_logins} failed) in {ramp_time:.2f}s')
+
+        # Chat for the configured duration
+        receivers = [asyncio.create_task(self.receive_loop(client)) for client in self.clients]
+        senders = [asyncio.create_task(self.send_loop(client, *self.user_profile())) for client in self.clients]
+        # Files are sent while the others chat, so chat latency is measured alongside them
+        transfers = None
+        if options.transfers > 0 and len(self.clients) > 1:
+            transfers = asyncio.create_task(self.run_transfers())
+        start = time.perf_counter()
+        received_before = self.received
+        await asyncio.sleep(options.duration)
+        self.stopping = True
+        elapsed = time.perf_counter() - start
+        # Senders may be waiting for their next message or for a write to drain, they are stopped where they are
+        for task in senders:
+            task.cancel()
+        await asyncio.gather(*senders, return_exceptions=True)
+        sent = self.sent
+        transfer_results = await transfers if transfers is not None else None
+        # Give messages in flight time to arrive (they were sent while the test ran, so they count towards it)
+        await asyncio.sleep(options.drain)
+        received = self.received - received_before
+
+        # The server goes down with every user still connected
+        if options.reconnect_storm and options.restart_server:
+            await self.restart_server()
+        for client in self.clients:
+            await client.close()
+        for task in receivers:
+            task.cancel()
+        storm = await self.reconnect_storm(limit) if options.reconnect_storm else None
+        if memory_task is not None:
+            memory_task.cancel()
+
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'options': {key: value for key, value in vars(options).items() if key not in ('output', 'server_pid')},
+            'users': len(self.clients),
+            'failed_logins': self.failed_logins,
+            'ramp_seconds': ramp_time,
+            'connect_latency': percentiles(self.connect_latencies),
+            'login_latency': percentiles(self.login_latencies),
+            'broadcast_latency': percentiles(self.broadcast_latencies),
+            'direct_latency': percentiles(self.direct_latencies),
+            'tls': self.tls_summary(),
+            'reconnect_storm': storm,
+            'file_transfers': transfer_results,
+            'messages_sent': sent,
+            'messages_received': received,
+            'send_throughput': sent / elapsed,
+            'receive_throughput': received / elapsed,
+            'receive_bytes_per_second': self.received_bytes / elapsed,
+            'server_memory': {
+                'peak': max(self.memory_samples) if self.memory_samples else None,
+                'final': self.memory_samples[-1] if self.memory_samples else None,
+            },
+        }
+
+
+def print_report(results):
+    """
+    Prints a human readable summary of a load test's results.
+    :param results: dict of results from LoadTest.run()
+    :return:
+    """
+    def milliseconds(summary):
+        if not summary['count']:
+            return 'no samples'
+        return ' '.join(f'{name}={summary[name] * 1000:.2f}ms' for name in ('p50', 'p90', 'p99', 'max'))
+
+    print(f"Users:              {results['users']} ({results['failed_logins']} failed)")
+    print(f"Connect latency:    {milliseconds(results['connect_latency'])}")
+    print(f"Login latency:      {milliseconds(results['login_latency'])}")
+    print(f"Broadcast latency:  {milliseconds(results['broadcast_latency'])}")
+    print(f"Direct latency:     {milliseconds(results['direct_latency'])}")
+    if results['tls'] is not None:
+        tls = results['tls']
+        rate = f"{tls['resumption_rate'] * 100:.1f}%" if tls['resumption_rate'] is not None else 'n/a'
+        print(f"TLS handshakes:     {tls['handshakes']} ({tls['resumed']} resumed, {rate})")
+        print(f"  full:             {milliseconds(tls['full_connect_latency'])}")
+        print(f"  resumed:          {milliseconds(tls['resumed_connect_latency'])}")
+    print(f"Sent:               {results['messages_sent']} ({results['send_throughput']:.1f} msg/s)")
+    print(f"Received:           {results['messages_received']} ({results['receive_throughput']:.1f} msg/s)")
+    if results['file_transfers'] is not None:
+        transfers = results['file_transfers']
+        print(f"File transfers:     {transfers['completed']}/{transfers['transfers']} completed of "
+              f"{transfers['file_bytes'] / 2 ** 20:.1f}MiB each in {transfers['seconds']:.2f}s "
+              f"({(transfers['throughput'] or 0) / 2 ** 20:.1f}MiB/s in total)")
+        if transfers['transfer_throughput']['count']:
+            per_transfer = transfers['transfer_throughput']
+            print(f"  per transfer:     p50={per_transfer['p50'] / 2 ** 20:.1f}MiB/s "
+                  f"mean={per_transfer['mean'] / 2 ** 20:.1f}MiB/s")
+        print(f"  received:         {transfers['bytes_received'] / 2 ** 20:.1f}MiB of file data "
+              f"({(transfers['receive_throughput'] or 0) / 2 ** 20:.1f}MiB/s)")
+        ends = ' '.join(f'{reason}={count}' for reason, count in sorted(transfers['ends'].items()))
+        print(f"  ended:            {ends}")
+        if transfers['server_memory_peak'] is not None:
+            print(f"  server memory:    peak={transfers['server_memory_peak'] / 2 ** 20:.1f}MiB during transfers")
+    if results['reconnect_storm'] is not None:
+        storm = results['reconnect_storm']
+        print(f"Reconnect storm:    {storm['users']} users ({storm['failed_logins']} failed, {storm['resumed']} "
+              f"resumed) in {storm['seconds']:.2f}s")
+        print(f"  connect latency:  {milliseconds(storm['connect_latency'])}")
+        print(f"  login latency:    {milliseconds(storm['login_latency'])}")
+        if storm['replayed_messages']['count']:
+            print(f"  replayed:         mean={storm['replayed_messages']['mean']:.1f} "
+                  f"max={storm['replayed_messages']['max']} messages per user")
+    if results['server_memory']['peak'] is not None:
+        print(f"Server memory:      peak={results['server_memory']['peak'] / 2 ** 20:.1f}MiB "
+              f"final={results['server_memory']['final'] / 2 ** 20:.1f}MiB")
+
+
+def parse_args(args=None):
+    """
+    Parses the load test's command line options.
+    :param args: list of arguments to parse (defaults to sys.argv)
+    :return: the parsed options
+    """
+    parser = argparse.ArgumentParser(description='Load generator and benchmark for the Simple Chat App server')
+    parser.add_argument('--host', default=HOST, help='server host')
+    parser.add_argument('--port', type=int, default=PORT, help='server port')
+    parser.add_argument('--users', type=int, default=100, help='number of simulated users')
+    parser.add_argument('--concurrency', type=int, default=200, help='maximum number of users logging in at once')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds users chat for')
+    parser.add_argument('--drain', type=float, default=2.0,
+                        help='seconds to wait for messages in flight after users stop sending')
+    parser.add_argument('--rate', type=float, default=0.5, help='average messages per second per user')
+    parser.add_argument('--dm-ratio', type=float, default=0.1, help='average fraction of messages sent privately')
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help="how far (as a fraction) each user's rate and direct message ratio vary from the average")
+    parser.add_argument('--rooms', type=int, default=1, help='number of rooms to spread users over')
+    parser.add_argument('--transfers', type=int, default=0,
+                        help='number of users sending a file to another user at once while the others chat')
+    parser.add_argument('--transfer-size', type=int, default=TRANSFER_SIZE, help='bytes of each file sent')
+    parser.add_argument('--prefix', default='bench', help='prefix of the simulated usernames')
+    parser.add_argument('--no-compression', action='store_true',
+                        help="don't ask the server to compress what it sends")
+    parser.add_argument('--tls', action='store_true', help='connect over TLS')
+    parser.add_argument('--tls-ca', default=None,
+                        help="PEM file of the certificate authorities to check the server's certificate against "
+                             "(it isn't checked without one)")
+    parser.add_argument('--reconnect-storm', action='store_true',
+                        help='after the chat, drop every user and reconnect them all at once, measuring how long it '
+                             'takes')
+    parser.add_argument('--restart-server', action='store_true',
+                        help='restart the server started with --spawn-server before the reconnect storm (give it '
+                             '--log-dir for the chat history to survive the restart)')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='log users back in afresh in the reconnect storm instead of resuming where they left off')
+    parser.add_argument('--seed', type=int, default=None, help='random seed, for repeatable runs')
+    parser.add_argument('--server-pid', type=int, default=None, help='process id of the server, to sample its memory')
+    parser.add_argument('--spawn-server', nargs=argparse.REMAINDER, default=None, metavar='SERVER_ARGS',
+                        help='start server.py with the given arguments for the run (must be the last option)')
+    parser.add_argument('--output', default='bench_results.jsonl',
+                        help="file the results are appended to as one JSON line ('-' to skip)")
+    options = parser.parse_args(args)
+    if options.restart_server and options.spawn_server is None:
+        parser.error('--restart-server needs --spawn-server')
+    return options
+
+
+def spawn_server(options):
+    """
+    Starts a server for the load test to run against.
+    :param options: the parsed command line options
+    :return: the server's Popen
+    """
+    server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    # Every simulated user connects from the same address, so the per-address and accept limits are lifted (unless
+    # the given arguments set them)
+    process = subprocess.Popen([sys.executable, server_script, '--host', options.host, '--port', str(options.port),
+                                '--address-rate', '0', '--accept-rate', '0', *options.spawn_server],
+                               stdout=subprocess.DEVNULL)
+    # Wait for the server to start listening
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((options.host, options.port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('server did not start listening')
+
+
+def main(args=None):
+    """
+    Runs a load test from the command line, printing a report and saving the results.
+    :param args: list of arguments to parse (defaults to sys.argv)
+    :return: dict of results
+    """
+    options = parse_args(args)
+    raise_file_limit()
+    server = None
+    if options.spawn_server is not None:
+        server = spawn_server(options)
+        options.server_pid = server.pid
+    test = LoadTest(options, server)
+    try:
+        results = asyncio.run(test.run())
+    finally:
+        # The server may have been restarted during the run
+        if test.server is not None:
+            test.server.terminate()
+            test.server.wait()
+    print_report(results)
+    if options.output != '-':
+        with open(options.output, 'a') as output:
+            output.write(json.dumps(results) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Largest a segment file grows to before a new one is started
+SEGMENT_SIZE = 64 * 2 ** 20
+# Seconds messages are collected for before being written and synced to disk in one go
+FLUSH_INTERVAL = 0.05
+# Bytes written to a segment between two entries of its offset index
+INDEX_INTERVAL = 4096
+# Number of the most recent messages read back into the rooms' histories at startup
+RECOVER_COUNT = 10000
+# Number of segment files kept, the oldest are deleted beyond it (0 keeps every segment)
+RETAIN_SEGMENTS = 16
+
+# Record header: CRC-32 of the room name and message, message length, room name length
+RECORD = struct.Struct('!IIH')
+# Offset index entry: record number relative to the segment's first record, byte position of the record
+INDEX_ENTRY = struct.Struct('!II')
+
+
+def encode_record(room, message):
+    """
+    Encodes one logged message.
+    :param room: name of the room the message was sent to
+    :param message: the message (bytes)
+    :return: the encoded record
+    """
+    data = room.encode('utf-8') + message
+    return RECORD.pack(zlib.crc32(data), len(message), len(data) - len(message)) + data
+
+
+def decode_record(view, position):
+    """
+    Decodes the record starting at a position of a segment.
+    :param view: the segment's contents (e.g. a memory map)
+    :param position: byte position of the record
+    :return: tuple of (room name, message, position of the next record), or None if no whole, intact record starts
+    there (the end of the segment, or a write cut short by a crash)
+    """
+    start = position + RECORD.size
+    if start > len(view):
+        return None
+    crc, message_length, room_length = RECORD.unpack_from(view, position)
+    end = start + room_length + message_length
+    if end > len(view):
+        return None
+    data = view[start:end]
+    if zlib.crc32(data) != crc:
+        return None
+    return data[:room_length].decode('utf-8'), data[room_length:], end
+
+
+class MessageLog:
+    """
+    Append-only on-disk log of the messages kept in room histories, so they survive a restart. The log is split into
+    segment files named after the number of their first record, each with a sparse offset index of record number ->
+    byte position. Appending only queues the message; a background thread writes everything queued once per flush
+    interval and syncs it to disk with a single fsync (group commit), keeping disk latency off the broadcast path.
+    Only the newest segments are kept, so the log takes at most about the retained segments' size on disk.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, flush_interval=FLUSH_INTERVAL,
+                 index_interval=INDEX_INTERVAL, retain_segments=RETAIN_SEGMENTS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.index_interval = index_interval
+        self.retain_segments = retain_segments
+        # Numbers of the first record of each segment, oldest first
+        self.bases = []
+        # Number the next written record will get
+        self.next_offset = 0
+        # Open files of the segment being written to and its index
+        self.segment = None
+        self.index = None
+        # Size of the segment being written to, and the position of its last indexed record
+        self.segment_position = 0
+        self.indexed_position = None
+        # (room name, message) pairs waiting to be written
+        self.pending = []
+        self.lock = threading.Lock()
+        # Serializes writing, so a flush on close cannot interleave with the flusher thread's
+        self.write_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.flusher = None
+
+    def segment_path(self, base):
+        """
+        Gets the path of a segment file.
+        :param base: number of the segment's first record
+        :return: the path
+        """
+        return os.path.join(self.directory, f'{base:020d}.log')
+
+    def index_path(self, base):
+        """
+        Gets the path of a segment's offset index file.
+        :param base: number of the segment's first record
+        :return: the path
+        """
+        return os.path.join(self.directory, f'{base:020d}.index')
+
+    def read_index(self, base):
+        """
+        Reads a segment's offset index.
+        :param base: number of the segment's first record
+        :return: list of (relative record number, byte position) entries
+        """
+        try:
+            with open(self.index_path(base), 'rb') as index:
+                data = index.read()
+        except FileNotFoundError:
+            return []
+        return list(INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]))
+
+    def open(self):
+        """
+        Opens the log for appending, creating it if needed and starting the flusher thread. Only the newest segment
+        is checked, from its last index entry on; a record cut short by a crash is cut off along with anything after
+        it.
+        :return:
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.bases = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                            if name.endswith('.log') and name[:-4].isdigit())
+        if not self.bases:
+            self.bases = [0]
+        # The limit may have been lowered since the log was last open
+        self.trim()
+        base = self.bases[-1]
+        path = self.segment_path(base)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        entries = [entry for entry in self.read_index(base) if entry[1] < size]
+        relative, position = entries[-1] if entries else (0, 0)
+        # Walk the records after the last index entry to find where the intact data ends
+        if position < size:
+            with open(path, 'rb') as segment, mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ) as view:
+                while True:
+                    record = decode_record(view, position)
+                    if record is None:
+                        break
+                    position = record[2]
+                    relative += 1
+        if position < size:
+            with open(path, 'r+b') as segment:
+                segment.truncate(position)
+        entries = [entry for entry in entries if entry[1] < position]
+        with open(self.index_path(base), 'wb') as index:
+            index.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+        self.next_offset = base + relative
+        self.segment_position = position
+        self.indexed_position = entries[-1][1] if entries else None
+        self.segment = open(path, 'ab')
+        self.index = open(self.index_path(base), 'ab')
+        self.stopping.clear()
+        self.flusher = threading.Thread(target=self.flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def tail(self, count):
+        """
+        Reads back the most recent records, memory-mapping only the segments they are in and starting from the
+        closest index entry, so startup does not parse the whole log.
+        :param count: the maximum number of records to read
+        :return: list of (room name, message) pairs, oldest first
+        """
+        start = max(self.bases[0], self.next_offset - count)
+        first = max(0, bisect.bisect_right(self.bases, start) - 1)
+        records = []
+        for base in self.bases[first:]:
+            path = self.segment_path(base)
+            size = self.segment_position if base == self.bases[-1] else os.path.getsize(path)
+            if size == 0:
+                continue
+            offset, position = base, 0
+            if base < start:
+                entries = self.read_index(base)
+                entry = bisect.bisect_right(entries, (start - base, size)) - 1
+                if entry >= 0:
+                    offset, position = base + entries[entry][0], entries[entry][1]
+            with open(path, 'rb') as segment, mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ) as view:
+                while position < size:
+                    record = decode_record(view, position)
+                    if record is None:
+                        break
+                    room, message, position = record
+                    if offset >= start:
+                        records.append((room, message))
+                    offset += 1
+        return records
+
+    def append(self, room, message):
+        """
+        Queues a message to be written with the next flush.
+        :param room: name of the room the message was sent to
+        :param message: the message (bytes)
+        :return:
+        """
+        with self.lock:
+            self.pending.append((room, message))
+
+    def flush_periodically(self):
+        """
+        Flushes the queued messages once per flush interval until the log is closed (runs on the flusher thread).
+        :return:
+        """
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every queued message and syncs them to disk.
+        :return:
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        if not pending:
+            return
+        with self.write_lock:
+            records = bytearray()
+            entries = bytearray()
+            for room, message in pending:
+                record = encode_record(room, message)
+                # Start a new segment once this one is full
+                if self.segment_position and self.segment_position + len(record) > self.segment_size:
+                    self.write(records, entries)
+                    records.clear()
+                    entries.clear()
+                    self.roll()
+                # Index the first record of a segment and then one record every index interval bytes
+                if (self.indexed_position is None
+                        or self.segment_position - self.indexed_position >= self.index_interval):
+                    entries += INDEX_ENTRY.pack(self.next_offset - self.bases[-1], self.segment_position)
+                    self.indexed_position = self.segment_position
+                records += record
+                self.segment_position += len(record)
+                self.next_offset += 1
+            self.write(records, entries)
+
+    def write(self, records, entries):
+        """
+        Writes records and index entries to the current segment and syncs them (index last, so it never points past
+        the data).
+        :param records: the encoded records
+        :param entries: the encoded index entries
+        :return:
+        """
+        self.segment.write(records)
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.index.write(entries)
+        self.index.flush()
+        os.fsync(self.index.fileno())
+
+    def roll(self):
+        """
+        Closes the current segment and starts a new one.
+        :return:
+        """
+        self.segment.close()
+        self.index.close()
+        self.bases.append(self.next_offset)
+        self.segment = open(self.segment_path(self.next_offset), 'ab')
+        self.index = open(self.index_path(self.next_offset), 'ab')
+        self.segment_position = 0
+        self.indexed_position = None
+        self.trim()
+
+    def trim(self):
+        """
+        Deletes the oldest segments (and their indexes) beyond the retention limit.
+        :return:
+        """
+        while 0 < self.retain_segments < len(self.bases):
+            base = self.bases.pop(0)
+            for path in (self.segment_path(base), self.index_path(base)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        """
+        Stops the flusher thread, writes anything still queued and closes the log.
+        :return:
+        """
+        if self.flusher is None:
+            return
+        self.stopping.set()
+        self.flusher.join()
+        self.flusher = None
+        self.flush()
+        self.segment.close()
+        self.index.close()
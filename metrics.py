@@ -0,0 +1,229 @@
+import bisect
+import http.server
+import threading
+
+# Upper bounds (in seconds) of the buckets latencies are counted in
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+# Upper bounds of the buckets counts (e.g. messages per write) are counted in
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Counter:
+    """
+    A value that only goes up, e.g. the number of connections accepted.
+    """
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        Adds to the counter.
+        :param amount: how much to add
+        :return:
+        """
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        """
+        Renders the counter in the Prometheus text format.
+        :return: list of lines
+        """
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter', f'{self.name} {self.value}']
+
+
+class Gauge:
+    """
+    A value read when the metrics are scraped (e.g. how many messages are waiting to be written), so keeping it costs
+    nothing in between.
+    """
+
+    def __init__(self, name, description, function):
+        self.name = name
+        self.description = description
+        # Function returning the current value
+        self.function = function
+
+    def render(self):
+        """
+        Renders the gauge in the Prometheus text format.
+        :return: list of lines
+        """
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} gauge', f'{self.name} {self.function()}']
+
+
+class Histogram:
+    """
+    Distribution of observed values (e.g. latencies), counted in fixed buckets.
+    """
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # Number of observations in each bucket (not cumulative), the last one for values above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Records one observed value.
+        :param value: the value
+        :return:
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self):
+        """
+        Renders the histogram in the Prometheus text format.
+        :return: list of lines
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_sum {total}')
+        lines.append(f'{self.name}_count {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Named collection of a process' metrics.
+    """
+
+    def __init__(self):
+        # Name -> metric, in the order they were added
+        self.metrics = {}
+
+    def counter(self, name, description):
+        """
+        Adds a counter (or gets the one already added under that name).
+        :param name: the metric's name
+        :param description: what the metric counts
+        :return: the Counter
+        """
+        return self.metrics.setdefault(name, Counter(name, description))
+
+    def gauge(self, name, description, function):
+        """
+        Adds a gauge, replacing any added under that name.
+        :param name: the metric's name
+        :param description: what the metric measures
+        :param function: function returning the current value
+        :return: the Gauge
+        """
+        gauge = self.metrics[name] = Gauge(name, description, function)
+        return gauge
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        """
+        Adds a histogram (or gets the one already added under that name).
+        :param name: the metric's name
+        :param description: what the metric measures
+        :param buckets: upper bounds of the histogram's buckets
+        :return: the Histogram
+        """
+        return self.metrics.setdefault(name, Histogram(name, description, buckets))
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text format.
+        :return: the metrics page
+        """
+        return '\n'.join(line for metric in list(self.metrics.values()) for line in metric.render()) + '\n'
+
+
+# The process' metrics
+metrics = MetricsRegistry()
+connections_accepted = metrics.counter('chat_connections_accepted_total', 'Connections accepted.')
+logins = metrics.counter('chat_logins_total', 'Users logged in.')
+login_seconds = metrics.histogram('chat_login_seconds', 'Time from accepting a connection to the user being logged in.')
+messages_received = metrics.counter('chat_messages_received_total', 'Messages received from users.')
+bytes_received = metrics.counter('chat_bytes_received_total', 'Bytes received from users.')
+messages_sent = metrics.counter('chat_messages_sent_total', 'Messages written to users.')
+bytes_sent = metrics.counter('chat_bytes_sent_total', 'Bytes written to users.')
+fan_out_seconds = metrics.histogram('chat_fan_out_seconds', 'Time taken to queue a room message for its members.')
+disconnects = metrics.counter('chat_disconnects_total', 'Users disconnected.')
+reads_paused = metrics.counter('chat_reads_paused_total', 'Times a connection was not read from for sending too fast.')
+accepts_paused = metrics.counter('chat_accepts_paused_total', 'Times new connections waited for arriving too fast.')
+idle_reaped = metrics.counter('chat_idle_reaped_total', 'Users disconnected for not answering heartbeats.')
+login_timeouts = metrics.counter('chat_login_timeouts_total', 'Connections closed for not logging in in time.')
+write_batch_messages = metrics.histogram('chat_write_batch_messages', 'Messages sent to a user in one write.',
+                                         COUNT_BUCKETS)
+compression_input_bytes = metrics.counter('chat_compression_input_bytes_total', 'Bytes of messages compressed.')
+compression_output_bytes = metrics.counter('chat_compression_output_bytes_total',
+                                           'Bytes the compressed messages took up on the wire.')
+compression_seconds = metrics.histogram('chat_compression_cpu_seconds', 'CPU time taken to compress one write.')
+tls_handshakes = metrics.counter('chat_tls_handshakes_total', 'TLS handshakes completed.')
+tls_resumed = metrics.counter('chat_tls_resumed_total', 'TLS handshakes that resumed an earlier session.')
+resumes = metrics.counter('chat_resumes_total', 'Reconnecting users sent only the messages they missed.')
+searches = metrics.counter('chat_searches_total', 'Pages of search results sent to users.')
+search_seconds = metrics.histogram('chat_search_seconds', 'Time taken to find a page of search results.')
+transfers = metrics.counter('chat_transfers_total', 'File transfers started.')
+transfers_completed = metrics.counter('chat_transfers_completed_total', 'File transfers written to every recipient.')
+transfer_bytes = metrics.counter('chat_transfer_bytes_total', 'Bytes of files relayed between users.')
+takeovers = metrics.counter('chat_takeovers_total', 'Stale connections replaced by their user reconnecting.')
+
+
+def watch_registry(registry):
+    """
+    Adds the gauges read from the connected users: how many there are and how far behind their outbound queues are.
+    :param registry: the server's UserRegistry
+    :return:
+    """
+    def queue_depths():
+        return [len(user.outbound.items) for user in registry.snapshot()]
+
+    metrics.gauge('chat_users', 'Users logged in.', lambda: len(registry))
+    metrics.gauge('chat_outbound_queued', 'Messages waiting to be written, over all users.',
+                  lambda: sum(queue_depths()))
+    metrics.gauge('chat_outbound_queue_max', "Messages waiting to be written to the furthest behind user.",
+                  lambda: max(queue_depths(), default=0))
+    metrics.gauge('chat_outbound_dropped', 'Messages dropped or coalesced for slow users still connected.',
+                  lambda: sum(user.outbound.dropped for user in registry.snapshot()))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the metrics page at any path.
+    """
+
+    def do_GET(self):
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+def serve_metrics(host, port):
+    """
+    Serves the metrics over HTTP from a background thread.
+    :param host: the host IP to bind to
+    :param port: the port number to bind to
+    :return: the running HTTP server
+    """
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
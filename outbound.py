@@ -0,0 +1,198 @@
+import collections
+import threading
+
+# Maximum number of frames waiting to be written to one client
+QUEUE_SIZE = 256
+# What to do when a client's queue is full:
+# 'drop' discards the new message, 'coalesce' replaces superseded messages (e.g. older user lists) and otherwise
+# discards the oldest waiting message, 'disconnect' closes the slow client's connection
+SLOW_CONSUMER_POLICIES = ('drop', 'coalesce', 'disconnect')
+SLOW_CONSUMER_POLICY = 'drop'
+# Bytes of bulk data (file chunks) written to a client in one go, before checking for chat messages again
+BULK_WRITE_SIZE = 64 * 1024
+
+
+class OutboundQueue:
+    """
+    Bounded queue of framed messages waiting to be written to one client. Senders only ever append to it, the
+    client's own writer drains it, so a slow receiver never holds up whoever is sending. Bulk data (file chunks) waits
+    in a lane of its own, which the writer only takes from a little at a time after the messages, so a file being
+    sent does not hold up chat; it is not bounded here, its senders only send as much as they are allowed to.
+    """
+
+    def __init__(self, size=QUEUE_SIZE, policy=SLOW_CONSUMER_POLICY, wakeup=None, on_overflow=None):
+        self.size = size
+        self.policy = policy
+        # Called after a frame is queued (used by the asyncio server to wake the client's writer task)
+        self.wakeup = wakeup
+        # Called once if the 'disconnect' policy gives up on the client (its writer may be stuck mid-write, so this
+        # should break the connection rather than wait for the writer)
+        self.on_overflow = on_overflow
+        # Waiting [frame, key] items, oldest first
+        self.items = collections.deque()
+        # Coalescing key -> waiting item, so a newer message can replace the one it supersedes in place
+        self.keyed = {}
+        # Waiting (list of buffers, function called once they are written) bulk items, oldest first
+        self.bulk = collections.deque()
+        self.lock = threading.Lock()
+        # Signalled whenever there is something for the writer to do
+        self.ready = threading.Condition(self.lock)
+        # Set once the queue stops accepting frames (client leaving, or disconnected for being too slow)
+        self.closed = False
+        # Whether the queue was closed because its client could not keep up
+        self.overflowed = False
+        # Number of frames discarded because the client could not keep up
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, frame, key=None):
+        """
+        Queues a frame for the client, applying the slow consumer policy if the queue is full.
+        :param frame: the framed message (the same buffer can be shared by every client's queue)
+        :param key: optional coalescing key, a newer frame replaces a waiting frame with the same key
+        :return: True if the frame was queued, else False
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            # Replace the superseded message rather than queueing another
+            if key is not None and self.policy == 'coalesce':
+                item = self.keyed.get(key)
+                if item is not None:
+                    item[0] = frame
+                    return True
+            # Client is not keeping up
+            if len(self.items) >= self.size:
+                if self.policy == 'drop':
+                    self.dropped += 1
+                    return False
+                elif self.policy == 'coalesce':
+                    self.dropped += 1
+                    oldest = self.items.popleft()
+                    if oldest[1] is not None and self.keyed.get(oldest[1]) is oldest:
+                        del self.keyed[oldest[1]]
+                else:
+                    self.closed = True
+                    self.overflowed = True
+                    self.ready.notify()
+            if not self.overflowed:
+                item = [frame, key]
+                self.items.append(item)
+                if key is not None:
+                    self.keyed[key] = item
+                self.ready.notify()
+        if self.overflowed:
+            if self.on_overflow is not None:
+                self.on_overflow()
+            self.notify_writer()
+            return False
+        self.notify_writer()
+        return True
+
+    def put_bulk(self, buffers, on_written=None):
+        """
+        Queues bulk data for the client.
+        :param buffers: list of buffers making up the data (written as they are, without joining them)
+        :param on_written: optional function called once the data has been written
+        :return: True if the data was queued, else False
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            self.bulk.append((buffers, on_written))
+            self.ready.notify()
+        self.notify_writer()
+        return True
+
+    def take_bulk(self, limit=BULK_WRITE_SIZE):
+        """
+        Removes the oldest waiting bulk items, at least one and no more than a write's worth beyond that.
+        :param limit: bytes worth writing in one go
+        :return: list of (list of buffers, function to call once written) items, oldest first
+        """
+        items = []
+        size = 0
+        with self.lock:
+            # Once the queue is closed, bulk data is no longer sent (its transfer is resumed or given up on)
+            while self.bulk and not self.closed and (not items or size < limit):
+                item = self.bulk.popleft()
+                items.append(item)
+                size += sum(len(buffer) for buffer in item[0])
+        return items
+
+    def notify_writer(self):
+        """
+        Wakes the client's writer task, if one is registered.
+        :return:
+        """
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def take_all(self):
+        """
+        Removes every waiting frame from the queue.
+        :return: list of frames, oldest first
+        """
+        with self.lock:
+            return self.take_locked()
+
+    def take_locked(self):
+        """
+        Removes every waiting frame from the queue (caller holds the lock).
+        :return: list of frames, oldest first
+        """
+        frames = [item[0] for item in self.items]
+        self.items.clear()
+        self.keyed.clear()
+        return frames
+
+    def wait_all(self):
+        """
+        Blocks until there are frames or bulk data waiting or the queue is closed, then removes every waiting frame
+        (leaving the bulk data for take_bulk()).
+        :return: list of frames, oldest first (empty once the queue is closed and drained, or if only bulk data waits)
+        """
+        with self.ready:
+            while not self.items and not self.bulk and not self.closed:
+                self.ready.wait()
+            return self.take_locked()
+
+    def close(self):
+        """
+        Stops the queue from accepting frames and wakes the writer so it can finish (bulk data still waiting is
+        dropped).
+        :return:
+        """
+        with self.lock:
+            self.closed = True
+            self.bulk.clear()
+            self.ready.notify()
+        self.notify_writer()
+
+
+def fan_out(frame, queues, key=None):
+    """
+    Queues one already-framed message for every given client.
+    :param frame: the framed message, shared by all the queues
+    :param queues: iterable of OutboundQueues to put the frame on
+    :param key: optional coalescing key
+    :return: the number of queues that accepted the frame
+    """
+    delivered = 0
+    for queue in queues:
+        if queue.put(frame, key):
+            delivered += 1
+    return delivered
+
+
+def bulk_written(items):
+    """
+    Reports bulk items as written.
+    :param items: list of (list of buffers, function to call once written) items, from take_bulk()
+    :return:
+    """
+    for _, on_written in items:
+        if on_written is not None:
+            on_written()
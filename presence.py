@@ -0,0 +1,86 @@
+import threading
+
+from protocol import OP_PRESENCE, OP_USER_LIST, encode_envelope, encode_frame
+
+# Seconds presence changes are collected for before being sent, so a burst of joins and leaves goes out as one delta
+PRESENCE_WINDOW = 0.05
+
+
+def user_list_snapshot(usernames):
+    """
+    Builds the full user list sent to a user when they enter a room.
+    :param usernames: the usernames in the room
+    :return: the USER_LIST envelope
+    """
+    return encode_envelope(OP_USER_LIST, body=' '.join(usernames))
+
+
+def presence_delta(changes):
+    """
+    Builds the message telling a room's members who joined ('+name') and who left ('-name').
+    :param changes: dict of username -> True if now present, False if gone
+    :return: the PRESENCE envelope
+    """
+    return encode_envelope(OP_PRESENCE, body=' '.join([('+' if present else '-') + username
+                                                       for username, present in changes.items()]))
+
+
+class PresenceTracker:
+    """
+    Collects the users joining and leaving each room and periodically sends each room a single delta. Each user's
+    latest state wins, so someone who joins and leaves within one window costs one entry rather than two messages,
+    and applying a delta on top of any snapshot taken during the window gives the right list.
+    """
+
+    def __init__(self, schedule, window=PRESENCE_WINDOW):
+        # Function called with (delay, callback) to run the callback later
+        self.schedule = schedule
+        self.window = window
+        # Room -> (username -> present) changes waiting to be sent
+        self.pending = {}
+        self.lock = threading.Lock()
+        # Whether a flush is already scheduled
+        self.scheduled = False
+
+    def changed(self, room, username, present):
+        """
+        Records a user joining or leaving a room.
+        :param room: the Room joined or left
+        :param username: the user's username
+        :param present: True if the user joined, False if they left
+        :return:
+        """
+        with self.lock:
+            self.pending.setdefault(room, {})[username] = present
+            if self.scheduled:
+                return
+            self.scheduled = True
+        if self.window > 0:
+            self.schedule(self.window, self.flush)
+        else:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends each room with pending changes a single delta.
+        :return:
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.scheduled = False
+        # Not kept in history, presence only matters to the users currently in the room
+        for room, changes in pending.items():
+            room.publish(encode_frame(presence_delta(changes)))
+
+
+def schedule_with_timer(delay, callback):
+    """
+    Runs a callback after a delay on a timer thread (used by the threaded server).
+    :param delay: seconds to wait
+    :param callback: the function to call
+    :return:
+    """
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
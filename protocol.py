@@ -0,0 +1,343 @@
+import collections
+import json
+import struct
+import zlib
+
+# Every message on the wire is preceded by a header holding the payload's length (4-byte unsigned, big-endian)
+HEADER = struct.Struct('!I')
+# Largest payload a peer is allowed to announce before the connection is considered broken
+MAX_FRAME_SIZE = 1024 * 1024
+# Largest FILE_CHUNK payload accepted, whatever the limit on other messages (file data comes in chunks well below it)
+MAX_CHUNK_FRAME_SIZE = 128 * 1024
+# Set in a frame's length header when its payload is compressed, inflating to further frames (only sent to clients
+# that asked for compression)
+COMPRESSED = 0x80000000
+
+# Every payload is an envelope: opcode, the byte lengths of the sender, target and color fields, the time the message
+# was sent (milliseconds since the epoch, 0 if not stamped) and its sequence number in its room's history (0 if not
+# recorded there), followed by those fields and the body (the rest of the payload), all UTF-8
+ENVELOPE = struct.Struct('!BHHBQI')
+# The sequence number ends the fixed part of an envelope, so it can be set without decoding the envelope
+SEQUENCE = struct.Struct('!I')
+SEQUENCE_OFFSET = ENVELOPE.size - SEQUENCE.size
+# A FILE_CHUNK body starts with the transfer id and the offset into the file of the bytes that follow it
+CHUNK = struct.Struct('!IQ')
+
+# Opcodes sent by the server
+OP_REQUEST_USERNAME = 1
+OP_VALID_USERNAME = 2
+OP_INVALID_USERNAME = 3
+# Room the user was placed in (body: the room's name)
+OP_ROOM = 4
+# Everyone in the user's room (body: the usernames, space separated)
+OP_USER_LIST = 5
+# Users who joined or left the room since the last update (body: '+name' and '-name', space separated)
+OP_PRESENCE = 6
+# Start and end of a page of history (body of the start: the sequence number of the page's first message)
+OP_HISTORY_PAGE = 7
+OP_HISTORY_END = 8
+# Login finished (body: the notice to display)
+OP_CONNECTED = 9
+# Someone joined or left the room (sender: the user, body: the notice to display)
+OP_JOINED = 10
+OP_LEFT = 11
+# Opcodes sent by both sides: a message to the room, and a private message to the target user (sent by the server
+# with the sender, color and the text to display as the body)
+OP_CHAT = 12
+OP_DIRECT = 13
+# Opcodes sent by the client
+# Log in (sender: the chosen username, left empty to give up)
+OP_LOGIN = 14
+# Change the color of the user's messages (color: the new color)
+OP_SET_COLOR = 15
+# Move to a room (body: the room's name), or back to the default room
+OP_JOIN_ROOM = 16
+OP_LEAVE_ROOM = 17
+# Ask for the page of history before a sequence number (body: the sequence number)
+OP_REQUEST_HISTORY = 18
+# Heartbeat: the server checks on a quiet connection, the client answers
+OP_PING = 19
+OP_PONG = 20
+# Search the user's room for chat messages (body: the words to search for and any filters, see
+# search.parse_search_request), answered by a page of results: its start (body: the sequence number to search before
+# for the next page, empty if there are no more), the matching messages newest first and its end
+OP_SEARCH = 21
+OP_SEARCH_RESULTS = 22
+OP_SEARCH_END = 23
+# File transfers (see transfers.py), sent by both sides, the server filling in the sender of what it relays.
+# Offer a file to a user, or to the sender's room without a target (body: '<id> <size> <name>'); offering it again
+# after reconnecting resumes the transfer
+OP_FILE_OFFER = 24
+# Take an offered file (target: the user offering it, body: '<id> <offset>', the offset being how much of the file was
+# already received when resuming)
+OP_FILE_ACCEPT = 25
+# How far into a file its sender may send (body: '<id> <limit>', followed by ' <offset>' when the sender has to carry
+# on from an earlier offset)
+OP_FILE_CREDIT = 26
+# Part of a file (body: the CHUNK header followed by the file's bytes, left undecoded)
+OP_FILE_CHUNK = 27
+# A transfer finished (target: the user offering the file, body: '<id> <reason>'), or was given up on by either side
+OP_FILE_END = 28
+
+# Opcode -> name, used by the JSON encoding
+OP_NAMES = {value: name[3:] for name, value in globals().items() if name.startswith('OP_')}
+OP_CODES = {name: value for value, name in OP_NAMES.items()}
+# Type each field of a JSON envelope must have (besides its opcode)
+JSON_FIELD_TYPES = {'sender': str, 'target': str, 'color': str, 'body': str, 'time': int, 'sequence': int}
+
+# Whether envelopes are sent as JSON instead of the compact binary encoding (for debugging; receivers accept both)
+json_envelopes = False
+
+
+class FrameError(ValueError):
+    """
+    Raised when a peer sends a frame that cannot be decoded (e.g. one larger than the allowed maximum).
+    """
+
+
+def encode_frame(message):
+    """
+    Frames a single message for sending.
+    :param message: the message to frame (str messages are encoded as UTF-8)
+    :return: the framed bytes
+    """
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    return HEADER.pack(len(message)) + message
+
+
+def encode_frames(messages):
+    """
+    Frames several messages into one buffer so they can be written with a single send.
+    :param messages: iterable of messages to frame
+    :return: the framed bytes
+    """
+    return b''.join([encode_frame(message) for message in messages])
+
+
+class Envelope:
+    """
+    A decoded message: what it is (its opcode) and who and what it concerns.
+    """
+    __slots__ = ('op', 'sender', 'target', 'color', 'body', 'time', 'sequence')
+
+    def __init__(self, op, sender='', target='', color='', body='', time=0, sequence=0):
+        self.op = op
+        self.sender = sender
+        self.target = target
+        self.color = color
+        self.body = body
+        # Milliseconds since the epoch the message was sent at (0 if not stamped), for clients rendering it themselves
+        self.time = time
+        # Position of the message in its room's history (0 if it is not recorded there), for clients to resume from
+        self.sequence = sequence
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__[1:] if getattr(self, name))
+        return f'Envelope({OP_NAMES.get(self.op, self.op)}{", " if fields else ""}{fields})'
+
+
+def encode_envelope(op, sender='', target='', color='', body='', time=0):
+    """
+    Encodes a message as an envelope, ready to be framed.
+    :param op: the message's opcode
+    :param sender: username of the user the message is from
+    :param target: username of the user the message is for
+    :param color: color the message is displayed in
+    :param body: the message's text
+    :param time: milliseconds since the epoch the message was sent at (0 to not stamp it)
+    :return: the encoded envelope
+    """
+    if json_envelopes:
+        fields = {'op': OP_NAMES[op], 'sender': sender, 'target': target, 'color': color, 'body': body, 'time': time}
+        return json.dumps({name: value for name, value in fields.items() if value}).encode('utf-8')
+    sender = sender.encode('utf-8')
+    target = target.encode('utf-8')
+    color = color.encode('utf-8')
+    return b''.join((ENVELOPE.pack(op, len(sender), len(target), len(color), time, 0), sender, target, color,
+                     body.encode('utf-8')))
+
+
+def stamp_sequence(message, sequence):
+    """
+    Sets the sequence number of an encoded envelope, keeping its encoding.
+    :param message: the encoded envelope
+    :param sequence: the message's sequence number in its room's history
+    :return: the stamped envelope
+    """
+    if message[:1] == b'{':
+        fields = json.loads(message)
+        fields['sequence'] = sequence
+        return json.dumps(fields).encode('utf-8')
+    return b''.join((message[:SEQUENCE_OFFSET], SEQUENCE.pack(sequence), message[ENVELOPE.size:]))
+
+
+def decode_envelope(payload):
+    """
+    Decodes a received envelope, in either encoding (JSON envelopes start with '{', which is no opcode).
+    :param payload: the frame's payload
+    :return: the Envelope
+    """
+    try:
+        if payload[:1] == b'{':
+            fields = json.loads(payload)
+            op = OP_CODES[fields.pop('op')]
+            # File data only travels in the binary encoding
+            if op == OP_FILE_CHUNK:
+                raise FrameError('file chunks cannot be sent as JSON')
+            for name, value in fields.items():
+                if type(value) is not JSON_FIELD_TYPES.get(name):
+                    raise FrameError(f'bad {name!r} field')
+            return Envelope(op, **fields)
+        op, sender_length, target_length, color_length, sent, sequence = ENVELOPE.unpack_from(payload)
+        target_start = ENVELOPE.size + sender_length
+        color_start = target_start + target_length
+        body_start = color_start + color_length
+        fields = [payload[ENVELOPE.size:target_start], payload[target_start:color_start],
+                  payload[color_start:body_start]]
+        if body_start <= len(payload):
+            sender, target, color = [field.decode('utf-8') for field in fields]
+            # File data is left as a view into the frame, relaying it is all the server does with it
+            if op == OP_FILE_CHUNK:
+                body = memoryview(payload)[body_start:]
+            else:
+                body = payload[body_start:].decode('utf-8')
+            return Envelope(op, sender, target, color, body, sent, sequence)
+    except (struct.error, ValueError, KeyError, TypeError) as error:
+        raise FrameError(f'malformed envelope: {error}') from error
+    raise FrameError('envelope fields run past the end of the frame')
+
+
+def encode_chunk_header(sender, target, transfer_id, offset, length):
+    """
+    Builds a FILE_CHUNK frame up to its file data, which is sent straight after it rather than copied into the frame.
+    Chunks always use the binary encoding.
+    :param sender: username of the user sending the file
+    :param target: username of the user the file is for ('' for the sender's room)
+    :param transfer_id: the transfer's id
+    :param offset: offset into the file of the chunk's data
+    :param length: number of bytes of file data that follow
+    :return: the frame's length header, envelope and chunk header
+    """
+    sender = sender.encode('utf-8')
+    target = target.encode('utf-8')
+    size = ENVELOPE.size + len(sender) + len(target) + CHUNK.size + length
+    return b''.join((HEADER.pack(size), ENVELOPE.pack(OP_FILE_CHUNK, len(sender), len(target), 0, 0, 0), sender, target,
+                     CHUNK.pack(transfer_id, offset)))
+
+
+def decode_chunk(envelope):
+    """
+    Splits a FILE_CHUNK envelope's body into its chunk header and file data.
+    :param envelope: the FILE_CHUNK envelope
+    :return: tuple of (transfer id, offset, memoryview of the data)
+    """
+    if not isinstance(envelope.body, (bytes, bytearray, memoryview)):
+        raise FrameError('malformed chunk: body is not binary')
+    try:
+        transfer_id, offset = CHUNK.unpack_from(envelope.body)
+    except struct.error as error:
+        raise FrameError(f'malformed chunk: {error}') from error
+    return transfer_id, offset, envelope.body[CHUNK.size:]
+
+
+class FrameDecoder:
+    """
+    Streaming decoder that turns arbitrary chunks of received bytes back into whole messages, handling both partial
+    frames and several frames arriving in one read.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, decompressor=None, max_chunk_size=MAX_CHUNK_FRAME_SIZE):
+        # Bytes received but not yet part of a complete frame
+        self.buffer = bytearray()
+        # Complete payloads waiting to be collected
+        self.frames = collections.deque()
+        self.max_frame_size = max_frame_size
+        self.max_chunk_size = max(max_frame_size, max_chunk_size)
+        # zlib stream inflating compressed frames, and the decoder splitting what it inflates back into frames (None
+        # where the peer may not send compressed frames)
+        self.decompressor = decompressor
+        self.inflated = FrameDecoder(max_frame_size) if decompressor is not None else None
+
+    def feed(self, data):
+        """
+        Adds received bytes to the decoder, splitting off every frame they complete.
+        :param data: the bytes received from the socket
+        :return: the number of complete frames now waiting
+        """
+        buffer = self.buffer
+        buffer += data
+        offset = 0
+        end = len(buffer)
+        # Split off as many whole frames as the buffer holds, through a view so each frame is copied out only once
+        # (the view is released before the buffer is trimmed)
+        with memoryview(buffer) as view:
+            while end - offset >= HEADER.size:
+                (length,) = HEADER.unpack_from(buffer, offset)
+                compressed = length & COMPRESSED
+                length &= ~COMPRESSED
+                start = offset + HEADER.size
+                if length > self.max_frame_size:
+                    # Only file chunks may be larger, which takes the frame's opcode (its first byte) to tell
+                    if length <= self.max_chunk_size and end == start:
+                        break
+                    if length > self.max_chunk_size or compressed or buffer[start] != OP_FILE_CHUNK:
+                        raise FrameError(f'frame of {length} bytes exceeds maximum of {self.max_frame_size}')
+                if compressed and self.decompressor is None:
+                    raise FrameError('compressed frame received without compression negotiated')
+                if end - start < length:
+                    break
+                if compressed:
+                    self.inflate(view[start:start + length])
+                else:
+                    self.frames.append(bytes(view[start:start + length]))
+                offset = start + length
+        # Drop consumed bytes once per feed rather than once per frame
+        if offset:
+            del buffer[:offset]
+        return len(self.frames)
+
+    def inflate(self, payload):
+        """
+        Inflates a compressed frame, queueing the frames it held.
+        :param payload: the compressed frame's payload
+        :return:
+        """
+        try:
+            data = self.decompressor.decompress(payload)
+        except zlib.error as error:
+            raise FrameError(f'malformed compressed frame: {error}') from error
+        self.inflated.feed(data)
+        self.frames.extend(self.inflated.frames)
+        self.inflated.frames.clear()
+
+    def next_frame(self):
+        """
+        Collects the oldest complete frame.
+        :return: the frame's payload, or None if no complete frame has been received
+        """
+        if self.frames:
+            return self.frames.popleft()
+        return None
+
+
+def receive_message(sock, decoder, chunk_size=65536, on_data=None):
+    """
+    Blocks until a whole message has been received on the given socket.
+    :param sock: the socket to receive from
+    :param decoder: the FrameDecoder holding the socket's partially received data
+    :param chunk_size: the maximum number of bytes to read per recv call
+    :param on_data: optional function called with the size of each chunk received (e.g. to count bytes)
+    :return: the decoded Envelope, or None if the connection was closed
+    """
+    frame = decoder.next_frame()
+    while frame is None:
+        data = sock.recv(chunk_size)
+        # Peer closed the connection
+        if not data:
+            return None
+        if on_data is not None:
+            on_data(len(data))
+        decoder.feed(data)
+        frame = decoder.next_frame()
+    return decode_envelope(frame)
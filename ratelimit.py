@@ -0,0 +1,107 @@
+import threading
+import time
+
+# Rates are per second, a rate of 0 turns its limit off
+# Messages one user may send per second on average, and how many they may send in a burst above that
+MESSAGE_RATE = 5.0
+MESSAGE_BURST = 20
+# Messages every connection from one IP address may send together per second, and their burst
+ADDRESS_RATE = 20.0
+ADDRESS_BURST = 60
+# Connections accepted per second, and how many may arrive in a burst above that
+ACCEPT_RATE = 200.0
+ACCEPT_BURST = 500
+# Largest message (in bytes) a client may send, a client sending a larger one is disconnected
+MAX_MESSAGE_SIZE = 16 * 1024
+
+
+class TokenBucket:
+    """
+    Token bucket allowing an average rate of events with bursts of up to the bucket's size. Taking a token never
+    refuses the event; once the bucket is empty the balance goes negative and the caller is told how long to wait for
+    it to refill, so a caller that stops reading for that long is paced to the rate without anything being buffered.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        # Tokens added per second, and the most the bucket holds
+        self.rate = rate
+        self.burst = burst
+        # Function returning the current time in seconds
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def take(self, count=1):
+        """
+        Takes tokens from the bucket.
+        :param count: number of tokens to take
+        :return: seconds to wait before the next event is allowed (0 if the bucket is not empty)
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - count
+            self.updated = now
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class AddressBuckets:
+    """
+    Token buckets shared by every connection from the same IP address, kept only while the address has connections.
+    """
+
+    def __init__(self, rate=ADDRESS_RATE, burst=ADDRESS_BURST):
+        self.rate = rate
+        self.burst = burst
+        # IP address -> [TokenBucket, number of connections using it]
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, address):
+        """
+        Gets the bucket for a new connection from an address.
+        :param address: the connection's IP address
+        :return: the address' TokenBucket
+        """
+        with self.lock:
+            entry = self.buckets.get(address)
+            if entry is None:
+                entry = self.buckets[address] = [TokenBucket(self.rate, self.burst), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, address):
+        """
+        Gives up a closed connection's use of its address' bucket.
+        :param address: the connection's IP address
+        :return:
+        """
+        with self.lock:
+            entry = self.buckets.get(address)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.buckets[address]
+
+
+class FloodControl:
+    """
+    Limits how fast one connection may send: its own bucket and the bucket it shares with its IP address are both
+    charged for every message, and the connection must wait for the slower of the two.
+    """
+    __slots__ = ('user', 'address')
+
+    def __init__(self, user, address):
+        # The connection's own TokenBucket
+        self.user = user
+        # TokenBucket shared with the other connections from the same IP address
+        self.address = address
+
+    def take(self):
+        """
+        Charges both buckets for one message.
+        :return: seconds the connection should stop reading for (0 if it is within its limits)
+        """
+        return max(self.user.take(), self.address.take())
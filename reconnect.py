@@ -0,0 +1,102 @@
+import hmac
+import random
+import secrets
+
+# Random bytes in a resume token
+RESUME_TOKEN_BYTES = 16
+# Seconds the first reconnection attempt may wait, doubling with every failed attempt up to the maximum
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+# Times a reconnecting client tries to reclaim its username (while the server drops its stale connection) before
+# logging in afresh
+RESUME_ATTEMPTS = 5
+
+
+def new_token():
+    """
+    Creates the token a user presents to take their username back from a stale connection when reconnecting.
+    :return: the token
+    """
+    return secrets.token_urlsafe(RESUME_TOKEN_BYTES)
+
+
+def valid_token(user, token):
+    """
+    Checks the resume token a reconnecting user presented against the one their connection was given.
+    :param user: UserRecord holding the username (None if nobody does)
+    :param token: the presented token (None if none was)
+    :return: True if the token is the user's, else False
+    """
+    return token is not None and user is not None and user.token is not None and hmac.compare_digest(user.token, token)
+
+
+def login_body(features, **options):
+    """
+    Builds the body of a LOGIN or VALID_USERNAME envelope: the optional features asked for or granted, then any
+    options as name=value pairs, space separated.
+    :param features: list of feature names
+    :param options: option values (None values are left out)
+    :return: the body
+    """
+    return ' '.join([*features, *[f'{name}={value}' for name, value in options.items() if value is not None]])
+
+
+def parse_login_body(body):
+    """
+    Splits the body of a LOGIN or VALID_USERNAME envelope into its features and options.
+    :param body: the envelope's body
+    :return: tuple of (set of feature names, dict of option name -> value)
+    """
+    features = set()
+    options = {}
+    for word in body.split():
+        name, equals, value = word.partition('=')
+        if equals:
+            options[name] = value
+        else:
+            features.add(word)
+    return features, options
+
+
+def resume_point(options):
+    """
+    Gets the sequence number a reconnecting client asked to resume after.
+    :param options: the LOGIN envelope's options
+    :return: the sequence number, or None if the client is not resuming (or sent a malformed one)
+    """
+    try:
+        return int(options['after'])
+    except (KeyError, ValueError):
+        return None
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter: each delay is picked at random between 0 and a cap that doubles with every
+    failed attempt. Clients that all lost their connection at once (e.g. when the server restarted) spread their
+    attempts out instead of reconnecting in waves.
+    """
+
+    def __init__(self, delay=RECONNECT_DELAY, max_delay=RECONNECT_MAX_DELAY, rng=random):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.rng = rng
+        # Failed attempts since the last successful one
+        self.attempts = 0
+
+    def next_delay(self):
+        """
+        Gets how long to wait before the next attempt.
+        :return: the delay in seconds
+        """
+        # (the exponent stops growing long after the cap is reached, so it cannot overflow)
+        cap = min(self.max_delay, self.delay * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return self.rng.uniform(0, cap)
+
+    def reset(self):
+        """
+        Starts over from the shortest delay, after a successful attempt.
+        :return:
+        """
+        self.attempts = 0
@@ -0,0 +1,127 @@
+import threading
+
+# Number of independently locked shards the registry is split into
+SHARD_COUNT = 16
+# Longest username that may be logged in with
+MAX_USERNAME_LENGTH = 32
+
+
+class UserRecord:
+    """
+    Everything the server keeps about one logged in user.
+    """
+    __slots__ = ('username', 'connection', 'color', 'outbound', 'decoder', 'room', 'address', 'flood', 'last_seen',
+                 'token')
+
+    def __init__(self, username, connection, outbound, decoder, color='black', address=None, flood=None, token=None):
+        self.username = username
+        # The user's socket (threaded server) or stream writer (asyncio server)
+        self.connection = connection
+        # IP address the user connected from
+        self.address = address
+        # FloodControl limiting how fast the user may send
+        self.flood = flood
+        # time.monotonic() reading from when the user was last heard from
+        self.last_seen = 0
+        # Text color the user picked for their messages
+        self.color = color
+        # OutboundQueue of messages waiting to be written to the user
+        self.outbound = outbound
+        # FrameDecoder holding the user's partially received data
+        self.decoder = decoder
+        # Room the user is currently in
+        self.room = None
+        # Resume token the user was given at login, to take their username back from this connection if it goes stale
+        self.token = token
+
+
+class UserRegistry:
+    """
+    Thread-safe mapping of usernames to UserRecords. Users are spread over several shards, each with its own lock,
+    so logins, lookups and removals for different users rarely wait on each other.
+    """
+
+    def __init__(self, shard_count=SHARD_COUNT):
+        # List of (username -> UserRecord dict, lock guarding it)
+        self.shards = [({}, threading.Lock()) for _ in range(shard_count)]
+
+    def __len__(self):
+        return sum(len(users) for users, _ in self.shards)
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def shard(self, username):
+        """
+        Gets the shard a username belongs to.
+        :param username: the username
+        :return: tuple of (username -> UserRecord dict, lock guarding it)
+        """
+        return self.shards[hash(username) % len(self.shards)]
+
+    def reserve(self, record):
+        """
+        Adds a user, unless their username is already taken. The check and the insert happen under one lock, so two
+        users logging in with the same name cannot both succeed.
+        :param record: the UserRecord to add
+        :return: True if the username was free and is now reserved, else False
+        """
+        users, lock = self.shard(record.username)
+        with lock:
+            if record.username in users:
+                return False
+            users[record.username] = record
+            return True
+
+    def get(self, username):
+        """
+        Looks up a user.
+        :param username: the username to look up
+        :return: the user's UserRecord, or None if they are not connected
+        """
+        users, lock = self.shard(username)
+        with lock:
+            return users.get(username)
+
+    def remove(self, username, record=None):
+        """
+        Removes a user.
+        :param username: the username to remove
+        :param record: the UserRecord to remove, if only that one should be (not one that has since taken over the
+        username)
+        :return: the removed UserRecord, or None if they were already gone
+        """
+        users, lock = self.shard(username)
+        with lock:
+            if record is not None and users.get(username) is not record:
+                return None
+            return users.pop(username, None)
+
+    def snapshot(self):
+        """
+        Copies the current users so they can be iterated (e.g. to fan out a message) while others log in and out.
+        :return: list of UserRecords
+        """
+        records = []
+        for users, lock in self.shards:
+            with lock:
+                records.extend(users.values())
+        return records
+
+    def usernames(self):
+        """
+        Gets the usernames of the current users.
+        :return: list of usernames
+        """
+        return [record.username for record in self.snapshot()]
+
+
+def valid_username(username):
+    """
+    Checks whether a username can be logged in with. User lists are sent space separated, and presence updates put
+    a '+' or '-' in front of each username, so usernames hold no whitespace and do not start with either.
+    :param username: the requested username
+    :return: True if the username is usable, else False
+    """
+    return (0 < len(username) <= MAX_USERNAME_LENGTH and username.isprintable() and username[0] not in '+-' and
+            not any(character.isspace() for character in username))
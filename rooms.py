@@ -0,0 +1,200 @@
+import threading
+import time
+
+from history import HISTORY_SIZE, ChatHistory
+from metrics import fan_out_seconds, search_seconds
+from outbound import fan_out
+from protocol import decode_envelope, encode_frame, stamp_sequence
+from search import SEARCH_PAGE_SIZE, search_page
+
+# Room every user is placed in when they log in (and returned to when they leave a room)
+DEFAULT_ROOM = 'lobby'
+# Longest room name a user may pick
+MAX_ROOM_NAME_LENGTH = 32
+
+
+class Room:
+    """
+    A named chat room with its own members and history, so messages only cost as much as the room they are sent to.
+    """
+
+    def __init__(self, name, history_size=HISTORY_SIZE, log=None):
+        self.name = name
+        # Members of the room (username -> UserRecord)
+        self.members = {}
+        # Usernames of the room's members logged in on other worker processes (multi-process mode only)
+        self.remote_members = set()
+        # Messages sent to the room
+        self.history = ChatHistory(history_size)
+        # MessageLog the room's history is also written to (None to keep it in memory only)
+        self.log = log
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.members)
+
+    def publish(self, frame, message=None, key=None):
+        """
+        Queues a framed message for every member of the room, recording it in the room's history. Both happen under
+        the room's lock, so the history's order is the order members receive messages in, and a member joining gets
+        each message either in their history replay or live, never both or neither. A recorded message is stamped with
+        its sequence number in the history (and framed again), so clients know where to resume from.
+        :param frame: the framed message (None when recording it, it is framed once stamped)
+        :param message: the unframed message to record in the history (None to not record it)
+        :param key: optional coalescing key
+        :return: the number of members the message was queued for
+        """
+        with self.lock:
+            if message is not None:
+                message = stamp_sequence(message, self.history.next_sequence)
+                frame = encode_frame(message)
+                self.history.append(message)
+                if self.log is not None:
+                    self.log.append(self.name, message)
+            start = time.perf_counter()
+            count = fan_out(frame, [user.outbound for user in self.members.values()], key)
+            fan_out_seconds.observe(time.perf_counter() - start)
+            return count
+
+    def search(self, query, count=SEARCH_PAGE_SIZE):
+        """
+        Finds a page of the chat messages in the room's history matching a search, under the room's lock so no message
+        is recorded (or evicted) while the index is being read.
+        :param query: the SearchQuery
+        :param count: the most matches in the page
+        :return: list of messages to send, see search_page
+        """
+        with self.lock:
+            start = time.perf_counter()
+            page = search_page(self.history, query, count)
+            search_seconds.observe(time.perf_counter() - start)
+            return page
+
+    def snapshot(self):
+        """
+        Copies the room's current members so they can be iterated while others join and leave.
+        :return: list of UserRecords
+        """
+        with self.lock:
+            return list(self.members.values())
+
+    def usernames(self):
+        """
+        Gets the usernames of the room's current members.
+        :return: list of usernames
+        """
+        with self.lock:
+            return list(self.members.keys())
+
+
+class RoomDirectory:
+    """
+    Thread-safe collection of the server's rooms. Rooms are created when someone first joins them and discarded
+    (along with their history) once their last member leaves, except for the default room.
+    """
+
+    def __init__(self, history_size=HISTORY_SIZE, keep_empty=False, log=None):
+        self.history_size = history_size
+        # MessageLog every room's history is also written to (None to keep histories in memory only)
+        self.log = log
+        # Whether rooms are kept once empty (worker processes keep every room, as a room without local members may
+        # still have members, and history, on other workers)
+        self.keep_empty = keep_empty
+        # Room name -> Room
+        self.rooms = {DEFAULT_ROOM: Room(DEFAULT_ROOM, history_size, log)}
+        # Guards creating and discarding rooms (always taken before a room's own lock)
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Looks up a room.
+        :param name: the room's name
+        :return: the Room, or None if no such room exists
+        """
+        return self.rooms.get(name)
+
+    def open(self, name):
+        """
+        Gets a room, creating it if it does not exist yet.
+        :param name: the room's name
+        :return: the Room
+        """
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.rooms[name] = Room(name, self.history_size, self.log)
+            return room
+
+    def restore(self, records):
+        """
+        Refills the rooms' histories with messages read back from the message log, numbering them as they were
+        before the restart.
+        :param records: list of (room name, message) pairs, oldest first
+        :return:
+        """
+        for name, message in records:
+            room = self.open(name)
+            sequence = decode_envelope(message).sequence or room.history.next_sequence
+            # A number that does not carry on from the history's means the room was discarded and its name reused
+            # since (its numbering starting over), so only the newest room's history is restored
+            if sequence != room.history.next_sequence:
+                room.history = ChatHistory(self.history_size)
+                room.history.resume_at(sequence)
+            room.history.append(message)
+
+    def join(self, user, name=DEFAULT_ROOM, on_join=None):
+        """
+        Moves a user into a room (leaving the room they are currently in, if any).
+        :param user: UserRecord of the user
+        :param name: name of the room to join
+        :param on_join: optional function called with the room while its lock is held, right after the user is added
+        (used to queue the room's history before any new message can reach the user)
+        :return: tuple of (room left or None, room joined)
+        """
+        with self.lock:
+            old_room = self.leave_locked(user)
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.rooms[name] = Room(name, self.history_size, self.log)
+            with room.lock:
+                room.members[user.username] = user
+                user.room = room
+                if on_join is not None:
+                    on_join(room)
+            return old_room, room
+
+    def leave(self, user):
+        """
+        Removes a user from the room they are in.
+        :param user: UserRecord of the user
+        :return: the room left, or None if the user was not in a room
+        """
+        with self.lock:
+            return self.leave_locked(user)
+
+    def leave_locked(self, user):
+        """
+        Removes a user from the room they are in (caller holds the directory lock).
+        :param user: UserRecord of the user
+        :return: the room left, or None if the user was not in a room
+        """
+        room = user.room
+        if room is None:
+            return None
+        with room.lock:
+            room.members.pop(user.username, None)
+            empty = not room.members
+        user.room = None
+        # Forget rooms nobody is in anymore
+        if empty and not self.keep_empty and room.name != DEFAULT_ROOM:
+            self.rooms.pop(room.name, None)
+        return room
+
+
+def valid_room_name(name):
+    """
+    Checks whether a room name can be used.
+    :param name: the requested room name
+    :return: True if the name is usable, else False
+    """
+    return 0 < len(name) <= MAX_ROOM_NAME_LENGTH and name.isprintable() and ' ' not in name
@@ -0,0 +1,353 @@
+import argparse
+import bisect
+import random
+import re
+import time
+import timeit
+
+from protocol import OP_CHAT, OP_SEARCH_END, OP_SEARCH_RESULTS, decode_envelope, encode_envelope, stamp_sequence
+
+# Number of matching messages sent per page of search results
+SEARCH_PAGE_SIZE = 20
+# Most candidate messages looked at to answer one search request; a search that hits the limit returns what it found
+# so far along with where to carry on, so a rare combination of common words cannot make the server walk its history
+SEARCH_SCAN_LIMIT = 2000
+# Most words a search may ask for
+MAX_SEARCH_WORDS = 8
+# What counts as a word, both in messages and in searches (matched case-insensitively)
+WORD = re.compile(r'\w+')
+# Index terms for senders start with a character no word can hold, so a word never matches a username
+SENDER_PREFIX = '@'
+
+
+def words(text):
+    """
+    Splits text into the distinct words it is searched by.
+    :param text: the text
+    :return: set of lowercase words
+    """
+    return set(WORD.findall(text.casefold()))
+
+
+class Postings(list):
+    """
+    The sequence numbers of the messages holding one index term, oldest first. Messages are only ever indexed newest
+    and evicted oldest, so numbers are appended at the end (with the plain list append, as every recorded message adds
+    to several lists) and dropped from the front (by moving the list's start, and only shifting the list once half of
+    it is dropped).
+    """
+    __slots__ = ('start',)
+
+    def __init__(self):
+        super().__init__()
+        # Position of the oldest sequence number still held
+        self.start = 0
+
+    def __contains__(self, sequence):
+        position = self.position(sequence)
+        return position < len(self) and self[position] == sequence
+
+    def held(self):
+        """
+        Counts the sequence numbers still held.
+        :return: the count
+        """
+        return len(self) - self.start
+
+    def evict(self):
+        """
+        Drops the oldest message holding the term.
+        :return:
+        """
+        self.start += 1
+        if self.start * 2 >= len(self):
+            del self[:self.start]
+            self.start = 0
+
+    def position(self, sequence):
+        """
+        Finds where a sequence number is, or would go, in the list.
+        :param sequence: the sequence number
+        :return: position of the first sequence number held that is not less than it
+        """
+        return bisect.bisect_left(self, sequence, self.start)
+
+
+class SearchQuery:
+    """
+    What a user searched for: messages holding all of the given words, from the given sender, sent in the given time
+    range, older than the given sequence number (to page through the results).
+    """
+    __slots__ = ('words', 'sender', 'since', 'until', 'before')
+
+    def __init__(self, words=(), sender=None, since=None, until=None, before=None):
+        self.words = words
+        self.sender = sender
+        # Milliseconds since the epoch the messages were sent at or after, and before (None for no limit)
+        self.since = since
+        self.until = until
+        # Sequence number the results are older than (None to start from the newest message)
+        self.before = before
+
+    def terms(self):
+        """
+        Gets the index terms a message must hold to match.
+        :return: list of terms
+        """
+        terms = list(self.words)
+        if self.sender is not None:
+            terms.append(SENDER_PREFIX + self.sender)
+        return terms
+
+
+class SearchIndex:
+    """
+    Inverted index over the chat messages in a history: each word, and each sender, maps to the sequence numbers of
+    the messages holding it. It is updated as messages are recorded and evicted along with them, so searching costs as
+    much as the shortest list of messages involved rather than the whole history.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Index term -> Postings
+        self.postings = {}
+        # Every indexed message, for searches by time alone
+        self.indexed = Postings()
+        # Message with sequence number n has its index terms (None if it was not indexed) and the time it was sent in
+        # slot n % capacity, like in its ChatHistory
+        self.terms = [None] * capacity
+        self.times = [0] * capacity
+        # Sequence numbers of the oldest message held and of the next one, matching the history's
+        self.first_sequence = 0
+        self.next_sequence = 0
+        # Latest time a message was sent at; times are kept from going backwards (messages are stamped before they
+        # are numbered, so two sent at once may be recorded out of order), so time ranges can be found by bisection
+        self.latest_time = 0
+
+    def add(self, sequence, message):
+        """
+        Indexes a message being recorded in the history (only chat messages can be searched for).
+        :param sequence: the message's sequence number
+        :param message: the encoded envelope
+        :return:
+        """
+        if self.first_sequence == self.next_sequence:
+            self.first_sequence = sequence
+        self.next_sequence = sequence + 1
+        slot = sequence % self.capacity
+        envelope = decode_envelope(message)
+        self.latest_time = max(self.latest_time, envelope.time)
+        self.times[slot] = self.latest_time
+        if envelope.op != OP_CHAT:
+            self.terms[slot] = None
+            return
+        # The body repeats the timestamp and sender ('[1:5:9PM] name: text'), only the text is worth searching
+        terms = [*words(envelope.body.partition(': ')[2]), SENDER_PREFIX + envelope.sender]
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = Postings()
+            postings.append(sequence)
+        self.indexed.append(sequence)
+        self.terms[slot] = terms
+
+    def evict(self):
+        """
+        Forgets the oldest message, as the history evicts it.
+        :return:
+        """
+        slot = self.first_sequence % self.capacity
+        terms = self.terms[slot]
+        self.first_sequence += 1
+        if terms is None:
+            return
+        self.terms[slot] = None
+        for term in terms:
+            postings = self.postings[term]
+            postings.evict()
+            if not postings:
+                del self.postings[term]
+        self.indexed.evict()
+
+    def sequence_at(self, sent):
+        """
+        Finds the first message sent at or after a time.
+        :param sent: milliseconds since the epoch
+        :return: the message's sequence number (the next sequence number if there is none)
+        """
+        low, high = self.first_sequence, self.next_sequence
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[middle % self.capacity] < sent:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def search(self, query, count=SEARCH_PAGE_SIZE, scan_limit=SEARCH_SCAN_LIMIT):
+        """
+        Finds the newest messages matching a search, walking the shortest list of messages involved and checking the
+        others by bisection.
+        :param query: the SearchQuery
+        :param count: the most matches to find
+        :param scan_limit: the most candidate messages to look at
+        :return: tuple of (list of matching sequence numbers newest first, sequence number to search before for the
+        next page or None if there are no more matches)
+        """
+        lists = []
+        for term in query.terms():
+            postings = self.postings.get(term)
+            # No message holds the term
+            if postings is None:
+                return [], None
+            lists.append(postings)
+        lists.sort(key=Postings.held)
+        shortest, others = (lists[0], lists[1:]) if lists else (self.indexed, [])
+        start, end = self.first_sequence, self.next_sequence
+        if query.before is not None:
+            end = min(end, query.before)
+        if query.since is not None:
+            start = max(start, self.sequence_at(query.since))
+        if query.until is not None:
+            end = min(end, self.sequence_at(query.until))
+        lowest = shortest.position(start)
+        position = shortest.position(end)
+        matches = []
+        while position > lowest and len(matches) < count and scan_limit > 0:
+            position -= 1
+            scan_limit -= 1
+            sequence = shortest[position]
+            if all(sequence in postings for postings in others):
+                matches.append(sequence)
+        return matches, shortest[position] if position > lowest else None
+
+
+def parse_search_request(envelope):
+    """
+    Reads the search a SEARCH envelope asks for. Its body holds the words to search for, space separated, along with
+    any of 'from:<username>', 'since:<ms>' and 'until:<ms>' (milliseconds since the epoch) and 'before:<sequence>'.
+    :param envelope: the search request
+    :return: the SearchQuery, or None if the request is malformed
+    """
+    query = SearchQuery()
+    found = set()
+    for word in envelope.body.split():
+        name, colon, value = word.partition(':')
+        try:
+            if colon and name == 'from':
+                query.sender = value
+            elif colon and name in ('since', 'until', 'before'):
+                setattr(query, name, int(value))
+            else:
+                found |= words(word)
+        except ValueError:
+            return None
+    if len(found) > MAX_SEARCH_WORDS:
+        return None
+    query.words = found
+    return query
+
+
+def search_page(history, query, count=SEARCH_PAGE_SIZE):
+    """
+    Builds the messages that deliver one page of search results to a client: a SEARCH_RESULTS envelope carrying the
+    sequence number to search before for the next page (empty if there are no more results), the matching messages
+    newest first and a closing SEARCH_END envelope.
+    :param history: the ChatHistory to search
+    :param query: the SearchQuery
+    :param count: the most matches in the page
+    :return: list of messages to send
+    """
+    matches, more = history.index.search(query, count)
+    return [encode_envelope(OP_SEARCH_RESULTS, body='' if more is None else str(more)),
+            *[history.message(sequence) for sequence in matches], encode_envelope(OP_SEARCH_END)]
+
+
+def search_body(text='', sender=None, since=None, until=None, before=None):
+    """
+    Builds the body of a SEARCH envelope.
+    :param text: the words to search for (may hold filters too, as typed by a user)
+    :param sender: username the messages must be from (None for anyone)
+    :param since: milliseconds since the epoch the messages must be sent at or after (None for no limit)
+    :param until: milliseconds since the epoch the messages must be sent before (None for no limit)
+    :param before: sequence number the results must be older than, from the previous page (None for the first page)
+    :return: the body
+    """
+    filters = {'from': sender, 'since': since, 'until': until, 'before': before}
+    return ' '.join([text, *[f'{name}:{value}' for name, value in filters.items() if value is not None]]).strip()
+
+
+def scan(history, query, count=SEARCH_PAGE_SIZE):
+    """
+    Finds the newest messages matching a search by decoding every message in the history, newest first (what
+    searching would cost without the index, for comparison).
+    :param history: the ChatHistory to search
+    :param query: the SearchQuery
+    :param count: the most matches to find
+    :return: list of matching sequence numbers newest first
+    """
+    matches = []
+    for sequence in range(history.next_sequence - 1, history.first_sequence - 1, -1):
+        envelope = decode_envelope(history.message(sequence))
+        if (envelope.op == OP_CHAT and (query.sender is None or envelope.sender == query.sender) and
+                query.words <= words(envelope.body.partition(': ')[2])):
+            matches.append(sequence)
+            if len(matches) == count:
+                break
+    return matches
+
+
+def main(args=None):
+    """
+    Microbenchmark comparing searching a full history through the index against scanning it, along with what keeping
+    the index costs per recorded message.
+    :param args: list of arguments to parse (defaults to sys.argv)
+    :return: dict of microseconds per call for each measurement
+    """
+    from history import ChatHistory
+
+    parser = argparse.ArgumentParser(description='Chat history search microbenchmark')
+    parser.add_argument('--history-size', type=int, default=100000, help='messages held in the history')
+    parser.add_argument('--vocabulary', type=int, default=5000, help='distinct words messages are made of')
+    parser.add_argument('--number', type=int, default=20, help='searches timed per query')
+    options = parser.parse_args(args)
+    rng = random.Random(0)
+    vocabulary = [f'word{index}' for index in range(options.vocabulary)]
+    # Word frequencies follow Zipf's law, as in natural language
+    weights = [1 / rank for rank in range(1, options.vocabulary + 1)]
+    senders = [f'user{index}' for index in range(100)]
+    messages = []
+    for index in range(options.history_size):
+        sender = rng.choice(senders)
+        text = ' '.join(rng.choices(vocabulary, weights, k=8))
+        messages.append(encode_envelope(OP_CHAT, sender=sender, body=f'[1:5:9PM] {sender}: {text}\n',
+                                        time=1000 * index))
+    # Each run records the messages into a fresh, full history, so evictions are timed along with appends
+    histories = [ChatHistory(options.history_size) for _ in range(2)]
+    start = time.perf_counter()
+    for history in histories:
+        for message in messages:
+            history.append(stamp_sequence(message, history.next_sequence))
+    results = {'record message': (time.perf_counter() - start) / len(histories) / len(messages) * 1e6}
+    index = SearchIndex(options.history_size)
+    start = time.perf_counter()
+    for sequence, message in enumerate(messages):
+        index.add(sequence, message)
+    results['  of which indexing'] = (time.perf_counter() - start) / len(messages) * 1e6
+    history = histories[0]
+    queries = {
+        'common word': SearchQuery(words={vocabulary[0]}),
+        'rare word': SearchQuery(words={vocabulary[-1]}),
+        'two words + sender': SearchQuery(words={vocabulary[1], vocabulary[2]}, sender=senders[0]),
+    }
+    for name, query in queries.items():
+        for method, function in (('index', history.index.search), ('scan', lambda query: scan(history, query))):
+            seconds = timeit.timeit(lambda: function(query), number=options.number)
+            results[f'{name} ({method})'] = seconds / options.number * 1e6
+    for name, microseconds in results.items():
+        print(f'{name:<28} {microseconds:12.1f} us/call')
+    return results
+
+
+if __name__ == '__main__':
+    main()
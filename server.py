@@ -1,234 +1,318 @@
 import socket
+import ssl
 import threading
 import time
 
-# The host IP (currently a default IPV4 address)
-HOST = '127.0.0.1'
-
-# The port number for the server
-PORT = 9090
-
-# This is the reference to the socket itself which is an endpoint in communication b/w programs
-# AF_INET denotes ipv4, SOCK_STREAM denotes TCP connection type (connection-oriented, not connectionless server)
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-# Binds the host name and port number to the socket
-address = (HOST, PORT)
-server.bind(address)
+import metrics
+import service
+from compression import BATCH_SIZE, COMPRESSION, Compressor
+from heartbeat import run_with_thread
+from outbound import OutboundQueue, bulk_written
+from presence import schedule_with_timer
+from protocol import (OP_INVALID_USERNAME, OP_LOGIN, OP_REQUEST_USERNAME, OP_VALID_USERNAME, FrameDecoder, FrameError,
+                      encode_envelope, encode_frame, receive_message)
+from reconnect import login_body, new_token, parse_login_body
+from registry import UserRecord, valid_username
+from service import (HOST, LISTEN_BACKLOG, PORT, configure, configure_logging, enter_chat, expire_login,
+                     flood_control, handle_message, logger, parse_args, remove_client, take_over)
+from tls import SharedTLSSocket
+from transfers import send_buffers
+
+
+def write_messages(client, outbound, compressor=None):
+    """
+    Writes the messages queued for a client until their queue is closed, sending everything that piled up in one
+    write.
+    :param client: the client's socket
+    :param outbound: the client's OutboundQueue
+    :param compressor: the client's Compressor, if they asked for compression
+    :return:
+    """
+    while True:
+        frames = outbound.wait_all()
+        # Messages go first, then no more than a write's worth of file chunks before checking for messages again
+        chunks = outbound.take_bulk()
+        # Queue closed and drained
+        if not frames and not chunks:
+            break
+        try:
+            if frames:
+                write_frames(client, outbound, frames, compressor, chunks)
+            if chunks:
+                # File data is written straight from the frames it arrived in, never compressed
+                buffers = [buffer for item, _ in chunks for buffer in item]
+                send_buffers(client, buffers)
+                bulk_written(chunks)
+                metrics.messages_sent.inc(len(chunks))
+                metrics.bytes_sent.inc(sum(len(buffer) for buffer in buffers))
+        except OSError:
+            break
+    # Connection broke, wake up the client's handle_client thread so it gets removed
+    if not outbound.closed:
+        shutdown_client(client)
 
-# Creates a queue for potential connections
-server.listen()
 
-# # Lists to store clients and their respective usernames
-# clients = []
-# usernames = []
-# # Dictionary to store text colors for each user
-# colors = {}
-# List for chat history
-chat_history = []
-# User data
-user_data = {}
+def write_frames(client, outbound, frames, compressor=None, chunks=()):
+    """
+    Writes messages to a client in one write.
+    :param client: the client's socket
+    :param outbound: the client's OutboundQueue
+    :param frames: the messages taken from the queue
+    :param compressor: the client's Compressor, if they asked for compression
+    :param chunks: file chunks waiting to be written after the messages
+    :return:
+    """
+    # A small write waits a moment for more messages to join it (like Nagle's algorithm, but bounded), unless file
+    # chunks are waiting behind it anyway
+    if service.batch_window > 0 and not chunks and sum(len(frame) for frame in frames) < BATCH_SIZE:
+        time.sleep(service.batch_window)
+        frames += outbound.take_all()
+    data = b''.join(frames)
+    if compressor is not None:
+        data = compressor.compress(data)
+    client.sendall(data)
+    metrics.messages_sent.inc(len(frames))
+    metrics.bytes_sent.inc(len(data))
+    metrics.write_batch_messages.observe(len(frames))
+
+
+def shutdown_client(client):
+    """
+    Shuts down a client's connection, waking up any of its threads blocked on the socket.
+    :param client: the client's socket
+    :return:
+    """
+    try:
+        client.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
 
 
-def broadcast_message(message):
+def close_client(client):
     """
-    Broadcasts a message to all connected users.
-    :param message: the message to broadcast
+    Closes a removed client's connection, waking up any of its threads blocked on the socket.
+    :param client: the client's socket
     :return:
     """
-    # Broadcast message to each connected client
-    for user in user_data.keys():
-        data = user_data[user]
-        client = data[1]
-        client.send(message)
-        # Prevent duplicate chat history entries
-        if message not in chat_history:
-            chat_history.append(message)
+    shutdown_client(client)
+    client.close()
 
 
-def handle_client(username):
+def handle_client(user):
     """
     Handles a user's sent message if user is available. Else, removes user and ends thread.
-    :param username: the user to receive message from
+    :param user: UserRecord of the user to receive messages from
     :return:
     """
-    while True:
-        data = user_data[username]
-        client = data[1]
-        # Try to receive and broadcast a message from the user
-        try:
-            message = client.recv(1024).decode()
-            # If user has selected a new color
-            if f'{username}_COLOR=' in message:
-                i = 0
-                for char in message:
-                    i += 1
-                    if char == '=':
-                        break
-                # Change the appropriate key value to their selected color
-                color = message[i:]
-                # Update color data for user
-                new_data = (data[0], data[1], color)
-                user_data[username] = new_data
-            # If user sending a normal message
-            else:
-                # Get their color
-                color = data[2]
-                # Send the message with their color and timestamp
-                current_time = time.localtime()
-                timestamp = time.strftime('%H:%M:%S', current_time)
-
-                hours = int(timestamp[0:2])
-                minutes = int(timestamp[3:5])
-                seconds = int(timestamp[6:9])
-                identifier = 'AM'
-
-                if hours >= 12:
-                    identifier = 'PM'
-                    if hours > 12:
-                        hours = hours - 12
-
-                timestamp = '[' + str(hours) + ':' + str(minutes) + ':' + str(seconds) + identifier + ']'
-
-                if 'CHAT_WITH_' in message:
-                    i = 0
-                    other_user = ''
-                    for char in message:
-                        # End of tag reached
-                        if char == ' ':
-                            break
-                        # Get other user
-                        if i > 9:
-                            other_user = other_user + char
-                        i += 1
-
-                    # Trimmed message after removing tag
-                    message = message[i+1:]
-                    full_message = f'{color}_{timestamp} {username} (To: {other_user}): {message}\n'
-                    other_user_data = user_data[other_user]
-                    other_client = other_user_data[1]
-                    # Send private message to other user
-                    other_client.send(full_message.encode('utf-8'))
-                    # And display it for the sender
-                    client.send(full_message.encode('utf-8'))
-                else:
-                    broadcast_message(f'{color}_{timestamp} {username}: {message}\n'.encode('utf-8'))
-        # If unable to handle user (user disconnects, crashes, etc.), remove user from list and close their connection
-        except ConnectionResetError:
-            # Remove the client
-            remove_client(username)
-            # Leave function (and thread)
-            break
+    try:
+        while True:
+            envelope = receive_message(user.connection, user.decoder, on_data=metrics.bytes_received.inc)
+            # An empty read means the user closed their connection
+            if envelope is None:
+                break
+            if handle_message(user, envelope):
+                throttle(user.flood)
+    # The user disconnected, crashed, broke TLS or sent something that could not be decoded
+    except (OSError, FrameError):
+        pass
+    # A message the server failed to handle still ends the connection cleanly
+    except Exception:
+        logger.exception('Error handling a message from %s.', user.username)
+    finally:
+        # Whatever ended the loop, the user is removed and their connection closed before the thread ends
+        remove_client(user)
+
+
+def throttle(flood):
+    """
+    Charges a connection for a message, and if it is sending too fast stops reading from it until it is back within
+    its limits. Whatever it sends meanwhile waits in the kernel's buffers, so TCP slows the sender down instead of the
+    server buffering its input.
+    :param flood: the connection's FloodControl
+    :return:
+    """
+    delay = flood.take()
+    if delay:
+        metrics.reads_paused.inc()
+        time.sleep(delay)
 
 
-def receive_connections():
+def start_tls(client):
+    """
+    Runs the TLS handshake with a newly accepted client. It runs on the client's login thread, so a slow or stalled
+    handshake never holds up accepting others, and gives up once the login deadline passes.
+    :param client: the client's socket
+    :return: the client's SharedTLSSocket
+    """
+    connection = service.tls_context.wrap_socket(client, server_side=True, do_handshake_on_connect=False)
+    try:
+        connection.settimeout(service.login_timeout if service.login_timeout > 0 else None)
+        connection.do_handshake()
+    except OSError:
+        connection.close()
+        raise
+    metrics.tls_handshakes.inc()
+    if connection.session_reused:
+        metrics.tls_resumed.inc()
+    return SharedTLSSocket(connection)
+
+
+def create_server_socket(host=HOST, port=PORT):
+    """
+    Creates the listening socket for the server.
+    :param host: the host IP to bind to
+    :param port: the port number to bind to
+    :return: the bound, listening socket
+    """
+    # This is the reference to the socket itself which is an endpoint in communication b/w programs
+    # AF_INET denotes ipv4, SOCK_STREAM denotes TCP connection type (connection-oriented, not connectionless server)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Allow quick restarts without waiting for the old socket to leave TIME_WAIT
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    # Binds the host name and port number to the socket
+    address = (host, port)
+    server.bind(address)
+
+    # Creates a queue for potential connections
+    server.listen(LISTEN_BACKLOG)
+    return server
+
+
+def receive_connections(server):
     """
     Receives and accepts connection requests from potential users.
+    :param server: the listening server socket
     :return:
     """
-    print('Server started and running.')
+    logger.info('Server started and running.')
     while True:
         # Accepts connection request from a client and gets their socket (user) and address (address_
         client, client_address = server.accept()
-        print(f'Connection from {client_address} accepted.')
+        # Writes are already batched (see write_frames()), so Nagle's algorithm would only delay them further
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        metrics.connections_accepted.inc()
+        logger.debug('Connection from %s accepted.', client_address)
 
         # Create thread to handle user login
-        attempt_login_thread = threading.Thread(target=login, args=(client,))
+        attempt_login_thread = threading.Thread(target=login, args=(client, time.perf_counter(), client_address[0]))
         attempt_login_thread.start()
 
+        # Connections arriving too fast wait in the listen backlog
+        delay = service.accept_bucket.take()
+        if delay:
+            metrics.accepts_paused.inc()
+            time.sleep(delay)
+
 
-def login(client):
+def login(client, accepted, address):
     """
     Handles user login attempts by looping in a separate thread until either a valid (unique) username is given or
     the user closes the login window.
     :param client: client to handle login for
+    :param accepted: time.perf_counter() reading from when the client's connection was accepted
+    :param address: the client's IP address
     :return:
     """
-    # Send the initial message to user to request the declaration of a username
-    client.send('REQUEST_USERNAME'.encode('utf-8'))
-    while True:
-        # The user's username input
-        username = client.recv(1024).decode('utf-8')
-
-        # If user hits 'Cancel' on the popup asking for a username, continue
-        if len(username) == 0:
-            break
-
-        # If username is already taken, request user to input a valid username
-        if username in user_data.keys():
-            client.send('INVALID_USERNAME'.encode('utf-8'))
-            continue
-        # Username valid, continue on
-        else:
-            # Notify client of username validity
-            client.send('VALID_USERNAME'.encode('utf-8'))
-            time.sleep(1)
-
-            # Add to lists and color dictionary
-            # usernames.append(username)
-            # clients.append(client)
-
-            data = (username, client, 'black')
-            user_data[username] = data
-
-            # Update user's chat history
-            for message in chat_history:
-                print(message)
-                client.send(message)
-                time.sleep(1)
-
-            # Send out messages to the chat log notifying of user's joining
-            client.send(f'Connected to chat as {username}\n'.encode('utf-8'))
-            time.sleep(1)
-            broadcast_message(f'{username} has joined the chat.\n'.encode('utf-8'))
-
-            # Update user list
-            update_user_list()
-
-            # New thread for handling with the current user as an argument ('user,' treated as a tuple)
-            thread = threading.Thread(target=handle_client, args=(username,))
-            thread.start()
-
-            print(f'Client username: {username}')
-            break
-
-
-def update_user_list():
-    """
-    Updates the list of connected users for clients.
-    :return:
-    """
-    users = 'CONNECTED_USERS: '
-    for user in user_data.keys():
-        users = users + user + ' '
-
-    # TODO: Explore alternatives to 'sleeping' in order to prevent cluttered streams to client (for all time.sleep()
-    #  occurrences)
-    time.sleep(1)
-
-    # Sends users list to clients
-    broadcast_message(users.encode('utf-8'))
-
-
-def remove_client(username):
+    # Decoder holding any of the client's data received but not yet handled
+    decoder = FrameDecoder(service.max_message_size)
+    flood = flood_control(address)
+    # The user's record, once their username is reserved
+    user = None
+    # A client that never finishes logging in (e.g. a half-open connection) is closed at the deadline
+    deadline = (service.wheel.schedule(service.login_timeout, lambda: expire_login(client))
+                if service.login_timeout > 0 else None)
+    try:
+        if service.tls_context is not None:
+            client = start_tls(client)
+        # Send the initial message to user to request the declaration of a username
+        client.sendall(encode_frame(encode_envelope(OP_REQUEST_USERNAME)))
+        while True:
+            # The user's username input
+            envelope = receive_message(client, decoder)
+
+            # If user hits 'Cancel' on the popup asking for a username, close the connection
+            if envelope is None or envelope.op != OP_LOGIN or len(envelope.sender) == 0:
+                client.close()
+                break
+            username = envelope.sender
+            # A username that would corrupt user lists is refused like a taken one
+            if not valid_username(username):
+                client.sendall(encode_frame(encode_envelope(OP_INVALID_USERNAME)))
+                throttle(flood)
+                continue
+            # The client lists the optional features it supports in the body, and where to resume from if it is
+            # reconnecting
+            features, options = parse_login_body(envelope.body)
+            compress = service.compression and COMPRESSION in features
+
+            # Queue of messages waiting to be written to the user, drained by its own writer thread. The username
+            # confirmation (with the token to reconnect with) is queued before the user is registered so that no
+            # message can overtake it
+            token = new_token()
+            outbound = OutboundQueue(service.queue_size, service.slow_consumer_policy,
+                                     on_overflow=lambda: shutdown_client(client))
+            outbound.put(encode_frame(encode_envelope(OP_VALID_USERNAME,
+                                                      body=login_body([COMPRESSION] if compress else [], token=token))))
+            user = UserRecord(username, client, outbound, decoder, address=address, flood=flood, token=token)
+
+            # If username is already taken (and not by the user's own stale connection), request user to input a valid
+            # username (the check and the reservation are one atomic step)
+            if not service.registry.reserve(user) and not (take_over(username, options.get('token')) and
+                                                           service.registry.reserve(user)):
+                user = None
+                client.sendall(encode_frame(encode_envelope(OP_INVALID_USERNAME)))
+                # Login attempts count against the same limits as messages
+                throttle(flood)
+                continue
+            # Username valid, continue on
+            else:
+                enter_chat(user, options)
+                # Everything queued so far goes out in one write
+                threading.Thread(target=write_messages, args=(client, outbound, Compressor(service.compress_threshold)
+                                                              if compress else None), daemon=True).start()
+
+                # New thread for handling with the current user as an argument
+                service.heartbeats.watch(user)
+                thread = threading.Thread(target=handle_client, args=(user,))
+                thread.start()
+
+                metrics.logins.inc()
+                metrics.login_seconds.observe(time.perf_counter() - accepted)
+                logger.debug('Client username: %s', username)
+                break
+    # User dropped (or sent garbage, or failed the TLS handshake) before finishing their login
+    except (ConnectionError, TimeoutError, ssl.SSLError, FrameError):
+        client.close()
+    finally:
+        if deadline is not None:
+            deadline.cancel()
+        # Once registered, the connection's share of its address' limit is given up when the user is removed
+        if user is None:
+            service.addresses.release(address)
+
+
+def run(options):
     """
-    Removes the given client from consideration.
-    :param username: username of the client to remove
+    Runs the threaded server with the given options.
+    :param options: the parsed command line options
     :return:
     """
-    data = user_data[username]
-    client = data[1]
-    # Close client connection
-    client.close()
-    # clients.remove(client)
-    # usernames.remove(username)
-    # Update connected user list for clients
-    user_data.pop(username)
-    update_user_list()
+    configure(options, schedule_with_timer, close_client, shutdown_client)
+    run_with_thread(service.wheel)
+    try:
+        receive_connections(create_server_socket(options.host, options.port))
+    finally:
+        if service.log is not None:
+            service.log.close()
 
-    # Notify users that someone has left
-    broadcast_message(f'{username} has left the chat.\n'.encode('utf-8'))
 
 if __name__ == '__main__':
-    print('Starting chat app server...')
-    receive_connections()
+    options = parse_args()
+    configure_logging(options)
+    logger.info('Starting chat app server (%s mode)...', options.mode)
+    if options.mode == 'asyncio':
+        import async_server
+        async_server.run(options)
+    else:
+        run(options)
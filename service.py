@@ -0,0 +1,642 @@
+import argparse
+import logging
+import socket
+import time
+
+import metrics
+import protocol
+from compression import BATCH_WINDOW, COMPRESS_THRESHOLD
+from heartbeat import HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, LOGIN_TIMEOUT, Heartbeats, TimerWheel
+from history import HISTORY_SIZE, REPLAY_SIZE, history_page, missed_messages, parse_history_request
+from message_log import FLUSH_INTERVAL, RECOVER_COUNT, RETAIN_SEGMENTS, SEGMENT_SIZE, MessageLog
+from outbound import QUEUE_SIZE, SLOW_CONSUMER_POLICIES, SLOW_CONSUMER_POLICY
+from presence import PRESENCE_WINDOW, PresenceTracker, user_list_snapshot
+from protocol import (OP_CHAT, OP_CONNECTED, OP_DIRECT, OP_FILE_ACCEPT, OP_FILE_CHUNK, OP_FILE_END, OP_FILE_OFFER,
+                      OP_JOIN_ROOM, OP_JOINED, OP_LEAVE_ROOM, OP_LEFT, OP_REQUEST_HISTORY, OP_ROOM, OP_SEARCH,
+                      OP_SET_COLOR, encode_envelope, encode_frame, encode_frames)
+from ratelimit import (ACCEPT_BURST, ACCEPT_RATE, ADDRESS_BURST, ADDRESS_RATE, MAX_MESSAGE_SIZE, MESSAGE_BURST,
+                       MESSAGE_RATE, AddressBuckets, FloodControl, TokenBucket)
+from reconnect import resume_point, valid_token
+from registry import UserRegistry
+from rooms import DEFAULT_ROOM, RoomDirectory, valid_room_name
+from search import parse_search_request
+from timestamps import timestamps
+from tls import server_context
+from transfers import TRANSFER_WINDOW, TransferTable
+
+# The host IP (currently a default IPV4 address)
+HOST = '127.0.0.1'
+
+# The port number for the server
+PORT = 9090
+
+# Maximum number of pending connections queued by the listening socket
+LISTEN_BACKLOG = 1024
+
+# The metrics endpoint only listens locally
+METRICS_HOST = '127.0.0.1'
+# Levels the server's log can be set to
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+
+logger = logging.getLogger('chat.server')
+
+# Chat rooms, each with its own members and (bounded) chat history
+rooms = RoomDirectory()
+# On-disk log the rooms' histories are written to (None when histories are kept in memory only)
+log = None
+# Number of history messages replayed on join and per requested page
+replay_size = REPLAY_SIZE
+# Maximum number of messages waiting to be written to one client, and what to do when a client falls that far behind
+queue_size = QUEUE_SIZE
+slow_consumer_policy = SLOW_CONSUMER_POLICY
+# Connected users (username -> UserRecord), safe to use from every thread
+registry = UserRegistry()
+# Collects the users joining and leaving each room and sends them as periodic deltas (created by configure())
+presence = None
+# How fast one user may send, the buckets shared by connections from the same IP address, and the largest message
+# a user may send
+message_rate = MESSAGE_RATE
+message_burst = MESSAGE_BURST
+addresses = AddressBuckets()
+max_message_size = MAX_MESSAGE_SIZE
+# Limits how fast new connections are accepted
+accept_bucket = TokenBucket(ACCEPT_RATE, ACCEPT_BURST)
+# Timers for heartbeats and login deadlines (driven by a thread in the threaded server, the event loop in the asyncio
+# server), the heartbeats sent to quiet users, and the seconds a connection has to log in
+wheel = TimerWheel()
+heartbeats = None
+login_timeout = LOGIN_TIMEOUT
+# File transfers being relayed between users
+transfers = TransferTable(registry.get, wheel)
+# Whether clients asking for compression get it, the smallest write worth compressing, and the seconds a writer waits
+# for more messages to join a small write
+compression = False
+compress_threshold = COMPRESS_THRESHOLD
+batch_window = BATCH_WINDOW
+# TLS context connections are wrapped in (None for plain TCP)
+tls_context = None
+# Connection to the other worker processes through the parent's hub (None when running as a single process)
+bus = None
+# Functions the server engine ends a user's connection with, both waking whatever is blocked reading from it: one
+# closing it once the user is removed, one breaking it off at once (a dead or stalled connection may never flush)
+close_connection = None
+abort_connection = None
+
+
+def chat_message(user, text):
+    """
+    Builds a user's message to their room, stamped with their color and the time.
+    :param user: UserRecord of the sender
+    :param text: the message's text
+    :return: the CHAT envelope
+    """
+    timestamp, sent = timestamps.now()
+    return encode_envelope(OP_CHAT, sender=user.username, color=user.color,
+                           body=f'{timestamp} {user.username}: {text}\n', time=sent)
+
+
+def direct_message(user, target, text):
+    """
+    Builds a user's private message to another user, stamped with their color and the time.
+    :param user: UserRecord of the sender
+    :param target: username of the recipient
+    :param text: the message's text
+    :return: the DIRECT envelope
+    """
+    timestamp, sent = timestamps.now()
+    return encode_envelope(OP_DIRECT, sender=user.username, target=target, color=user.color,
+                           body=f'{timestamp} {user.username} (To: {target}): {text}\n', time=sent)
+
+
+def joined_notice(username):
+    """
+    Builds the notice telling a room that someone joined it.
+    :param username: the user who joined
+    :return: the JOINED envelope
+    """
+    return encode_envelope(OP_JOINED, sender=username, body=f'{username} has joined the chat.\n')
+
+
+def left_notice(username):
+    """
+    Builds the notice telling a room that someone left it.
+    :param username: the user who left
+    :return: the LEFT envelope
+    """
+    return encode_envelope(OP_LEFT, sender=username, body=f'{username} has left the chat.\n')
+
+
+def connected_notice(username):
+    """
+    Builds the message confirming a user's login, sent once they have their room's history.
+    :param username: the user who logged in
+    :return: the CONNECTED envelope
+    """
+    return encode_envelope(OP_CONNECTED, sender=username, body=f'Connected to chat as {username}\n')
+
+
+def broadcast_message(message, room, save=True, key=None):
+    """
+    Broadcasts a message to all users in a room.
+    :param message: the message to broadcast
+    :param room: the Room to broadcast to
+    :param save: whether the message should be kept in the room's chat history
+    :param key: optional coalescing key, lets a newer message replace this one if it is still waiting to be sent
+    :return:
+    """
+    # With several workers, every worker (this one included) publishes the message once the hub relays it back, so
+    # they all record room histories in the same order
+    if bus is not None:
+        bus.publish({'op': 'room', 'room': room.name, 'save': save, 'key': key}, message)
+        return
+    # Frame the message once and queue that same buffer for each member of the room; each client's writer sends it,
+    # so a slow receiver only holds up itself
+    room.publish(None if save else encode_frame(message), message if save else None, key)
+
+
+def handle_history_request(user, envelope):
+    """
+    Sends a user the page of messages before the sequence number they asked for, in one write.
+    :param user: UserRecord of the user
+    :param envelope: the REQUEST_HISTORY envelope
+    :return:
+    """
+    sequence = parse_history_request(envelope)
+    if sequence is not None:
+        user.outbound.put(encode_frames(history_page(user.room.history, sequence, replay_size)))
+
+
+def handle_search_request(user, envelope):
+    """
+    Sends a user the page of chat messages in their room matching their search, in one write.
+    :param user: UserRecord of the user
+    :param envelope: the SEARCH envelope
+    :return:
+    """
+    query = parse_search_request(envelope)
+    if query is not None:
+        metrics.searches.inc()
+        user.outbound.put(encode_frames(user.room.search(query)))
+
+
+def handle_join_room(user, envelope):
+    """
+    Moves a user into the room they asked for.
+    :param user: UserRecord of the user
+    :param envelope: the JOIN_ROOM envelope
+    :return:
+    """
+    change_room(user, envelope.body)
+
+
+def handle_leave_room(user, envelope):
+    """
+    Returns a user leaving their room to the default room.
+    :param user: UserRecord of the user
+    :param envelope: the LEAVE_ROOM envelope
+    :return:
+    """
+    change_room(user, DEFAULT_ROOM)
+
+
+def handle_set_color(user, envelope):
+    """
+    Changes the color of a user's messages.
+    :param user: UserRecord of the user
+    :param envelope: the SET_COLOR envelope
+    :return:
+    """
+    user.color = envelope.color
+
+
+def handle_chat(user, envelope):
+    """
+    Sends a user's message to everyone in their room.
+    :param user: UserRecord of the user
+    :param envelope: the CHAT envelope
+    :return:
+    """
+    broadcast_message(chat_message(user, envelope.body), user.room)
+
+
+def handle_direct(user, envelope):
+    """
+    Sends a user's private message to its recipient (if they are still connected) and back to the user.
+    :param user: UserRecord of the user
+    :param envelope: the DIRECT envelope
+    :return:
+    """
+    message = direct_message(user, envelope.target, envelope.body)
+    frame = encode_frame(message)
+    other_user = registry.get(envelope.target)
+    if other_user is not None:
+        other_user.outbound.put(frame)
+    # Or hand it to the worker they are logged in on
+    elif bus is not None:
+        bus.publish({'op': 'direct', 'username': envelope.target}, message)
+    user.outbound.put(frame)
+
+
+def handle_file_offer(user, envelope):
+    """
+    Offers a user's file to the user (or room) they are sending it to, or resumes sending it. Only users logged in
+    on the same worker can be sent files.
+    :param user: UserRecord of the user
+    :param envelope: the FILE_OFFER envelope
+    :return:
+    """
+    transfers.offer(user, envelope)
+
+
+def handle_file_accept(user, envelope):
+    """
+    Starts (or resumes) relaying an offered file to a user taking it.
+    :param user: UserRecord of the user
+    :param envelope: the FILE_ACCEPT envelope
+    :return:
+    """
+    transfers.accept(user, envelope)
+
+
+def handle_file_end(user, envelope):
+    """
+    Gives up on a transfer a user is sending or taking.
+    :param user: UserRecord of the user
+    :param envelope: the FILE_END envelope
+    :return:
+    """
+    transfers.end(user, envelope)
+
+
+# Opcode -> function handling that request from a logged in user (file chunks are relayed by handle_message())
+HANDLERS = {
+    OP_REQUEST_HISTORY: handle_history_request,
+    OP_SEARCH: handle_search_request,
+    OP_JOIN_ROOM: handle_join_room,
+    OP_LEAVE_ROOM: handle_leave_room,
+    OP_SET_COLOR: handle_set_color,
+    OP_CHAT: handle_chat,
+    OP_DIRECT: handle_direct,
+    OP_FILE_OFFER: handle_file_offer,
+    OP_FILE_ACCEPT: handle_file_accept,
+    OP_FILE_END: handle_file_end,
+}
+
+
+def handle_message(user, envelope):
+    """
+    Handles a message received from a logged in user.
+    :param user: UserRecord of the user
+    :param envelope: the received Envelope
+    :return: True if the message counts against the user's rate limits, else False
+    """
+    metrics.messages_received.inc()
+    # Anything received shows the user is alive (a PONG needs no handling beyond that)
+    user.last_seen = time.monotonic()
+    # Chunks the sender was given credit for are only limited by that, any others count as messages
+    if envelope.op == OP_FILE_CHUNK:
+        return not transfers.chunk(user, envelope)
+    # Messages with an opcode the server does not handle are ignored
+    handler = HANDLERS.get(envelope.op)
+    if handler is not None:
+        handler(user, envelope)
+    return True
+
+
+def flood_control(address):
+    """
+    Creates the rate limits for a new connection.
+    :param address: the connection's IP address
+    :return: the connection's FloodControl
+    """
+    return FloodControl(TokenBucket(message_rate, message_burst), addresses.acquire(address))
+
+
+def reap_idle(user):
+    """
+    Disconnects a user who stopped answering heartbeats (whatever reads from their connection then removes them).
+    :param user: UserRecord of the user
+    :return:
+    """
+    metrics.idle_reaped.inc()
+    logger.debug('Disconnecting idle user %s.', user.username)
+    abort_connection(user.connection)
+
+
+def expire_login(connection):
+    """
+    Disconnects a client that did not log in before its deadline (its login then gives up).
+    :param connection: the client's connection
+    :return:
+    """
+    metrics.login_timeouts.inc()
+    abort_connection(connection)
+
+
+def room_greeting(room, after=None):
+    """
+    Builds the messages that bring a user into a room: the room's name, its full user list (members on other workers
+    included) and its latest history (called while the room's lock is held). A user reconnecting to the room who
+    missed no more than a page of messages (all still held) gets just those after the user list instead, carrying on
+    from where their chat log left off.
+    :param room: the Room being joined
+    :param after: sequence number of the last message a reconnecting user received in the room (None if not resuming)
+    :return: list of messages to send
+    """
+    users = user_list_snapshot([*room.members, *room.remote_members])
+    missed = missed_messages(room.history, after, replay_size) if after is not None else None
+    if missed is not None:
+        metrics.resumes.inc()
+        return [users, *missed]
+    return [encode_envelope(OP_ROOM, body=room.name), users, *history_page(room.history, count=replay_size)]
+
+
+def enter_chat(user, options):
+    """
+    Places a user who just logged in in the default room (or the room they are reconnecting to), queueing its latest
+    chat history (or what they missed) and the connection's confirmation for them; framing keeps the messages apart
+    so no pauses are needed between them.
+    :param user: UserRecord of the user, with their username reserved
+    :param options: the options from the user's LOGIN envelope
+    :return:
+    """
+    username = user.username
+    room = options.get('room', DEFAULT_ROOM)
+    after = resume_point(options)
+    rooms.join(user, room if valid_room_name(room) else DEFAULT_ROOM, lambda joined: user.outbound.put(
+        encode_frames([*room_greeting(joined, after), connected_notice(username)])))
+
+    # Send out messages to the chat log notifying of user's joining (a reconnecting user carries on their session, so
+    # the room is not told again)
+    if after is None:
+        broadcast_message(joined_notice(username), user.room)
+
+    # Update user list
+    update_user_list(user.room, username, True)
+
+
+def take_over(username, token):
+    """
+    Disconnects the stale connection holding a username when its user reconnects with the resume token they were
+    given (the server may not have noticed the old connection drop yet).
+    :param username: the username being logged in with
+    :param token: the resume token the reconnecting user presented (None if they did not)
+    :return: True if the stale connection was dropped and the username is free, else False
+    """
+    if token is None:
+        return False
+    # The stale connection may be on another worker: the hub hands the request to whichever holds the username, and
+    # once it has dropped the connection the user's next attempt gets the username
+    if bus is not None:
+        bus.publish({'op': 'takeover', 'username': username, 'token': token})
+        return False
+    user = registry.get(username)
+    if not valid_token(user, token):
+        return False
+    metrics.takeovers.inc()
+    logger.debug('Replacing the stale connection of %s.', username)
+    # Removed here rather than by whatever reads from the old connection (which remove_client wakes), so nobody is told
+    # they left
+    remove_client(user, announce=False)
+    return True
+
+
+def change_room(user, name):
+    """
+    Moves a user into another room, notifying the members of both rooms.
+    :param user: UserRecord of the user to move
+    :param name: name of the room to join
+    :return:
+    """
+    if not valid_room_name(name) or user.room.name == name:
+        return
+    # The new room's history is queued for the user in the same step that adds them to the room
+    old_room, room = rooms.join(user, name, lambda joined: user.outbound.put(encode_frames(room_greeting(joined))))
+    if old_room is not None:
+        update_user_list(old_room, user.username, False)
+        broadcast_message(left_notice(user.username), old_room)
+    broadcast_message(joined_notice(user.username), room)
+    update_user_list(room, user.username, True)
+
+
+def update_user_list(room, username, present):
+    """
+    Updates the list of connected users for the clients in a room. Changes are collected for a short window and sent
+    as one delta, so a burst of users connecting costs one message per member instead of one per user.
+    :param room: the Room joined or left
+    :param username: the user who joined or left
+    :param present: True if the user joined, False if they left
+    :return:
+    """
+    # With several workers the change goes through the hub, so the room's members on every worker hear of it
+    if bus is not None:
+        bus.publish({'op': 'presence', 'room': room.name, 'username': username, 'present': present})
+        return
+    presence.changed(room, username, present)
+
+
+def remove_client(user, announce=True):
+    """
+    Removes the given client from consideration.
+    :param user: UserRecord of the client to remove
+    :param announce: whether to tell the room the user left (not when they are reconnecting)
+    :return:
+    """
+    username = user.username
+    # Already removed (or replaced by the user reconnecting)
+    if registry.remove(username, user) is None:
+        return
+    metrics.disconnects.inc()
+    room = rooms.leave(user)
+    addresses.release(user.address)
+    # Stop the client's writer and close their connection, waking whatever is still blocked reading from it
+    user.outbound.close()
+    close_connection(user.connection)
+    # Transfers the user was sending or taking wait for them to come back
+    transfers.disconnect(user)
+    # A user dropped before being placed in a room was never announced
+    if room is not None:
+        # Update connected user list for clients
+        update_user_list(room, username, False)
+
+        # Notify users that someone has left
+        if announce:
+            broadcast_message(left_notice(username), room)
+    # Free the username on the other workers last, so anyone taking it over is announced after this user left
+    if bus is not None:
+        bus.release(username)
+
+
+def parse_args(args=None):
+    """
+    Parses the server's command line options.
+    :param args: list of arguments to parse (defaults to sys.argv)
+    :return: the parsed options
+    """
+    parser = argparse.ArgumentParser(description='Simple Chat App server')
+    parser.add_argument('--host', default=HOST, help='host IP to bind to')
+    parser.add_argument('--port', type=int, default=PORT, help='port number to bind to')
+    parser.add_argument('--mode', choices=('threaded', 'asyncio'), default='threaded',
+                        help="'threaded' runs a thread per connection, 'asyncio' runs every connection on one "
+                             "event loop")
+    parser.add_argument('--history-size', type=int, default=HISTORY_SIZE,
+                        help="number of messages kept in each room's chat history")
+    parser.add_argument('--replay-size', type=int, default=REPLAY_SIZE,
+                        help='number of history messages sent on join and per requested page')
+    parser.add_argument('--presence-window', type=float, default=PRESENCE_WINDOW,
+                        help='seconds user joins and leaves are collected for before being sent as one update')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help='maximum number of messages waiting to be written to one client')
+    parser.add_argument('--slow-consumer', choices=SLOW_CONSUMER_POLICIES, default=SLOW_CONSUMER_POLICY,
+                        help="what to do with a client whose queue is full: 'drop' new messages, 'coalesce' "
+                             "superseded and old messages, or 'disconnect' the client")
+    parser.add_argument('--log-dir', default=None,
+                        help='directory to keep an on-disk log of chat history in, so it survives restarts')
+    parser.add_argument('--log-segment-size', type=int, default=SEGMENT_SIZE,
+                        help='bytes a log segment file grows to before a new one is started')
+    parser.add_argument('--log-retain-segments', type=int, default=RETAIN_SEGMENTS,
+                        help='number of log segment files kept, the oldest are deleted beyond it (0 keeps them all)')
+    parser.add_argument('--log-flush-interval', type=float, default=FLUSH_INTERVAL,
+                        help='seconds new messages are collected for before being written and synced to disk together')
+    parser.add_argument('--log-recover', type=int, default=RECOVER_COUNT,
+                        help='number of the most recent logged messages read back into room histories at startup')
+    parser.add_argument('--message-rate', type=float, default=MESSAGE_RATE,
+                        help='messages per second one user may send on average (0 for no limit)')
+    parser.add_argument('--message-burst', type=int, default=MESSAGE_BURST,
+                        help='messages one user may send at once above their average rate')
+    parser.add_argument('--address-rate', type=float, default=ADDRESS_RATE,
+                        help='messages per second all users connected from one IP address may send together (0 for '
+                             'no limit)')
+    parser.add_argument('--address-burst', type=int, default=ADDRESS_BURST,
+                        help='messages all users from one IP address may send at once above their average rate')
+    parser.add_argument('--accept-rate', type=float, default=ACCEPT_RATE,
+                        help='new connections accepted per second (0 for no limit; per worker with --workers)')
+    parser.add_argument('--accept-burst', type=int, default=ACCEPT_BURST,
+                        help='new connections accepted at once above the average rate')
+    parser.add_argument('--max-message-size', type=int, default=MAX_MESSAGE_SIZE,
+                        help='largest message in bytes a user may send before being disconnected')
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help='seconds a user may be quiet before being pinged (0 turns heartbeats off)')
+    parser.add_argument('--heartbeat-timeout', type=float, default=HEARTBEAT_TIMEOUT,
+                        help='seconds a user may be quiet, not answering pings, before being disconnected')
+    parser.add_argument('--login-timeout', type=float, default=LOGIN_TIMEOUT,
+                        help='seconds a connection has to log in before being closed (0 for no deadline)')
+    parser.add_argument('--compression', action='store_true',
+                        help='compress what is sent to clients that ask for it (saves bandwidth on slow links at the '
+                             'cost of CPU on both ends)')
+    parser.add_argument('--compress-threshold', type=int, default=COMPRESS_THRESHOLD,
+                        help='smallest write in bytes worth compressing')
+    parser.add_argument('--batch-window', type=float, default=BATCH_WINDOW,
+                        help='seconds a small write waits for more messages to join it (0 to send straight away)')
+    parser.add_argument('--transfer-window', type=int, default=TRANSFER_WINDOW,
+                        help='bytes of a file its sender may send beyond what its slowest recipient has been written')
+    parser.add_argument('--tls-cert', default=None,
+                        help='PEM certificate (chain) file, to accept connections over TLS instead of plain TCP')
+    parser.add_argument('--tls-key', default=None,
+                        help="PEM private key file for --tls-cert (if the key isn't in the certificate file)")
+    parser.add_argument('--json-envelopes', action='store_true',
+                        help='send messages as JSON instead of the compact binary encoding, for debugging')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='local port serving metrics in the Prometheus text format (with several workers, each '
+                             'worker serves its own on the port plus its number, counting from 0)')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='info',
+                        help='least severe server log messages shown')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of asyncio worker processes sharing the port (relayed through a local hub)')
+    options = parser.parse_args(args)
+    if options.history_size < 1:
+        parser.error('--history-size must be at least 1')
+    if options.replay_size < 1:
+        parser.error('--replay-size must be at least 1')
+    if options.log_retain_segments < 0:
+        parser.error('--log-retain-segments must be at least 0')
+    if options.heartbeat_interval > 0 and options.heartbeat_timeout <= options.heartbeat_interval:
+        parser.error('--heartbeat-timeout must be longer than --heartbeat-interval')
+    if options.tls_key is not None and options.tls_cert is None:
+        parser.error('--tls-key needs --tls-cert')
+    if options.workers > 1:
+        if options.mode != 'asyncio':
+            parser.error('--workers needs --mode asyncio')
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error('--workers needs SO_REUSEPORT, which this platform does not support')
+    return options
+
+
+def open_message_log(options):
+    """
+    Opens the on-disk message log, if one was asked for.
+    :param options: the parsed command line options
+    :return: the opened MessageLog, or None to keep chat history in memory only
+    """
+    if options.log_dir is None:
+        return None
+    log = MessageLog(options.log_dir, options.log_segment_size, options.log_flush_interval,
+                     retain_segments=options.log_retain_segments)
+    log.open()
+    return log
+
+
+def open_tls_context(options):
+    """
+    Loads the server's certificate, if TLS was asked for.
+    :param options: the parsed command line options
+    :return: the server's SSLContext, or None to accept plain TCP connections
+    """
+    if options.tls_cert is None:
+        return None
+    return server_context(options.tls_cert, options.tls_key)
+
+
+def configure(options, schedule, close, abort, records=None, worker=0):
+    """
+    Applies the command line options to the server's settings, with the server engine's ways of running timers and
+    ending connections.
+    :param options: the parsed command line options
+    :param schedule: function called with (delay, callback) to run the callback later
+    :param close: function closing a removed user's connection
+    :param abort: function breaking off a connection at once
+    :param records: (room name, message) pairs to restore the rooms' histories from (None to read them from the log)
+    :param worker: number of the worker process being configured (0 when running as a single process)
+    :return:
+    """
+    global rooms, log, replay_size, queue_size, slow_consumer_policy, presence
+    global message_rate, message_burst, addresses, max_message_size, accept_bucket, heartbeats, login_timeout
+    global compression, compress_threshold, batch_window, tls_context, transfers, close_connection, abort_connection
+    protocol.json_envelopes = options.json_envelopes
+    # Only the first worker writes the message log
+    log = open_message_log(options) if worker == 0 else None
+    if records is None:
+        records = log.tail(options.log_recover) if log is not None else []
+    rooms = RoomDirectory(options.history_size, keep_empty=options.workers > 1, log=log)
+    # Pick up the chat history from before the last restart
+    rooms.restore(records)
+    presence = PresenceTracker(schedule, options.presence_window)
+    replay_size = options.replay_size
+    queue_size = options.queue_size
+    slow_consumer_policy = options.slow_consumer
+    message_rate = options.message_rate
+    message_burst = options.message_burst
+    addresses = AddressBuckets(options.address_rate, options.address_burst)
+    max_message_size = options.max_message_size
+    accept_bucket = TokenBucket(options.accept_rate, options.accept_burst)
+    heartbeats = Heartbeats(wheel, reap_idle, options.heartbeat_interval, options.heartbeat_timeout)
+    login_timeout = options.login_timeout
+    compression = options.compression
+    compress_threshold = options.compress_threshold
+    batch_window = options.batch_window
+    tls_context = open_tls_context(options)
+    transfers = TransferTable(registry.get, wheel, options.transfer_window)
+    close_connection = close
+    abort_connection = abort
+    metrics.watch_registry(registry)
+    if options.metrics_port is not None:
+        metrics.serve_metrics(METRICS_HOST, options.metrics_port + worker)
+
+
+def configure_logging(options):
+    """
+    Sets up the server's log (messages below the chosen level cost no more than a level check).
+    :param options: the parsed command line options
+    :return:
+    """
+    logging.basicConfig(level=options.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
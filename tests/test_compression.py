@@ -0,0 +1,120 @@
+import base64
+import os
+import zlib
+
+import pytest
+
+import server
+import service
+from compression import BATCH_SIZE, Compressor, decompressor
+from outbound import OutboundQueue
+from protocol import (COMPRESSED, HEADER, MAX_FRAME_SIZE, OP_CHAT, FrameDecoder, FrameError, encode_envelope,
+                      encode_frame, encode_frames)
+
+
+def chat_frames(count):
+    return [encode_frame(encode_envelope(OP_CHAT, sender='ana', color='black', body=f'[1:00PM] ana: hello {number}\n'))
+            for number in range(count)]
+
+
+def test_small_batches_are_sent_as_they_are():
+    data = encode_frames([b'tiny'])
+    assert Compressor(threshold=256).compress(data) is data
+
+
+def test_batches_inflate_back_into_frames():
+    compressor = Compressor(threshold=0)
+    decoder = FrameDecoder(decompressor=decompressor())
+    frames = chat_frames(20)
+    sizes = []
+    for batch in (frames[:10], frames[10:]):
+        data = compressor.compress(b''.join(batch))
+        assert HEADER.unpack_from(data)[0] & COMPRESSED
+        sizes.append(len(data))
+        decoder.feed(data)
+    assert list(iter(decoder.next_frame, None)) == [frame[HEADER.size:] for frame in frames]
+    # The second batch is compressed with the first as context
+    assert sizes[1] < sizes[0] < len(b''.join(frames[:10]))
+
+
+def test_large_batches_are_split_into_frames_the_client_accepts():
+    # Random text compresses poorly, so one compressed frame would be far over the limit
+    frames = [encode_frame(encode_envelope(OP_CHAT, body=base64.b64encode(os.urandom(3000)).decode()))
+              for _ in range(1000)]
+    data = Compressor().compress(b''.join(frames))
+    offset = 0
+    while offset < len(data):
+        (length,) = HEADER.unpack_from(data, offset)
+        assert length & COMPRESSED and length & ~COMPRESSED <= MAX_FRAME_SIZE
+        offset += HEADER.size + (length & ~COMPRESSED)
+    decoder = FrameDecoder(decompressor=decompressor())
+    decoder.feed(data)
+    assert list(iter(decoder.next_frame, None)) == [frame[HEADER.size:] for frame in frames]
+
+
+def test_compressed_and_plain_frames_mix():
+    compressor = Compressor(threshold=0)
+    decoder = FrameDecoder(decompressor=decompressor())
+    decoder.feed(encode_frame(b'plain') + compressor.compress(encode_frame(b'packed')) + encode_frame(b'again'))
+    assert list(iter(decoder.next_frame, None)) == [b'plain', b'packed', b'again']
+
+
+def test_compressed_frame_needs_negotiation():
+    with pytest.raises(FrameError):
+        FrameDecoder().feed(HEADER.pack(COMPRESSED | 1) + b'x')
+
+
+def test_malformed_compressed_frame():
+    with pytest.raises(FrameError):
+        FrameDecoder(decompressor=decompressor()).feed(HEADER.pack(COMPRESSED | 4) + b'junk')
+
+
+def test_inflated_frames_are_size_checked():
+    data = encode_frame(b'x' * 200)
+    compressed = zlib.compressobj(zdict=b'x')
+    payload = compressed.compress(data) + compressed.flush(zlib.Z_SYNC_FLUSH)
+    decoder = FrameDecoder(max_frame_size=100, decompressor=zlib.decompressobj(zdict=b'x'))
+    with pytest.raises(FrameError):
+        decoder.feed(HEADER.pack(len(payload) | COMPRESSED) + payload)
+
+
+class Socket:
+    def __init__(self):
+        self.writes = []
+
+    def sendall(self, data):
+        self.writes.append(bytes(data))
+
+
+def test_small_write_waits_for_more_messages(monkeypatch):
+    monkeypatch.setattr(service, 'batch_window', 0.01)
+    client = Socket()
+    outbound = OutboundQueue()
+    outbound.put(b'second')
+    server.write_frames(client, outbound, [b'first'])
+    assert client.writes == [b'firstsecond']
+
+
+def test_no_batch_window_writes_straight_away(monkeypatch):
+    monkeypatch.setattr(service, 'batch_window', 0)
+    client = Socket()
+    outbound = OutboundQueue()
+    outbound.put(b'second')
+    server.write_frames(client, outbound, [b'first'])
+    assert client.writes == [b'first']
+
+
+def test_waiting_file_chunks_are_not_held_up(monkeypatch):
+    monkeypatch.setattr(service, 'batch_window', 10)
+    client = Socket()
+    outbound = OutboundQueue()
+    server.write_frames(client, outbound, [b'first'], chunks=[([b'chunk'], None)])
+    assert client.writes == [b'first']
+
+
+def test_large_writes_go_straight_out(monkeypatch):
+    monkeypatch.setattr(service, 'batch_window', 10)
+    client = Socket()
+    outbound = OutboundQueue()
+    server.write_frames(client, outbound, [b'x' * BATCH_SIZE])
+    assert client.writes == [b'x' * BATCH_SIZE]
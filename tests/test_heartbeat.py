@@ -0,0 +1,144 @@
+from heartbeat import Heartbeats, TimerWheel
+from outbound import OutboundQueue
+from protocol import HEADER, OP_PING, FrameDecoder, decode_envelope
+from registry import UserRecord
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def wheel_with_clock(slot_count=8):
+    clock = Clock()
+    return TimerWheel(tick=1.0, slot_count=slot_count, clock=clock), clock
+
+
+def test_timer_fires_once_its_delay_has_passed():
+    wheel, clock = wheel_with_clock()
+    fired = []
+    wheel.schedule(2.5, lambda: fired.append(clock.now))
+    for now in (101.0, 102.0, 102.9):
+        clock.now = now
+        wheel.advance()
+    assert fired == []
+    clock.now = 103.0
+    wheel.advance()
+    wheel.advance()
+    assert fired == [103.0]
+
+
+def test_zero_delay_waits_for_the_next_tick():
+    wheel, clock = wheel_with_clock()
+    fired = []
+    wheel.schedule(0, lambda: fired.append(True))
+    wheel.advance()
+    assert fired == []
+    clock.now = 101.0
+    wheel.advance()
+    assert fired == [True]
+
+
+def test_cancelled_timer_does_not_fire():
+    wheel, clock = wheel_with_clock()
+    fired = []
+    wheel.schedule(1, lambda: fired.append(True)).cancel()
+    clock.now = 105.0
+    wheel.advance()
+    assert fired == []
+    assert not any(wheel.slots)
+
+
+def test_timers_further_than_one_turn():
+    wheel, clock = wheel_with_clock(slot_count=4)
+    fired = []
+    wheel.schedule(10, lambda: fired.append('late'))
+    wheel.schedule(2, lambda: fired.append('early'))
+    for now in range(101, 110):
+        clock.now = now
+        wheel.advance()
+    assert fired == ['early']
+    clock.now = 110.0
+    wheel.advance()
+    assert fired == ['early', 'late']
+
+
+def test_advancing_far_behind_runs_everything_due():
+    wheel, clock = wheel_with_clock(slot_count=4)
+    fired = []
+    for delay in (1, 3, 6, 50):
+        wheel.schedule(delay, lambda delay=delay: fired.append(delay))
+    clock.now = 120.0
+    wheel.advance()
+    assert sorted(fired) == [1, 3, 6]
+    clock.now = 150.0
+    wheel.advance()
+    assert sorted(fired) == [1, 3, 6, 50]
+
+
+def test_callback_can_reschedule():
+    wheel, clock = wheel_with_clock()
+    fired = []
+
+    def beat():
+        fired.append(clock.now)
+        wheel.schedule(1, beat)
+
+    wheel.schedule(1, beat)
+    for now in range(101, 105):
+        clock.now = now
+        wheel.advance()
+    assert fired == [101, 102, 103, 104]
+
+
+def watched_user(interval=10, timeout=30):
+    wheel, clock = wheel_with_clock(slot_count=64)
+    reaped = []
+    heartbeats = Heartbeats(wheel, reaped.append, interval, timeout, clock=clock)
+    user = UserRecord('ana', None, OutboundQueue(), FrameDecoder())
+    heartbeats.watch(user)
+    return wheel, clock, user, reaped
+
+
+def run_until(wheel, clock, until):
+    while clock.now < until:
+        clock.now += 1
+        wheel.advance()
+
+
+def test_quiet_user_is_pinged_then_reaped():
+    wheel, clock, user, reaped = watched_user()
+    run_until(wheel, clock, 109)
+    assert user.outbound.take_all() == []
+    run_until(wheel, clock, 111)
+    [ping] = user.outbound.take_all()
+    assert decode_envelope(ping[HEADER.size:]).op == OP_PING
+    run_until(wheel, clock, 129)
+    assert reaped == []
+    run_until(wheel, clock, 131)
+    assert reaped == [user]
+
+
+def test_active_user_is_left_alone():
+    wheel, clock, user, reaped = watched_user()
+    for _ in range(60):
+        user.last_seen = clock.now
+        run_until(wheel, clock, clock.now + 5)
+    assert user.outbound.take_all() == []
+    assert reaped == []
+
+
+def test_departed_user_is_no_longer_checked():
+    wheel, clock, user, reaped = watched_user()
+    user.outbound.close()
+    run_until(wheel, clock, 200)
+    assert reaped == []
+    assert not any(wheel.slots)
+
+
+def test_zero_interval_turns_heartbeats_off():
+    wheel, _, _, _ = watched_user(interval=0)
+    assert not any(wheel.slots)
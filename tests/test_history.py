@@ -0,0 +1,95 @@
+from history import ChatHistory, history_page, missed_messages, parse_history_request
+from protocol import OP_CHAT, OP_HISTORY_END, OP_HISTORY_PAGE, Envelope, decode_envelope, encode_envelope
+
+
+def filled(capacity, count):
+    history = ChatHistory(capacity)
+    for number in range(count):
+        history.append(encode_envelope(OP_CHAT, sender='ana', body=f'[1:00PM] ana: message {number}'))
+    return history
+
+
+def bodies(messages):
+    return [decode_envelope(message).body.rpartition(' ')[2] for message in messages]
+
+
+def test_append_numbers_messages():
+    history = filled(5, 3)
+    assert (history.first_sequence, history.next_sequence, len(history)) == (1, 4, 3)
+    assert bodies(history) == ['0', '1', '2']
+    assert bodies([history.message(2)]) == ['1']
+
+
+def test_wraparound_evicts_oldest():
+    history = filled(5, 12)
+    assert (history.first_sequence, history.next_sequence, len(history)) == (8, 13, 5)
+    assert bodies(history) == ['7', '8', '9', '10', '11']
+    assert sum(history.counts.values()) == 5
+    evicted = encode_envelope(OP_CHAT, sender='ana', body='[1:00PM] ana: message 6')
+    assert evicted not in history
+    assert history.message(12) in history
+
+
+def test_duplicates_are_counted_until_all_copies_are_evicted():
+    history = ChatHistory(3)
+    message = encode_envelope(OP_CHAT, body='again')
+    history.append(message)
+    history.append(message)
+    for number in range(2):
+        history.append(encode_envelope(OP_CHAT, body=str(number)))
+    assert message in history
+    history.append(encode_envelope(OP_CHAT, body='2'))
+    assert message not in history
+
+
+def test_range_and_before_clamp():
+    history = filled(5, 12)
+    assert bodies(history.range(0, 100)) == ['7', '8', '9', '10', '11']
+    assert history.range(20, 30) == []
+    start, messages = history.before(11, 2)
+    assert (start, bodies(messages)) == (9, ['8', '9'])
+    start, messages = history.before(9, 10)
+    assert (start, bodies(messages)) == (8, ['7'])
+    assert history.before(3, 10) == (8, [])
+    assert history.latest(3)[0] == 10
+
+
+def test_resume_at_only_moves_empty_history():
+    history = ChatHistory(5)
+    history.resume_at(100)
+    assert history.append(encode_envelope(OP_CHAT, body='x')) == 100
+    history.resume_at(5)
+    assert history.next_sequence == 101
+
+
+def test_history_page():
+    history = filled(5, 12)
+    page = history_page(history, count=2)
+    assert decode_envelope(page[0]).op == OP_HISTORY_PAGE
+    assert decode_envelope(page[0]).body == '11'
+    assert bodies(page[1:-1]) == ['10', '11']
+    assert decode_envelope(page[-1]).op == OP_HISTORY_END
+    assert decode_envelope(history_page(history, 11, 2)[0]).body == '9'
+
+
+def test_empty_history_page():
+    page = history_page(ChatHistory(5))
+    assert [decode_envelope(message).op for message in page] == [OP_HISTORY_PAGE, OP_HISTORY_END]
+
+
+def test_missed_messages():
+    history = filled(5, 12)
+    assert missed_messages(history, 12) == []
+    assert bodies(missed_messages(history, 9)) == ['9', '10', '11']
+    assert bodies(missed_messages(history, 7)) == ['7', '8', '9', '10', '11']
+    # Some of the missed messages were evicted
+    assert missed_messages(history, 6) is None
+    # A sequence number the history never reached
+    assert missed_messages(history, 13) is None
+    # More than a fresh login would replay
+    assert missed_messages(history, 8, count=2) is None
+
+
+def test_parse_history_request():
+    assert parse_history_request(Envelope(OP_CHAT, body='12')) == 12
+    assert parse_history_request(Envelope(OP_CHAT, body='twelve')) is None
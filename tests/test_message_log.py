@@ -0,0 +1,123 @@
+import os
+
+from message_log import RECORD, MessageLog, decode_record, encode_record
+
+
+def written(directory, records, **options):
+    log = MessageLog(str(directory), flush_interval=60, **options)
+    log.open()
+    for room, message in records:
+        log.append(room, message)
+    log.close()
+    return log
+
+
+def reopened(directory, **options):
+    log = MessageLog(str(directory), flush_interval=60, **options)
+    log.open()
+    return log
+
+
+def test_record_round_trip():
+    record = encode_record('lobby', b'hello')
+    assert decode_record(record, 0) == ('lobby', b'hello', len(record))
+    assert decode_record(record[:-1], 0) is None
+    assert decode_record(record[:RECORD.size - 1], 0) is None
+    assert decode_record(record[:-1] + b'x', 0) is None
+
+
+def test_tail_after_reopen(tmp_path):
+    records = [(f'room{number % 3}', f'message {number}'.encode()) for number in range(50)]
+    written(tmp_path, records, segment_size=200, index_interval=64)
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.log')]) > 1
+    log = reopened(tmp_path, segment_size=200, index_interval=64)
+    try:
+        assert log.next_offset == 50
+        assert log.tail(100) == records
+        assert log.tail(7) == records[-7:]
+        assert log.tail(0) == []
+    finally:
+        log.close()
+
+
+def test_oldest_segments_are_deleted_beyond_the_limit(tmp_path):
+    records = [('lobby', f'message {number}'.encode()) for number in range(50)]
+    written(tmp_path, records, segment_size=200, retain_segments=3)
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.log')]) == 3
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.index')]) == 3
+    log = reopened(tmp_path, segment_size=200, retain_segments=2)
+    try:
+        assert len(log.bases) == 2
+        assert log.next_offset == 50
+        kept = log.tail(100)
+        assert 0 < len(kept) < 50
+        assert kept == records[-len(kept):]
+    finally:
+        log.close()
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.log')]) == 2
+
+
+def test_appending_after_reopen_continues_numbering(tmp_path):
+    written(tmp_path, [('lobby', b'one')])
+    written(tmp_path, [('lobby', b'two')])
+    log = reopened(tmp_path)
+    try:
+        assert log.next_offset == 2
+        assert log.tail(10) == [('lobby', b'one'), ('lobby', b'two')]
+    finally:
+        log.close()
+
+
+def test_torn_write_is_cut_off(tmp_path):
+    records = [('lobby', f'message {number}'.encode()) for number in range(10)]
+    log = written(tmp_path, records, index_interval=1)
+    path = log.segment_path(0)
+    size = os.path.getsize(path)
+    # A crash part way through writing one more record
+    with open(path, 'ab') as segment:
+        segment.write(encode_record('lobby', b'torn')[:-2])
+    log = reopened(tmp_path, index_interval=1)
+    try:
+        assert os.path.getsize(path) == size
+        assert log.next_offset == 10
+        assert log.tail(100) == records
+        log.append('lobby', b'after')
+        log.flush()
+        assert log.tail(2) == [records[-1], ('lobby', b'after')]
+    finally:
+        log.close()
+
+
+def test_corrupt_record_is_cut_off(tmp_path):
+    records = [('lobby', f'message {number}'.encode()) for number in range(10)]
+    log = written(tmp_path, records)
+    path = log.segment_path(0)
+    cut = len(encode_record(*records[0])) * 6
+    # Record 6 was written in full but damaged, so it and everything after it are dropped
+    with open(path, 'r+b') as segment:
+        segment.seek(cut + RECORD.size)
+        segment.write(b'X')
+    log = reopened(tmp_path)
+    try:
+        assert os.path.getsize(path) == cut
+        assert log.next_offset == 6
+        assert log.tail(100) == records[:6]
+    finally:
+        log.close()
+
+
+def test_index_past_the_data_is_dropped(tmp_path):
+    records = [('lobby', f'message {number}'.encode()) for number in range(10)]
+    log = written(tmp_path, records, index_interval=1)
+    path = log.segment_path(0)
+    cut = len(encode_record(*records[0])) * 4
+    # The segment lost its last records but the index still has entries for them
+    with open(path, 'r+b') as segment:
+        segment.truncate(cut)
+    log = reopened(tmp_path, index_interval=1)
+    try:
+        assert log.next_offset == 4
+        assert all(position < cut for _, position in log.read_index(0))
+        assert log.tail(100) == records[:4]
+    finally:
+        log.close()
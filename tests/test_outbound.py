@@ -0,0 +1,105 @@
+import threading
+
+from outbound import OutboundQueue, bulk_written, fan_out
+
+
+def test_frames_are_taken_in_order():
+    queue = OutboundQueue(size=4)
+    assert queue.put(b'a') and queue.put(b'b')
+    assert len(queue) == 2
+    assert queue.take_all() == [b'a', b'b']
+    assert queue.take_all() == []
+
+
+def test_drop_policy_discards_new_frames():
+    queue = OutboundQueue(size=2, policy='drop')
+    assert queue.put(b'a') and queue.put(b'b')
+    assert not queue.put(b'c')
+    assert queue.dropped == 1
+    assert queue.take_all() == [b'a', b'b']
+
+
+def test_coalesce_policy_replaces_superseded_frames():
+    queue = OutboundQueue(size=3, policy='coalesce')
+    queue.put(b'users 1', key='users')
+    queue.put(b'chat')
+    assert queue.put(b'users 2', key='users')
+    assert queue.take_all() == [b'users 2', b'chat']
+
+
+def test_coalesce_policy_discards_oldest_when_full():
+    queue = OutboundQueue(size=2, policy='coalesce')
+    queue.put(b'users 1', key='users')
+    queue.put(b'a')
+    assert queue.put(b'b')
+    assert queue.dropped == 1
+    # The evicted keyed frame no longer takes replacements
+    queue.put(b'users 2', key='users')
+    assert queue.take_all() == [b'b', b'users 2']
+
+
+def test_keys_are_ignored_by_other_policies():
+    queue = OutboundQueue(size=4, policy='drop')
+    queue.put(b'users 1', key='users')
+    queue.put(b'users 2', key='users')
+    assert queue.take_all() == [b'users 1', b'users 2']
+
+
+def test_disconnect_policy_closes_the_queue():
+    overflowed = []
+    queue = OutboundQueue(size=1, policy='disconnect', on_overflow=lambda: overflowed.append(True))
+    assert queue.put(b'a')
+    assert not queue.put(b'b')
+    assert queue.closed and queue.overflowed
+    assert overflowed == [True]
+    assert not queue.put(b'c')
+
+
+def test_wakeup_is_called_for_every_frame():
+    wakeups = []
+    queue = OutboundQueue(wakeup=lambda: wakeups.append(True))
+    queue.put(b'a')
+    queue.put_bulk([b'chunk'])
+    queue.close()
+    assert len(wakeups) == 3
+
+
+def test_wait_all_returns_once_closed():
+    queue = OutboundQueue()
+    taken = []
+    writer = threading.Thread(target=lambda: taken.append(queue.wait_all()))
+    writer.start()
+    queue.put(b'a')
+    writer.join(5)
+    assert taken == [[b'a']]
+    queue.close()
+    assert queue.wait_all() == []
+
+
+def test_bulk_lane_is_taken_a_write_at_a_time():
+    queue = OutboundQueue()
+    written = []
+    for number in range(4):
+        queue.put_bulk([b'h', b'x' * 40], on_written=lambda number=number: written.append(number))
+    items = queue.take_bulk(limit=60)
+    assert len(items) == 2
+    bulk_written(items)
+    assert written == [0, 1]
+    # At least one item is taken however large it is
+    assert len(queue.take_bulk(limit=1)) == 1
+
+
+def test_closing_drops_bulk_data():
+    queue = OutboundQueue()
+    queue.put_bulk([b'chunk'])
+    queue.close()
+    assert queue.take_bulk() == []
+    assert not queue.put_bulk([b'chunk'])
+
+
+def test_fan_out_shares_one_frame():
+    queues = [OutboundQueue(size=1, policy='drop') for _ in range(3)]
+    queues[0].put(b'full')
+    frame = b'message'
+    assert fan_out(frame, queues) == 2
+    assert all(queue.take_all()[0] is frame for queue in queues[1:])
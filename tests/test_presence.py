@@ -0,0 +1,88 @@
+from outbound import OutboundQueue
+from presence import PresenceTracker, presence_delta, user_list_snapshot
+from protocol import OP_PRESENCE, OP_USER_LIST, FrameDecoder, decode_envelope
+from registry import UserRecord
+from rooms import Room
+
+
+class Scheduler:
+    def __init__(self):
+        self.callbacks = []
+
+    def __call__(self, delay, callback):
+        self.callbacks.append((delay, callback))
+
+    def run(self):
+        callbacks = self.callbacks
+        self.callbacks = []
+        for _, callback in callbacks:
+            callback()
+
+
+def room_with_member(name='lobby'):
+    room = Room(name)
+    member = UserRecord('watcher', None, OutboundQueue(), FrameDecoder())
+    room.members[member.username] = member
+    return room, member
+
+
+def deltas(member):
+    decoder = FrameDecoder()
+    decoder.feed(b''.join(member.outbound.take_all()))
+    envelopes = [decode_envelope(frame) for frame in iter(decoder.next_frame, None)]
+    assert all(envelope.op == OP_PRESENCE for envelope in envelopes)
+    return [envelope.body for envelope in envelopes]
+
+
+def test_snapshot_and_delta_encoding():
+    snapshot = decode_envelope(user_list_snapshot(['ana', 'bo']))
+    assert (snapshot.op, snapshot.body) == (OP_USER_LIST, 'ana bo')
+    assert decode_envelope(presence_delta({'ana': True, 'bo': False})).body == '+ana -bo'
+
+
+def test_changes_in_one_window_go_out_as_one_delta():
+    schedule = Scheduler()
+    presence = PresenceTracker(schedule, window=0.05)
+    room, member = room_with_member()
+    presence.changed(room, 'ana', True)
+    presence.changed(room, 'bo', True)
+    presence.changed(room, 'cy', True)
+    # One flush is scheduled for the whole window
+    assert [delay for delay, _ in schedule.callbacks] == [0.05]
+    assert deltas(member) == []
+    schedule.run()
+    assert deltas(member) == ['+ana +bo +cy']
+
+
+def test_latest_state_wins():
+    schedule = Scheduler()
+    presence = PresenceTracker(schedule)
+    room, member = room_with_member()
+    presence.changed(room, 'ana', True)
+    presence.changed(room, 'ana', False)
+    schedule.run()
+    assert deltas(member) == ['-ana']
+
+
+def test_each_room_gets_its_own_delta():
+    schedule = Scheduler()
+    presence = PresenceTracker(schedule)
+    lobby, lobby_member = room_with_member('lobby')
+    games, games_member = room_with_member('games')
+    presence.changed(lobby, 'ana', True)
+    presence.changed(games, 'bo', False)
+    schedule.run()
+    assert deltas(lobby_member) == ['+ana']
+    assert deltas(games_member) == ['-bo']
+    # A new window starts after a flush
+    presence.changed(lobby, 'cy', True)
+    assert len(schedule.callbacks) == 1
+
+
+def test_zero_window_sends_straight_away():
+    schedule = Scheduler()
+    presence = PresenceTracker(schedule, window=0)
+    room, member = room_with_member()
+    presence.changed(room, 'ana', True)
+    assert schedule.callbacks == []
+    assert deltas(member) == ['+ana']
@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+import protocol
+from protocol import (CHUNK, HEADER, OP_CHAT, OP_DIRECT, OP_FILE_CHUNK, Envelope, FrameDecoder, FrameError,
+                      decode_chunk, decode_envelope, encode_chunk_header, encode_envelope, encode_frame, encode_frames,
+                      stamp_sequence)
+
+
+def test_decoder_partial_and_batched_frames():
+    messages = [b'one', b'', b'three' * 100]
+    data = encode_frames(messages)
+    decoder = FrameDecoder()
+    # Byte by byte, each frame only appears once it is complete
+    for byte in data[:-1]:
+        decoder.feed(bytes([byte]))
+    assert [decoder.next_frame(), decoder.next_frame(), decoder.next_frame()] == [b'one', b'', None]
+    decoder.feed(data[-1:])
+    assert decoder.next_frame() == messages[2]
+    assert decoder.next_frame() is None
+    # All at once, plus the start of another
+    assert decoder.feed(data + encode_frame(b'four')[:3]) == 3
+    assert [decoder.next_frame() for _ in range(3)] == messages
+    decoder.feed(encode_frame(b'four')[3:])
+    assert decoder.next_frame() == b'four'
+
+
+def test_text_frames_are_encoded_as_utf8():
+    decoder = FrameDecoder()
+    decoder.feed(encode_frame('héllo'))
+    assert decoder.next_frame() == 'héllo'.encode('utf-8')
+
+
+def test_decoder_rejects_oversize_frame():
+    decoder = FrameDecoder(max_frame_size=100)
+    decoder.feed(encode_frame(b'x' * 100))
+    assert decoder.next_frame() == b'x' * 100
+    # Refused before the rest of the payload arrives
+    with pytest.raises(FrameError):
+        FrameDecoder(max_frame_size=100).feed(HEADER.pack(101) + bytes([OP_CHAT]))
+
+
+def test_envelope_round_trip():
+    message = encode_envelope(OP_DIRECT, sender='ana', target='bo', color='red', body='hi ✓', time=7)
+    envelope = decode_envelope(message)
+    assert (envelope.op, envelope.sender, envelope.target, envelope.color, envelope.body, envelope.time) == \
+        (OP_DIRECT, 'ana', 'bo', 'red', 'hi ✓', 7)
+    assert decode_envelope(stamp_sequence(encode_envelope(OP_CHAT, body='x'), 42)).sequence == 42
+
+
+def test_json_envelope_round_trip(monkeypatch):
+    monkeypatch.setattr(protocol, 'json_envelopes', True)
+    message = stamp_sequence(encode_envelope(OP_CHAT, sender='ana', body='hi', time=7), 3)
+    assert json.loads(message)['op'] == 'CHAT'
+    envelope = decode_envelope(message)
+    assert (envelope.op, envelope.sender, envelope.body, envelope.time, envelope.sequence) == \
+        (OP_CHAT, 'ana', 'hi', 7, 3)
+
+
+@pytest.mark.parametrize('fields', [
+    {'op': 'CHAT', 'body': 5},
+    {'op': 'CHAT', 'time': '5'},
+    {'op': 'CHAT', 'sequence': True},
+    {'op': 'CHAT', 'unknown': 'x'},
+    {'op': 'NOPE'},
+    {'body': 'no op'},
+    {'op': 'FILE_CHUNK', 'body': 'data'},
+])
+def test_bad_json_envelope(fields):
+    with pytest.raises(FrameError):
+        decode_envelope(json.dumps(fields).encode('utf-8'))
+
+
+@pytest.mark.parametrize('payload', [b'', b'\x0c\x00', encode_envelope(OP_CHAT, sender='ana')[:-1],
+                                     encode_envelope(OP_CHAT, body='\xe9')[:-1], b'{not json', b'[1]'])
+def test_malformed_envelope(payload):
+    with pytest.raises(FrameError):
+        decode_envelope(payload)
+
+
+def test_chunk_round_trip():
+    data = b'file data'
+    frame = encode_chunk_header('ana', 'bo', 5, 1000, len(data)) + data
+    decoder = FrameDecoder()
+    assert decoder.feed(frame) == 1
+    envelope = decode_envelope(decoder.next_frame())
+    assert (envelope.op, envelope.sender, envelope.target) == (OP_FILE_CHUNK, 'ana', 'bo')
+    transfer_id, offset, chunk = decode_chunk(envelope)
+    assert (transfer_id, offset, bytes(chunk)) == (5, 1000, data)
+
+
+def test_chunk_errors():
+    short = encode_chunk_header('ana', '', 5, 0, 0)[HEADER.size:-1]
+    with pytest.raises(FrameError):
+        decode_chunk(decode_envelope(short))
+    with pytest.raises(FrameError):
+        decode_chunk(Envelope(OP_FILE_CHUNK, body='x' * CHUNK.size))
+
+
+def test_decoder_allows_large_chunk_frames():
+    data = b'y' * 500
+    frame = encode_chunk_header('ana', '', 1, 0, len(data)) + data
+    decoder = FrameDecoder(max_frame_size=100, max_chunk_size=1000)
+    # The opcode is not known until the byte after the header arrives
+    assert decoder.feed(frame[:HEADER.size]) == 0
+    assert decoder.feed(frame[HEADER.size:]) == 1
+    assert bytes(decode_chunk(decode_envelope(decoder.next_frame()))[2]) == data
+
+
+def test_decoder_limits_chunk_frames():
+    with pytest.raises(FrameError):
+        FrameDecoder(max_frame_size=100, max_chunk_size=1000).feed(HEADER.pack(1001) + bytes([OP_FILE_CHUNK]))
@@ -0,0 +1,58 @@
+from ratelimit import AddressBuckets, FloodControl, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_burst_then_paced_to_rate():
+    clock = Clock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.take() == 0.5
+    assert bucket.take() == 1.0
+    clock.now = 1.0
+    assert bucket.take() == 0.5
+
+
+def test_refill_is_capped_at_burst():
+    clock = Clock()
+    bucket = TokenBucket(rate=1, burst=2, clock=clock)
+    clock.now = 100.0
+    assert [bucket.take() for _ in range(2)] == [0, 0]
+    assert bucket.take() == 1.0
+
+
+def test_take_several_tokens():
+    clock = Clock()
+    bucket = TokenBucket(rate=10, burst=10, clock=clock)
+    assert bucket.take(10) == 0
+    assert bucket.take(5) == 0.5
+
+
+def test_zero_rate_never_limits():
+    bucket = TokenBucket(rate=0, burst=0, clock=Clock())
+    assert all(bucket.take() == 0 for _ in range(100))
+
+
+def test_address_buckets_are_shared_and_released():
+    buckets = AddressBuckets(rate=1, burst=1)
+    first = buckets.acquire('10.0.0.1')
+    assert buckets.acquire('10.0.0.1') is first
+    assert buckets.acquire('10.0.0.2') is not first
+    buckets.release('10.0.0.1')
+    assert '10.0.0.1' in buckets.buckets
+    buckets.release('10.0.0.1')
+    assert '10.0.0.1' not in buckets.buckets
+    buckets.release('10.0.0.1')
+
+
+def test_flood_control_waits_for_slower_bucket():
+    clock = Clock()
+    flood = FloodControl(TokenBucket(10, 1, clock=clock), TokenBucket(1, 1, clock=clock))
+    assert flood.take() == 0
+    assert flood.take() == 1.0
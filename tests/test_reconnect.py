@@ -0,0 +1,51 @@
+from reconnect import (RECONNECT_MAX_DELAY, Backoff, login_body, new_token, parse_login_body, resume_point,
+                       valid_token)
+from registry import UserRecord
+
+
+class Highest:
+    @staticmethod
+    def uniform(low, high):
+        return high
+
+
+def test_tokens_are_unique():
+    assert len({new_token() for _ in range(100)}) == 100
+
+
+def test_valid_token():
+    token = new_token()
+    user = UserRecord('ana', None, None, None, token=token)
+    assert valid_token(user, token)
+    assert not valid_token(user, new_token())
+    assert not valid_token(user, None)
+    assert not valid_token(None, token)
+    assert not valid_token(UserRecord('ana', None, None, None), token)
+
+
+def test_login_body_round_trip():
+    body = login_body(['deflate'], token='abc', room='games', after=12, unused=None)
+    assert body == 'deflate token=abc room=games after=12'
+    assert parse_login_body(body) == ({'deflate'}, {'token': 'abc', 'room': 'games', 'after': '12'})
+    assert parse_login_body('') == (set(), {})
+
+
+def test_resume_point():
+    assert resume_point({'after': '12'}) == 12
+    assert resume_point({'after': 'twelve'}) is None
+    assert resume_point({}) is None
+
+
+def test_backoff_cap_doubles_up_to_the_maximum():
+    backoff = Backoff(delay=0.5, max_delay=4, rng=Highest)
+    assert [backoff.next_delay() for _ in range(6)] == [0.5, 1, 2, 4, 4, 4]
+    backoff.reset()
+    assert backoff.next_delay() == 0.5
+
+
+def test_backoff_is_jittered_and_never_overflows():
+    backoff = Backoff()
+    backoff.attempts = 10000
+    delays = [backoff.next_delay() for _ in range(100)]
+    assert all(0 <= delay <= RECONNECT_MAX_DELAY for delay in delays)
+    assert len(set(delays)) > 1
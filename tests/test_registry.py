@@ -0,0 +1,14 @@
+import pytest
+
+from registry import MAX_USERNAME_LENGTH, valid_username
+
+
+@pytest.mark.parametrize('username', ['ana', 'Bo_2', 'é', 'a+b', 'x' * MAX_USERNAME_LENGTH])
+def test_valid_username(username):
+    assert valid_username(username)
+
+
+@pytest.mark.parametrize('username', ['', 'two words', 'tab\there', 'new\nline', '+ana', '-ana', '\x00',
+                                      'x' * (MAX_USERNAME_LENGTH + 1), 'nb\u00a0sp'])
+def test_invalid_username(username):
+    assert not valid_username(username)
@@ -0,0 +1,113 @@
+from outbound import OutboundQueue
+from protocol import OP_CHAT, FrameDecoder, decode_envelope, encode_envelope, encode_frame, stamp_sequence
+from registry import UserRecord
+from rooms import DEFAULT_ROOM, MAX_ROOM_NAME_LENGTH, RoomDirectory, valid_room_name
+
+
+def user(username):
+    return UserRecord(username, None, OutboundQueue(), FrameDecoder())
+
+
+def received(user):
+    decoder = FrameDecoder()
+    decoder.feed(b''.join(user.outbound.take_all()))
+    return [decode_envelope(frame) for frame in iter(decoder.next_frame, None)]
+
+
+def test_join_moves_user_between_rooms():
+    rooms = RoomDirectory()
+    ana = user('ana')
+    assert rooms.join(ana) == (None, rooms.get(DEFAULT_ROOM))
+    old_room, room = rooms.join(ana, 'games')
+    assert old_room is rooms.get(DEFAULT_ROOM) and room is rooms.get('games')
+    assert ana.room is room
+    assert room.usernames() == ['ana']
+    assert len(old_room) == 0
+
+
+def test_empty_rooms_are_discarded_except_the_default():
+    rooms = RoomDirectory()
+    ana = user('ana')
+    rooms.join(ana, 'games')
+    assert rooms.leave(ana).name == 'games'
+    assert ana.room is None
+    assert rooms.get('games') is None
+    rooms.join(ana)
+    rooms.leave(ana)
+    assert rooms.get(DEFAULT_ROOM) is not None
+    assert rooms.leave(ana) is None
+
+
+def test_workers_keep_empty_rooms():
+    rooms = RoomDirectory(keep_empty=True)
+    ana = user('ana')
+    rooms.join(ana, 'games')
+    rooms.leave(ana)
+    assert rooms.get('games') is not None
+
+
+def test_on_join_sees_the_new_member():
+    rooms = RoomDirectory()
+    seen = []
+    rooms.join(user('ana'), 'games', lambda room: seen.append((room.name, list(room.members))))
+    assert seen == [('games', ['ana'])]
+
+
+def test_publish_only_reaches_the_room():
+    rooms = RoomDirectory()
+    ana, bo, cy = user('ana'), user('bo'), user('cy')
+    rooms.join(ana, 'games')
+    rooms.join(bo, 'games')
+    rooms.join(cy)
+    assert rooms.get('games').publish(None, encode_envelope(OP_CHAT, body='hi')) == 2
+    assert [envelope.body for envelope in received(ana)] == ['hi']
+    assert [envelope.body for envelope in received(bo)] == ['hi']
+    assert received(cy) == []
+
+
+def test_recorded_messages_are_stamped_with_their_sequence():
+    rooms = RoomDirectory(history_size=10)
+    ana = user('ana')
+    rooms.join(ana)
+    room = rooms.get(DEFAULT_ROOM)
+    for text in ('one', 'two'):
+        room.publish(None, encode_envelope(OP_CHAT, body=text))
+    # Unrecorded messages are sent as they are
+    room.publish(encode_frame(encode_envelope(OP_CHAT, body='three')))
+    assert [(envelope.body, envelope.sequence) for envelope in received(ana)] == [('one', 1), ('two', 2),
+                                                                                  ('three', 0)]
+    assert [decode_envelope(message).sequence for message in room.history] == [1, 2]
+
+
+def logged(room, sequences):
+    return [(room, stamp_sequence(encode_envelope(OP_CHAT, body=f'{room} {sequence}'), sequence))
+            for sequence in sequences]
+
+
+def test_restore_keeps_the_logged_numbering():
+    rooms = RoomDirectory()
+    records = logged('games', range(7, 10))
+    rooms.restore(records)
+    history = rooms.get('games').history
+    assert (history.first_sequence, history.next_sequence) == (7, 10)
+    assert list(history) == [message for _, message in records]
+
+
+def test_restore_keeps_only_the_newest_room_of_a_reused_name():
+    rooms = RoomDirectory()
+    # The room was discarded after its third message, and a new room of the same name numbered from 1 again
+    newest = logged('games', [1, 2])
+    rooms.restore(logged('games', [1, 2, 3]) + logged(DEFAULT_ROOM, [1]) + newest)
+    history = rooms.get('games').history
+    assert (history.first_sequence, history.next_sequence) == (1, 3)
+    assert list(history) == [message for _, message in newest]
+    assert len(rooms.get(DEFAULT_ROOM).history) == 1
+
+
+def test_valid_room_name():
+    assert valid_room_name('games')
+    assert valid_room_name('x' * MAX_ROOM_NAME_LENGTH)
+    assert not valid_room_name('')
+    assert not valid_room_name('two words')
+    assert not valid_room_name('tab\t')
+    assert not valid_room_name('x' * (MAX_ROOM_NAME_LENGTH + 1))
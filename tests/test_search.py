@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+from history import ChatHistory
+from protocol import OP_CHAT, OP_JOINED, OP_SEARCH, OP_SEARCH_END, OP_SEARCH_RESULTS, Envelope, decode_envelope, \
+    encode_envelope
+from search import SearchQuery, parse_search_request, scan, search_body, search_page, words
+
+SENDERS = ['ana', 'bo', 'cy']
+WORDS = ['apple', 'pear', 'plum', 'fig', 'kiwi']
+
+
+def chat(sender, text, time=0):
+    return encode_envelope(OP_CHAT, sender=sender, body=f'[1:00PM] {sender}: {text}', time=time)
+
+
+def random_history(capacity, count, seed):
+    generator = random.Random(seed)
+    history = ChatHistory(capacity)
+    for number in range(count):
+        if generator.random() < 0.1:
+            history.append(encode_envelope(OP_JOINED, sender=generator.choice(SENDERS), time=number))
+        else:
+            text = ' '.join(generator.choices(WORDS, k=generator.randint(1, 3)))
+            history.append(chat(generator.choice(SENDERS), text, number))
+    return history
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_index_matches_scan(seed):
+    # More messages than the history holds, so the index has evicted some too
+    history = random_history(200, 650, seed)
+    queries = [SearchQuery(set()), SearchQuery({'apple'}), SearchQuery({'apple', 'fig'}),
+               SearchQuery(set(), sender='bo'), SearchQuery({'plum'}, sender='cy'), SearchQuery({'durian'}),
+               SearchQuery(set(), sender='nobody')]
+    for query in queries:
+        matches, _ = history.index.search(query, count=1000)
+        assert matches == scan(history, query, count=1000)
+
+
+def test_paging_through_results():
+    history = random_history(200, 650, 1)
+    query = SearchQuery({'pear'})
+    expected = scan(history, query, count=1000)
+    found = []
+    while True:
+        matches, more = history.index.search(query, count=7)
+        found += matches
+        if more is None:
+            break
+        query.before = more
+    assert found == expected
+
+
+def test_time_range():
+    history = ChatHistory(10)
+    for time in range(0, 100, 10):
+        history.append(chat('ana', 'apple', time))
+    matches, _ = history.index.search(SearchQuery({'apple'}, since=25, until=60))
+    assert [decode_envelope(history.message(sequence)).time for sequence in matches] == [50, 40, 30]
+
+
+def test_only_message_text_is_indexed():
+    history = ChatHistory(10)
+    history.append(chat('ana', 'hello'))
+    assert history.index.search(SearchQuery({'ana'}))[0] == []
+    assert history.index.search(SearchQuery({'hello'}))[0] == [1]
+
+
+def test_search_page():
+    history = ChatHistory(10)
+    for number in range(5):
+        history.append(chat('ana', f'apple {number}'))
+    page = search_page(history, SearchQuery({'apple'}), count=2)
+    assert decode_envelope(page[0]).op == OP_SEARCH_RESULTS
+    assert decode_envelope(page[0]).body == '4'
+    assert [decode_envelope(message).body for message in page[1:-1]] == ['[1:00PM] ana: apple 4',
+                                                                          '[1:00PM] ana: apple 3']
+    assert decode_envelope(page[-1]).op == OP_SEARCH_END
+    assert decode_envelope(search_page(history, SearchQuery({'pear'}))[0]).body == ''
+
+
+def test_parse_search_request():
+    query = parse_search_request(Envelope(OP_SEARCH, body=search_body('Apple pie', 'bo', 5, 9, 12)))
+    assert (query.words, query.sender, query.since, query.until, query.before) == ({'apple', 'pie'}, 'bo', 5, 9, 12)
+    assert parse_search_request(Envelope(OP_SEARCH, body='since:soon')) is None
+    assert parse_search_request(Envelope(OP_SEARCH, body=' '.join(WORDS * 2 + ['a', 'b', 'c', 'd']))) is None
+
+
+def test_words():
+    assert words("Don't PANIC, don't!") == {'don', 't', 'panic'}
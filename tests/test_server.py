@@ -0,0 +1,122 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from chat_client import ChatClient, LoginError
+from protocol import OP_CHAT, OP_DIRECT, OP_JOINED
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+# Seconds to wait for the server to start, and for an expected message
+START_TIMEOUT = 10
+RECEIVE_TIMEOUT = 5
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(params=['threaded', 'asyncio'])
+def server(request):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--port', str(port), '--mode', request.param,
+                                '--log-level', 'warning'])
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                pytest.fail('server did not start')
+            time.sleep(0.05)
+    yield port
+    process.terminate()
+    process.wait()
+
+
+async def logged_in(port, username):
+    client = ChatClient(port=port)
+    await client.connect()
+    await client.login(username)
+    return client
+
+
+async def expect(client, op, body='', timeout=RECEIVE_TIMEOUT):
+    """
+    Skips received messages until one with the given opcode (and text in its body) arrives.
+    """
+    async def wait():
+        while True:
+            envelope = await client.receive()
+            assert envelope is not None, 'connection closed'
+            if envelope.op == op and body in envelope.body:
+                return envelope
+    return await asyncio.wait_for(wait(), timeout)
+
+
+async def nothing_more(client, op, seconds=0.3):
+    """
+    Checks that no message with the given opcode arrives for a while.
+    """
+    with pytest.raises(asyncio.TimeoutError):
+        await expect(client, op, timeout=seconds)
+
+
+def test_login_broadcast_and_direct_message(server):
+    async def scenario():
+        ana = await logged_in(server, 'ana')
+        bo = await logged_in(server, 'bo')
+        cy = await logged_in(server, 'cy')
+        try:
+            await expect(ana, OP_JOINED, 'bo has joined')
+            assert ana.room == bo.room == 'lobby'
+
+            await ana.send('hello everyone')
+            for client in (ana, bo, cy):
+                envelope = await expect(client, OP_CHAT)
+                assert envelope.sender == 'ana'
+                assert envelope.body.endswith('ana: hello everyone\n')
+                # Recorded in the room's history
+                assert envelope.sequence > 0
+
+            await ana.send_direct('bo', 'just for you')
+            for client in (ana, bo):
+                envelope = await expect(client, OP_DIRECT)
+                assert (envelope.sender, envelope.target) == ('ana', 'bo')
+                assert 'just for you' in envelope.body
+            await nothing_more(cy, OP_DIRECT)
+
+            # Messages stay in the room they were sent to
+            await cy.join_room('games')
+            await expect(cy, OP_JOINED, 'cy has joined')
+            await ana.send('lobby only')
+            await expect(bo, OP_CHAT, 'lobby only')
+            await nothing_more(cy, OP_CHAT)
+        finally:
+            for client in (ana, bo, cy):
+                await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_taken_username_is_refused(server):
+    async def scenario():
+        ana = await logged_in(server, 'ana')
+        other = ChatClient(port=server)
+        try:
+            await other.connect()
+            with pytest.raises(LoginError):
+                await other.login('ana')
+        finally:
+            await ana.close()
+            await other.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,51 @@
+import pytest
+
+import service
+from outbound import OutboundQueue
+from protocol import FrameDecoder
+from registry import UserRecord, UserRegistry
+from rooms import RoomDirectory
+
+
+class Bus:
+    def __init__(self):
+        self.published = []
+        self.released = []
+
+    def publish(self, event, data=b''):
+        self.published.append(event)
+
+    def release(self, username):
+        self.released.append(username)
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    bus = Bus()
+    monkeypatch.setattr(service, 'bus', bus)
+    monkeypatch.setattr(service, 'registry', UserRegistry())
+    monkeypatch.setattr(service, 'rooms', RoomDirectory())
+    monkeypatch.setattr(service, 'close_connection', lambda connection: None)
+    return bus
+
+
+def user(username):
+    return UserRecord(username, None, OutboundQueue(), FrameDecoder())
+
+
+def test_removed_user_frees_their_username_on_other_workers(bus):
+    alice = user('alice')
+    service.registry.reserve(alice)
+    service.rooms.join(alice, 'lobby')
+    service.remove_client(alice)
+    assert bus.released == ['alice']
+    assert [event['op'] for event in bus.published] == ['presence', 'room']
+
+
+def test_user_removed_before_joining_a_room_frees_their_username(bus):
+    alice = user('alice')
+    service.registry.reserve(alice)
+    service.remove_client(alice)
+    assert bus.released == ['alice']
+    assert bus.published == []
+    assert 'alice' not in service.registry
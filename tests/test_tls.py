@@ -0,0 +1,106 @@
+import shutil
+import socket
+import subprocess
+import threading
+
+import pytest
+
+from tls import SharedTLSSocket, client_context, server_context
+
+
+@pytest.fixture(scope='module')
+def certificate(tmp_path_factory):
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl is needed to create a test certificate')
+    directory = tmp_path_factory.mktemp('tls')
+    cert_file, key_file = str(directory / 'cert.pem'), str(directory / 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost', '-keyout', key_file, '-out', cert_file],
+                   check=True, capture_output=True)
+    return cert_file, key_file
+
+
+@pytest.fixture
+def echo_server(certificate):
+    context = server_context(*certificate)
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def serve():
+        while True:
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            with context.wrap_socket(client, server_side=True) as connection:
+                try:
+                    while data := connection.recv(1024):
+                        connection.sendall(data)
+                except OSError:
+                    pass
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield listener.getsockname()
+    listener.close()
+
+
+def connect(context, address):
+    connection = context.wrap_socket(socket.create_connection(address), server_hostname='localhost')
+    return SharedTLSSocket(connection)
+
+
+def test_reconnecting_resumes_the_session(certificate, echo_server):
+    context = client_context(certificate[0])
+    resumed = []
+    for _ in range(3):
+        connection = connect(context, echo_server)
+        connection.sendall(b'ping')
+        assert connection.recv(1024) == b'ping'
+        # The server's session tickets have arrived along with the answer
+        context.remember(connection)
+        resumed.append(connection.session_reused)
+        connection.close()
+    assert resumed == [False, True, True]
+
+
+def test_without_remembering_every_handshake_is_full(certificate, echo_server):
+    context = client_context(certificate[0])
+    for _ in range(2):
+        connection = connect(context, echo_server)
+        connection.sendall(b'ping')
+        assert connection.recv(1024) == b'ping'
+        assert not connection.session_reused
+        connection.close()
+
+
+def test_shared_socket_reads_and_writes_from_two_threads(certificate, echo_server):
+    connection = connect(client_context(certificate[0]), echo_server)
+    data = bytes(range(256)) * 4096
+    received = bytearray()
+
+    def read():
+        while len(received) < len(data):
+            received.extend(connection.recv(65536))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    connection.sendall(data)
+    reader.join(10)
+    connection.close()
+    assert received == data
+
+
+def test_closing_wakes_a_blocked_reader(certificate, echo_server):
+    connection = connect(client_context(certificate[0]), echo_server)
+    outcome = []
+
+    def read():
+        try:
+            outcome.append(connection.recv(1024))
+        except OSError as error:
+            outcome.append(error)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    connection.close()
+    reader.join(5)
+    assert not reader.is_alive()
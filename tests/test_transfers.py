@@ -0,0 +1,156 @@
+import os
+
+from heartbeat import TimerWheel
+from outbound import OutboundQueue, bulk_written
+from protocol import (HEADER, OP_FILE_ACCEPT, OP_FILE_CREDIT, OP_FILE_END, OP_FILE_OFFER, Envelope, FrameDecoder,
+                      decode_envelope, encode_chunk_header)
+from registry import UserRecord
+from rooms import Room
+from transfers import (END_CANCELLED, END_DONE, END_REFUSED, IncomingFile, TransferTable, download_path, parse_numbers,
+                       parse_offer)
+
+
+def test_parse_numbers():
+    assert parse_numbers('1 2 3') == [1, 2, 3]
+    assert parse_numbers('') == []
+    assert parse_numbers('1 two') is None
+
+
+def test_parse_offer():
+    assert parse_offer('7 1024 my file.txt') == (7, 1024, 'my file.txt')
+    assert parse_offer('7 1024') is None
+    assert parse_offer('7 big file.txt') is None
+    assert parse_offer(f'{2 ** 32} 1 file') is None
+    assert parse_offer('-1 1 file') is None
+    assert parse_offer('') is None
+
+
+def test_incoming_file_skips_repeated_data(tmp_path):
+    path = tmp_path / 'file'
+    incoming = IncomingFile('ana', 1, 10, 'file', str(path))
+    assert incoming.write(0, b'01234') == 5
+    # A resent chunk overlapping what was already received
+    assert incoming.write(3, b'3456') == 2
+    assert incoming.write(0, b'012') == 0
+    # A chunk past a gap is not written
+    assert incoming.write(9, b'9') == 0
+    assert incoming.accept_body() == '1 7'
+    assert incoming.write(7, b'789') == 3
+    incoming.close()
+    assert path.read_bytes() == b'0123456789'
+
+
+def test_incoming_file_without_path():
+    incoming = IncomingFile('ana', 1, 3, 'file')
+    assert incoming.write(0, b'abc') == 3
+    assert incoming.received == 3
+    incoming.close()
+
+
+def test_download_path(tmp_path):
+    directory = str(tmp_path)
+    assert download_path(directory, 'notes.txt') == os.path.join(directory, 'notes.txt')
+    assert download_path(directory, '../../etc/passwd') == os.path.join(directory, 'passwd')
+    assert download_path(directory, 'C:\\Users\\x\\report.pdf') == os.path.join(directory, 'report.pdf')
+    assert download_path(directory, '.bashrc') == os.path.join(directory, 'bashrc')
+    assert download_path(directory, '..') == os.path.join(directory, 'download')
+    (tmp_path / 'notes.txt').write_text('')
+    (tmp_path / 'notes (1).txt').write_text('')
+    assert download_path(directory, 'notes.txt') == os.path.join(directory, 'notes (2).txt')
+
+
+class Users(dict):
+    def add(self, username, room=None):
+        user = self[username] = UserRecord(username, None, OutboundQueue(), FrameDecoder())
+        user.room = room
+        return user
+
+
+def received(user):
+    decoder = FrameDecoder()
+    decoder.feed(b''.join(user.outbound.take_all()))
+    return [decode_envelope(frame) for frame in iter(decoder.next_frame, None)]
+
+
+def chunk(user, transfer_id, offset, data):
+    frame = encode_chunk_header(user.username, '', transfer_id, offset, len(data)) + data
+    return decode_envelope(frame[HEADER.size:])
+
+
+def write_bulk(user):
+    items = user.outbound.take_bulk()
+    bulk_written(items)
+    return b''.join(bytes(item[0][1]) for item in items)
+
+
+def test_direct_transfer_is_credited_and_relayed():
+    users = Users()
+    ana, bo = users.add('ana'), users.add('bo')
+    wheel = TimerWheel()
+    table = TransferTable(users.get, wheel, window=100)
+    table.offer(ana, Envelope(OP_FILE_OFFER, target='bo', body='1 150 notes.txt'))
+    [offer] = received(bo)
+    assert (offer.op, offer.sender, offer.body) == (OP_FILE_OFFER, 'ana', '1 150 notes.txt')
+    table.accept(bo, Envelope(OP_FILE_ACCEPT, target='ana', body='1 0'))
+    assert [(envelope.op, envelope.body) for envelope in received(ana)] == [(OP_FILE_CREDIT, '1 100')]
+    assert table.chunk(ana, chunk(ana, 1, 0, b'a' * 60))
+    # Chunks past the credit, or not where the sender is up to, are dropped
+    assert not table.chunk(ana, chunk(ana, 1, 60, b'b' * 60))
+    assert not table.chunk(ana, chunk(ana, 1, 0, b'a' * 10))
+    assert table.chunk(ana, chunk(ana, 1, 60, b'b' * 40))
+    assert write_bulk(bo) == b'a' * 60 + b'b' * 40
+    assert [(envelope.op, envelope.body) for envelope in received(ana)] == [(OP_FILE_CREDIT, '1 150')]
+    assert table.chunk(ana, chunk(ana, 1, 100, b'c' * 50))
+    assert write_bulk(bo) == b'c' * 50
+    assert len(table) == 0
+    assert [(envelope.op, envelope.target, envelope.body) for envelope in received(bo)] == \
+        [(OP_FILE_END, 'ana', f'1 {END_DONE}')]
+    assert [envelope.op for envelope in received(ana)] == [OP_FILE_END]
+
+
+def test_offers_that_cannot_start_are_refused():
+    users = Users()
+    ana = users.add('ana')
+    table = TransferTable(users.get, TimerWheel())
+    for target, body in (('nobody', '1 10 file'), ('ana', '2 10 file'), ('', f'3 {2 ** 40} file'), ('', '4 10 \n')):
+        table.offer(ana, Envelope(OP_FILE_OFFER, target=target, body=body))
+    assert [envelope.body for envelope in received(ana)] == [f'{number} {END_REFUSED}' for number in range(1, 5)]
+    assert len(table) == 0
+
+
+def test_room_offer_reaches_only_members_on_the_same_server():
+    users = Users()
+    lobby = Room('lobby')
+    ana = users.add('ana', lobby)
+    lobby.members['ana'] = ana
+    # Members logged in on other workers cannot take the file, so with nobody else here it is refused at once
+    lobby.remote_members.add('bo')
+    table = TransferTable(users.get, TimerWheel())
+    table.offer(ana, Envelope(OP_FILE_OFFER, body='1 10 file'))
+    assert [envelope.body for envelope in received(ana)] == [f'1 {END_REFUSED}']
+    cy = lobby.members['cy'] = users.add('cy', lobby)
+    table.offer(ana, Envelope(OP_FILE_OFFER, body='2 10 file'))
+    assert [(envelope.op, envelope.body) for envelope in received(cy)] == [(OP_FILE_OFFER, '2 10 file')]
+    assert len(table) == 1
+
+
+def test_accepting_a_finished_transfer_cancels_it():
+    users = Users()
+    bo = users.add('bo')
+    table = TransferTable(users.get, TimerWheel())
+    table.accept(bo, Envelope(OP_FILE_ACCEPT, target='ana', body='1 0'))
+    assert [(envelope.op, envelope.body) for envelope in received(bo)] == [(OP_FILE_END, f'1 {END_CANCELLED}')]
+
+
+def test_stalled_transfer_expires():
+    users = Users()
+    ana = users.add('ana')
+    users.add('bo')
+    clock = [100.0]
+    wheel = TimerWheel(tick=1, clock=lambda: clock[0])
+    table = TransferTable(users.get, wheel, timeout=5)
+    table.offer(ana, Envelope(OP_FILE_OFFER, target='bo', body='1 10 file'))
+    clock[0] = 106.0
+    wheel.advance()
+    assert len(table) == 0
+    assert [envelope.body for envelope in received(ana)] == [f'1 {END_CANCELLED}']
@@ -0,0 +1,73 @@
+import argparse
+import time
+import timeit
+
+
+def format_timestamp(current_time):
+    """
+    Builds the 12-hour timestamp shown with each chat message.
+    :param current_time: the time as a time.struct_time
+    :return: the timestamp string, e.g. '[1:5:9PM]'
+    """
+    hours = current_time.tm_hour
+    identifier = 'AM'
+    if hours >= 12:
+        identifier = 'PM'
+        if hours > 12:
+            hours -= 12
+    return f'[{hours}:{current_time.tm_min}:{current_time.tm_sec}{identifier}]'
+
+
+class TimestampCache:
+    """
+    Hands out message timestamps, formatting the displayed one only once per second however many messages are sent
+    in it.
+    """
+
+    def __init__(self, clock=time.time):
+        # Function returning the current time in seconds since the epoch
+        self.clock = clock
+        # (second, formatted timestamp) for the last second a timestamp was asked for, replaced as a whole so threads
+        # never see one without the other
+        self.current = (None, None)
+
+    def now(self):
+        """
+        Gets the current time for stamping a message.
+        :return: tuple of (formatted timestamp, milliseconds since the epoch)
+        """
+        now = self.clock()
+        second = int(now)
+        cached_second, formatted = self.current
+        if second != cached_second:
+            formatted = format_timestamp(time.localtime(second))
+            self.current = (second, formatted)
+        return formatted, int(now * 1000)
+
+
+# Shared by everything stamping messages in this process
+timestamps = TimestampCache()
+
+
+def main(args=None):
+    """
+    Microbenchmark comparing formatting every timestamp against using the cache.
+    :param args: list of arguments to parse (defaults to sys.argv)
+    :return: dict of nanoseconds per call for each approach
+    """
+    parser = argparse.ArgumentParser(description='Timestamp formatting microbenchmark')
+    parser.add_argument('--number', type=int, default=1000000, help='calls timed per approach')
+    options = parser.parse_args(args)
+    cache = TimestampCache()
+    results = {
+        'format every call': timeit.timeit(lambda: format_timestamp(time.localtime()), number=options.number),
+        'cached': timeit.timeit(cache.now, number=options.number),
+    }
+    results = {name: seconds / options.number * 1e9 for name, seconds in results.items()}
+    for name, nanoseconds in results.items():
+        print(f'{name:<18} {nanoseconds:8.1f} ns/call')
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import select
+import socket
+import ssl
+import threading
+
+# Session tickets the server issues per TLS 1.3 handshake, each letting the client skip a later full handshake
+SESSION_TICKETS = 2
+
+
+def server_context(cert_file, key_file):
+    """
+    Creates the server's TLS context.
+    :param cert_file: PEM file holding the server's certificate (chain)
+    :param key_file: PEM file holding the certificate's private key
+    :return: the SSLContext
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    context.num_tickets = SESSION_TICKETS
+    return context
+
+
+class ClientContext(ssl.SSLContext):
+    """
+    Client TLS context that offers the last session it saw when connecting, so reconnecting to the same server (e.g.
+    every client of a restarted server at once) resumes the session instead of paying for a full handshake. It also
+    works for asyncio connections, which have no way of passing a session themselves.
+    """
+    # The session to resume, once a connection has received one
+    session = None
+
+    def wrap_socket(self, sock, *args, session=None, **kwargs):
+        return super().wrap_socket(sock, *args, session=session or self.session, **kwargs)
+
+    def wrap_bio(self, incoming, outgoing, *args, session=None, **kwargs):
+        return super().wrap_bio(incoming, outgoing, *args, session=session or self.session, **kwargs)
+
+    def remember(self, connection):
+        """
+        Keeps a connection's session for the next connection to resume (TLS 1.3 servers send their session tickets
+        after the handshake, so this is best called once something has been received).
+        :param connection: the SSLSocket or SSLObject
+        :return:
+        """
+        if connection is not None and connection.session is not None:
+            self.session = connection.session
+
+
+def client_context(ca_file=None, verify=True):
+    """
+    Creates a client TLS context.
+    :param ca_file: PEM file of the certificate authorities to trust (None for the system's)
+    :param verify: whether to check the server's certificate (turn off only for testing against self-signed servers)
+    :return: the ClientContext
+    """
+    context = ClientContext(ssl.PROTOCOL_TLS_CLIENT)
+    if ca_file is not None:
+        context.load_verify_locations(ca_file)
+    else:
+        context.load_default_certs()
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class SharedTLSSocket:
+    """
+    TLS socket that one thread can read from while another writes to it. An OpenSSL connection must not be used by
+    two threads at once, so every TLS call is made under a lock; the socket is non-blocking so no call ever holds the
+    lock while waiting, which happens in poll() instead.
+    """
+
+    def __init__(self, sock):
+        # The connected SSLSocket, after its handshake
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.lock = threading.Lock()
+
+    def recv(self, size):
+        """
+        Blocks until data is received.
+        :param size: the maximum number of bytes to receive
+        :return: the received bytes (empty once the connection is closed)
+        """
+        while True:
+            with self.lock:
+                try:
+                    return self.sock.recv(size)
+                # Only part of a record (or a record carrying no data, like a session ticket) has arrived
+                except ssl.SSLWantReadError:
+                    pass
+            self.wait(readable=True)
+
+    def sendall(self, data):
+        """
+        Blocks until all the data is sent.
+        :param data: the bytes to send
+        :return:
+        """
+        view = memoryview(data)
+        while view:
+            with self.lock:
+                try:
+                    view = view[self.sock.send(view):]
+                    continue
+                except ssl.SSLWantWriteError:
+                    pass
+            self.wait(readable=False)
+
+    def wait(self, readable):
+        """
+        Blocks until the socket can be read from or written to.
+        :param readable: True to wait until it can be read from, False until it can be written to
+        :return:
+        """
+        fileno = self.sock.fileno()
+        # Closed by another thread
+        if fileno < 0:
+            raise ConnectionAbortedError('connection closed')
+        # poll() handles descriptors of any number, select() (all Windows has) only those below FD_SETSIZE
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(fileno, select.POLLIN if readable else select.POLLOUT)
+            poller.poll()
+        else:
+            select.select([fileno] if readable else [], [] if readable else [fileno], [])
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        # Wake any thread waiting on the socket first, they would never hear of it being closed otherwise
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        with self.lock:
+            self.sock.close()
+
+    @property
+    def session(self):
+        with self.lock:
+            return self.sock.session
+
+    @property
+    def session_reused(self):
+        return self.sock.session_reused
@@ -0,0 +1,562 @@
+import collections
+import functools
+import itertools
+import os
+import ssl
+import threading
+
+import metrics
+from protocol import (OP_FILE_CREDIT, OP_FILE_END, OP_FILE_OFFER, decode_chunk, encode_chunk_header, encode_envelope,
+                      encode_frame)
+
+# Bytes of file data a client sends per FILE_CHUNK
+CHUNK_SIZE = 64 * 1024
+# Bytes of a file its sender may send beyond what has been written to the slowest recipient, bounding how much of each
+# transfer the server holds at once
+TRANSFER_WINDOW = 1024 * 1024
+# Largest file that may be offered
+MAX_FILE_SIZE = 4 * 1024 ** 3
+# Longest file name that may be offered
+MAX_FILE_NAME_LENGTH = 255
+# Most transfers a user may be sending at once
+MAX_TRANSFERS = 4
+# Seconds a stalled transfer (its sender disconnected, or nobody taking the file) waits to be resumed before it is
+# given up on
+TRANSFER_TIMEOUT = 60.0
+# Reasons a transfer ends with, in FILE_END bodies
+END_DONE = 'done'
+END_CANCELLED = 'cancelled'
+END_REFUSED = 'refused'
+# Most buffers handed to the kernel in one gather write
+MAX_GATHER = 64
+
+
+class Recipient:
+    """
+    A user taking an offered file, and how much of it has been written to them.
+    """
+    __slots__ = ('user', 'written')
+
+    def __init__(self, user, written=0):
+        # UserRecord of the recipient
+        self.user = user
+        # Bytes of the file written to the recipient's connection (or that they already had when resuming)
+        self.written = written
+
+
+class Transfer:
+    """
+    A file being relayed from its sender to the users taking it.
+    """
+    __slots__ = ('id', 'username', 'sender', 'target', 'room', 'name', 'size', 'offset', 'granted', 'restart',
+                 'recipients', 'expiry')
+
+    def __init__(self, transfer_id, sender, target, room, name, size):
+        # Id the sender picked for the transfer (unique among their transfers)
+        self.id = transfer_id
+        # Username of the sender, and their UserRecord (None while they are disconnected)
+        self.username = sender.username
+        self.sender = sender
+        # Username of the user the file was offered to ('' when offered to the sender's room), and the Room it was
+        # offered in
+        self.target = target
+        self.room = room
+        self.name = name
+        self.size = size
+        # Offset of the next byte expected from the sender, and how far they may send
+        self.offset = 0
+        self.granted = 0
+        # Whether the sender has to be told where to carry on from with their next credit (after they reconnected, or
+        # someone took the file from an earlier offset)
+        self.restart = False
+        # Username -> Recipient of the users taking the file
+        self.recipients = {}
+        # Timer giving up on the transfer while it is stalled (None while it is not)
+        self.expiry = None
+
+    def offered_to(self, user):
+        """
+        Checks whether a user may take the file.
+        :param user: UserRecord of the user
+        :return: True if the file was offered to them (or to the room they are in), else False
+        """
+        if self.target:
+            return user.username == self.target
+        return user.room is self.room and user.username != self.username
+
+
+class TransferTable:
+    """
+    The file transfers in progress on a server. Files are relayed, never stored: each chunk is queued in the bulk lane
+    of every recipient's OutboundQueue as a view into the frame it arrived in, and its sender is only allowed (given
+    credit) to send a window beyond what has been written to the slowest recipient. A transfer survives either side
+    reconnecting for a while: the sender offers the file again or a recipient takes it again from what they have, and
+    the sender is told where to carry on from (the other recipients get those bytes again, and skip them).
+    Thread-safe; chunks and credit are queued from whichever thread or task handles the message or writes the chunk.
+    """
+
+    def __init__(self, lookup, wheel, window=TRANSFER_WINDOW, timeout=TRANSFER_TIMEOUT):
+        # Function getting the UserRecord of a logged in user by username (None if nobody holds it)
+        self.lookup = lookup
+        # TimerWheel the expiry of stalled transfers is scheduled on
+        self.wheel = wheel
+        self.window = window
+        self.timeout = timeout
+        # (sender's username, transfer id) -> Transfer
+        self.transfers = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.transfers)
+
+    def offer(self, user, envelope):
+        """
+        Starts a transfer, passing the offer on to whoever it is for, or resumes one the sender offers again after
+        reconnecting.
+        :param user: UserRecord of the sender
+        :param envelope: the FILE_OFFER envelope
+        :return:
+        """
+        offer = parse_offer(envelope.body)
+        if offer is None:
+            return
+        transfer_id, size, name = offer
+        target = envelope.target
+        with self.lock:
+            transfer = self.transfers.get((user.username, transfer_id))
+            if transfer is not None:
+                transfer.sender = user
+                transfer.restart = True
+                self.unstall(transfer)
+                self.progress(transfer)
+                return
+            if not self.acceptable(user, target, size, name):
+                user.outbound.put(end_frame(user.username, transfer_id, END_REFUSED))
+                return
+            transfer = self.transfers[(user.username, transfer_id)] = Transfer(transfer_id, user, target, user.room,
+                                                                               name, size)
+            # Nobody has taken the file yet
+            self.stall(transfer)
+        metrics.transfers.inc()
+        frame = encode_frame(encode_envelope(OP_FILE_OFFER, sender=user.username, target=target, body=envelope.body))
+        if not target:
+            transfer.room.publish(frame)
+            return
+        # The target may have left meanwhile, the transfer then expires
+        recipient = self.lookup(target)
+        if recipient is not None:
+            recipient.outbound.put(frame)
+
+    def acceptable(self, user, target, size, name):
+        """
+        Checks whether a new transfer may be started (caller holds the lock).
+        :param user: UserRecord of the sender
+        :param target: username of the user the file is offered to ('' for the sender's room)
+        :param size: the file's size in bytes
+        :param name: the file's name
+        :return: True if the transfer may start, else False
+        """
+        if not 0 <= size <= MAX_FILE_SIZE or not 0 < len(name) <= MAX_FILE_NAME_LENGTH or not name.isprintable():
+            return False
+        # Files are relayed by the server (or worker) holding the sender's connection, so only the users logged in on
+        # it can take them: an offer nobody here could take is refused straight away rather than left to expire
+        if target and (target == user.username or self.lookup(target) is None):
+            return False
+        if not target and len(user.room) < 2:
+            return False
+        return sum(username == user.username for username, _ in self.transfers) < MAX_TRANSFERS
+
+    def accept(self, user, envelope):
+        """
+        Adds a user taking an offered file (again, from what they already have, when resuming).
+        :param user: UserRecord of the recipient
+        :param envelope: the FILE_ACCEPT envelope
+        :return:
+        """
+        numbers = parse_numbers(envelope.body)
+        if numbers is None or len(numbers) != 2:
+            return
+        transfer_id, offset = numbers
+        with self.lock:
+            transfer = self.transfers.get((envelope.target, transfer_id))
+            # Finished or given up on already
+            if transfer is None:
+                user.outbound.put(end_frame(envelope.target, transfer_id, END_CANCELLED))
+                return
+            if not transfer.offered_to(user):
+                return
+            # The sender carries on from what the recipient has, if they are past that
+            offset = min(max(offset, 0), transfer.offset)
+            transfer.recipients[user.username] = Recipient(user, offset)
+            if offset < transfer.offset:
+                transfer.offset = offset
+                transfer.restart = True
+            self.unstall(transfer)
+            self.progress(transfer)
+
+    def chunk(self, user, envelope):
+        """
+        Relays a chunk of a file to the users taking it. Chunks the sender was not (or no longer) allowed to send are
+        dropped.
+        :param user: UserRecord of the sender
+        :param envelope: the FILE_CHUNK envelope
+        :return: True if the chunk was relayed, False if it was dropped
+        """
+        transfer_id, offset, data = decode_chunk(envelope)
+        end = offset + len(data)
+        with self.lock:
+            transfer = self.transfers.get((user.username, transfer_id))
+            if transfer is None or transfer.sender is not user or offset != transfer.offset or end > transfer.granted:
+                return False
+            transfer.offset = end
+            # The header is built once for every recipient, and the data is the frame the chunk arrived in
+            header = encode_chunk_header(user.username, transfer.target, transfer_id, offset, len(data))
+            for recipient in transfer.recipients.values():
+                recipient.user.outbound.put_bulk([header, data], functools.partial(self.written, transfer, recipient,
+                                                                                   end))
+        metrics.transfer_bytes.inc(len(data))
+        return True
+
+    def end(self, user, envelope):
+        """
+        Gives up on a transfer for its sender, or for one recipient (a file offered to one user is given up on along
+        with them, or refused if they never took it).
+        :param user: UserRecord of the user giving up
+        :param envelope: the FILE_END envelope
+        :return:
+        """
+        numbers = parse_numbers(envelope.body.split(' ', 1)[0])
+        if not numbers:
+            return
+        with self.lock:
+            transfer = self.transfers.get((envelope.target, numbers[0]))
+            if transfer is None:
+                return
+            if transfer.sender is user:
+                self.finish(transfer, END_CANCELLED)
+            elif transfer.target and transfer.target == user.username:
+                self.finish(transfer, END_CANCELLED if user.username in transfer.recipients else END_REFUSED)
+            else:
+                self.drop_recipient(transfer, user)
+
+    def disconnect(self, user):
+        """
+        Stalls the transfers a disconnected user was sending, and stops relaying the ones they were taking, until they
+        come back and resume them (or the transfers expire).
+        :param user: UserRecord of the user
+        :return:
+        """
+        with self.lock:
+            for transfer in list(self.transfers.values()):
+                if transfer.sender is user:
+                    transfer.sender = None
+                    self.stall(transfer)
+                self.drop_recipient(transfer, user)
+
+    def drop_recipient(self, transfer, user):
+        """
+        Stops relaying a transfer to a user, if they are taking it (caller holds the lock).
+        :param transfer: the Transfer
+        :param user: UserRecord of the user
+        :return: True if that left the transfer without recipients, else False
+        """
+        recipient = transfer.recipients.get(user.username)
+        if recipient is None or recipient.user is not user:
+            return False
+        del transfer.recipients[user.username]
+        if transfer.recipients:
+            # The slowest recipient may have been the one leaving
+            self.progress(transfer)
+            return False
+        self.stall(transfer)
+        return True
+
+    def written(self, transfer, recipient, end):
+        """
+        Records a chunk as written to a recipient, crediting the sender as the slowest recipient catches up (called by
+        the recipient's writer).
+        :param transfer: the Transfer
+        :param recipient: the Recipient
+        :param end: offset into the file of the end of the chunk
+        :return:
+        """
+        with self.lock:
+            recipient.written = max(recipient.written, end)
+            if transfer.recipients.get(recipient.user.username) is recipient:
+                self.progress(transfer)
+
+    def progress(self, transfer):
+        """
+        Finishes a transfer once every recipient has been written the whole file, otherwise gives the sender more
+        credit once enough has been written (caller holds the lock).
+        :param transfer: the Transfer
+        :return:
+        """
+        if self.transfers.get((transfer.username, transfer.id)) is not transfer or not transfer.recipients:
+            return
+        slowest = min(recipient.written for recipient in transfer.recipients.values())
+        if slowest == transfer.size:
+            self.finish(transfer, END_DONE)
+            return
+        if transfer.sender is None:
+            return
+        limit = min(transfer.size, slowest + self.window)
+        # Credit goes out a quarter of a window at a time rather than for every chunk, unless the sender is waiting
+        # for it (or has to be told where to carry on from)
+        if not transfer.restart and (limit <= transfer.granted or limit < transfer.granted + self.window // 4 and
+                                     transfer.offset < transfer.granted and limit < transfer.size):
+            return
+        transfer.granted = limit
+        body = f'{transfer.id} {limit} {transfer.offset}' if transfer.restart else f'{transfer.id} {limit}'
+        transfer.restart = False
+        transfer.sender.outbound.put(encode_frame(encode_envelope(OP_FILE_CREDIT, target=transfer.username,
+                                                                  body=body)))
+
+    def finish(self, transfer, reason):
+        """
+        Ends a transfer, telling its sender and recipients (caller holds the lock).
+        :param transfer: the Transfer
+        :param reason: why it ended (END_DONE, END_CANCELLED or END_REFUSED)
+        :return:
+        """
+        del self.transfers[(transfer.username, transfer.id)]
+        if transfer.expiry is not None:
+            transfer.expiry.cancel()
+        frame = end_frame(transfer.username, transfer.id, reason)
+        users = [recipient.user for recipient in transfer.recipients.values()]
+        if transfer.sender is not None:
+            users.append(transfer.sender)
+        for user in users:
+            user.outbound.put(frame)
+        if reason == END_DONE:
+            metrics.transfers_completed.inc()
+
+    def stall(self, transfer):
+        """
+        Starts the countdown to giving up on a transfer that cannot go on (caller holds the lock).
+        :param transfer: the Transfer
+        :return:
+        """
+        if transfer.expiry is None:
+            transfer.expiry = self.wheel.schedule(self.timeout, functools.partial(self.expire, transfer))
+
+    def unstall(self, transfer):
+        """
+        Stops the countdown of a transfer that can go on again (caller holds the lock).
+        :param transfer: the Transfer
+        :return:
+        """
+        if transfer.expiry is not None and transfer.sender is not None and transfer.recipients:
+            transfer.expiry.cancel()
+            transfer.expiry = None
+
+    def expire(self, transfer):
+        """
+        Gives up on a transfer that stayed stalled (called by the timer wheel).
+        :param transfer: the Transfer
+        :return:
+        """
+        with self.lock:
+            transfer.expiry = None
+            if self.transfers.get((transfer.username, transfer.id)) is not transfer:
+                return
+            if transfer.sender is None or not transfer.recipients:
+                self.finish(transfer, END_CANCELLED)
+
+
+def end_frame(sender, transfer_id, reason):
+    """
+    Builds the framed message ending a transfer.
+    :param sender: username of the user sending the file
+    :param transfer_id: the transfer's id
+    :param reason: why it ended
+    :return: the framed FILE_END envelope
+    """
+    return encode_frame(encode_envelope(OP_FILE_END, target=sender, body=f'{transfer_id} {reason}'))
+
+
+def parse_offer(body):
+    """
+    Reads a FILE_OFFER body.
+    :param body: the body, '<id> <size> <name>'
+    :return: tuple of (transfer id, size, file name), or None if the body is malformed
+    """
+    parts = body.split(' ', 2)
+    numbers = parse_numbers(' '.join(parts[:2]))
+    if len(parts) != 3 or numbers is None or len(numbers) != 2 or not 0 <= numbers[0] < 2 ** 32:
+        return None
+    return numbers[0], numbers[1], parts[2]
+
+
+def parse_numbers(body):
+    """
+    Reads the numbers in a FILE_ACCEPT, FILE_CREDIT or FILE_END body.
+    :param body: the numbers, space separated
+    :return: list of numbers, or None if the body is malformed
+    """
+    try:
+        return [int(number) for number in body.split()]
+    except ValueError:
+        return None
+
+
+def send_buffers(sock, buffers):
+    """
+    Writes buffers to a socket one after the other without joining them. A plain socket gets them in gather writes,
+    so file data goes from the frame it arrived in straight to the kernel; anything else (TLS) gets a sendall() per
+    buffer.
+    :param sock: the socket
+    :param buffers: list of buffers
+    :return:
+    """
+    if isinstance(sock, ssl.SSLSocket) or not hasattr(sock, 'sendmsg'):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    views = collections.deque(memoryview(buffer) for buffer in buffers if len(buffer))
+    while views:
+        sent = sock.sendmsg(list(itertools.islice(views, MAX_GATHER)))
+        # Drop what was sent, the last buffer may only have been partly
+        while sent:
+            if sent >= views[0].nbytes:
+                sent -= views.popleft().nbytes
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+class OutgoingFile:
+    """
+    A file a client is sending: how far it has been sent, and how far the server allows it to be.
+    """
+
+    def __init__(self, transfer_id, path, target=''):
+        self.id = transfer_id
+        self.path = path
+        self.name = os.path.basename(path)
+        # Username of the user the file is for ('' for the sender's room)
+        self.target = target
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # Offset of the next byte to send, and how far the server allows sending
+        self.position = 0
+        self.limit = 0
+        # Why the transfer ended (None while it goes on)
+        self.ended = None
+
+    def offer_body(self):
+        """
+        Builds the body of the file's FILE_OFFER envelope.
+        :return: the body
+        """
+        return f'{self.id} {self.size} {self.name}'
+
+    def credit(self, envelope):
+        """
+        Applies credit from the server.
+        :param envelope: the FILE_CREDIT envelope
+        :return:
+        """
+        numbers = parse_numbers(envelope.body)
+        if numbers is None or len(numbers) < 2:
+            return
+        self.limit = numbers[1]
+        # The server wants the file from an earlier offset (resuming, or someone taking it late)
+        if len(numbers) > 2:
+            self.position = numbers[2]
+
+    def suspend(self):
+        """
+        Stops sending until the server says where to carry on from (after reconnecting).
+        :return:
+        """
+        self.limit = 0
+
+    def next_chunk(self, chunk_size=CHUNK_SIZE):
+        """
+        Picks the next chunk to send, moving past it.
+        :param chunk_size: the most bytes to send in one chunk
+        :return: tuple of (offset, length), or None if nothing may be sent until more credit arrives
+        """
+        length = min(chunk_size, self.limit - self.position)
+        if length <= 0:
+            return None
+        offset = self.position
+        self.position += length
+        return offset, length
+
+    def close(self):
+        """
+        Closes the file.
+        :return:
+        """
+        self.file.close()
+
+
+class IncomingFile:
+    """
+    A file a client is receiving, written at the offsets its chunks say (chunks repeating what was already received
+    after the sender carried on from an earlier offset are skipped).
+    """
+
+    def __init__(self, sender, transfer_id, size, name, path=None):
+        self.sender = sender
+        self.id = transfer_id
+        self.size = size
+        self.name = name
+        # Where the file is saved (None to only count what is received)
+        self.path = path
+        self.file = open(path, 'wb') if path is not None else None
+        # Bytes received so far, from the start of the file
+        self.received = 0
+        # Why the transfer ended (None while it goes on)
+        self.ended = None
+
+    def write(self, offset, data):
+        """
+        Writes a received chunk.
+        :param offset: offset into the file of the chunk's data
+        :param data: the data
+        :return: number of new bytes received
+        """
+        end = offset + len(data)
+        if offset > self.received or end <= self.received:
+            return 0
+        data = data[self.received - offset:]
+        if self.file is not None:
+            self.file.seek(self.received)
+            self.file.write(data)
+        self.received = end
+        return len(data)
+
+    def accept_body(self):
+        """
+        Builds the body of the FILE_ACCEPT envelope taking the file from what was already received.
+        :return: the body
+        """
+        return f'{self.id} {self.received}'
+
+    def close(self):
+        """
+        Closes the file.
+        :return:
+        """
+        if self.file is not None:
+            self.file.close()
+
+
+def download_path(directory, name):
+    """
+    Picks where to save a received file, keeping only the file name the sender gave and not overwriting an existing
+    file.
+    :param directory: the directory to save in
+    :param name: the name the file was offered under
+    :return: the path
+    """
+    name = os.path.basename(name.replace('\\', '/')).lstrip('.') or 'download'
+    stem, extension = os.path.splitext(name)
+    path = os.path.join(directory, name)
+    for copy in itertools.count(1):
+        if not os.path.exists(path):
+            return path
+        path = os.path.join(directory, f'{stem} ({copy}){extension}')